@@ -0,0 +1,136 @@
+"""
+Compare the per-crop fan-out with the single shelf-level call.
+
+For each shelf image, runs detection once and then the analysis stage in
+both LLM_ANALYSIS_MODE settings, reporting end-to-end latency, number of
+gpt-4o calls and tokens used per image. Calls the live OpenAI API, or with
+--fake-openai the local stand-in (benchmarks/fake_openai.py), whose token
+counts follow the image detail levels.
+
+--synthetic N analyzes N synthetic shelf photos (shelf_images.py) with
+their known boxes instead, so neither the detector weights nor the
+classifier are needed (every produce crop gets the same classification).
+
+Usage:
+    python benchmarks/analysis_modes.py shelf1.jpg [shelf2.jpg ...] [--repeat 3]
+    python benchmarks/analysis_modes.py --synthetic 8 --fake-openai [--latency-ms 800]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from load_test import start_process, wait_until_ready  # noqa: E402
+from shelf_images import make_shelf  # noqa: E402
+
+# Cache hits would make the second mode look free
+os.environ["LLM_CACHE_ENABLED"] = "0"
+
+MODES = ["per_crop", "shelf"]
+
+
+async def run_once(llm_client, main, pil_image, detections, mode, classifications=None):
+    before = dict(llm_client.usage_totals)
+    start = time.perf_counter()
+    await main.process_detections_with_clients(
+        client=llm_client.get_client(),
+        detections=detections,
+        pil_image=pil_image,
+        analysis_mode=mode,
+        classifications=classifications,
+    )
+    elapsed = time.perf_counter() - start
+    after = llm_client.usage_totals
+    return {
+        "seconds": elapsed,
+        "calls": after["calls"] - before["calls"],
+        "prompt_tokens": after["prompt_tokens"] - before["prompt_tokens"],
+        "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+    }
+
+
+def load_shelves(paths, synthetic, main):
+    if synthetic:
+        for seed in range(synthetic):
+            pil_image, detections = make_shelf(seed)
+            classifications = {i: ("fresh", 0.95) for i, det in enumerate(detections) if det["class_id"] == 0}
+            yield f"synthetic shelf {seed}", pil_image, detections, classifications
+        return
+    for path in paths:
+        pil_image = Image.open(path).convert('RGB')
+        yield path, pil_image, main.detect_objects(pil_image), None
+
+
+async def run(paths, synthetic, repeat):
+    # Imported here so OPENAI_BASE_URL is set before the client is created
+    import llm_client
+    import main
+
+    samples = {mode: [] for mode in MODES}
+    if not synthetic:
+        await main.load_models()
+    for name, pil_image, detections, classifications in load_shelves(paths, synthetic, main):
+        print(f"{name}: {len(detections)} detections")
+        for _ in range(repeat):
+            for mode in MODES:
+                samples[mode].append(await run_once(llm_client, main, pil_image, detections, mode, classifications))
+    await llm_client.close_client()
+
+    print(f"{'mode':<10}{'p50 s':>10}{'max s':>10}{'calls/img':>12}{'prompt tok/img':>16}{'compl tok/img':>16}")
+    for mode in MODES:
+        rows = samples[mode]
+        seconds = [r["seconds"] for r in rows]
+        print(
+            f"{mode:<10}"
+            f"{statistics.median(seconds):>10.2f}"
+            f"{max(seconds):>10.2f}"
+            f"{statistics.mean(r['calls'] for r in rows):>12.1f}"
+            f"{statistics.mean(r['prompt_tokens'] for r in rows):>16.0f}"
+            f"{statistics.mean(r['completion_tokens'] for r in rows):>16.0f}"
+        )
+
+
+async def wait_for_fake_openai(url):
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as client:
+        await wait_until_ready(client, url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="*", help="Shelf images to analyze")
+    parser.add_argument("--synthetic", type=int, default=0, help="Analyze this many synthetic shelves instead")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per image and mode")
+    parser.add_argument("--fake-openai", action="store_true", help="Start and use benchmarks/fake_openai.py")
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=200)
+    parser.add_argument("--openai-port", type=int, default=8100)
+    args = parser.parse_args()
+    if bool(args.images) == bool(args.synthetic):
+        parser.error("pass either shelf images or --synthetic")
+
+    server = None
+    if args.fake_openai:
+        openai_url = f"http://127.0.0.1:{args.openai_port}"
+        os.environ.update(OPENAI_API_KEY="sk-local-benchmark", OPENAI_BASE_URL=f"{openai_url}/v1")
+        server = start_process([
+            sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"),
+            "--port", str(args.openai_port),
+            "--latency-ms", str(args.latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+        ], os.environ)
+        asyncio.run(wait_for_fake_openai(f"{openai_url}/stats"))
+    try:
+        asyncio.run(run(args.images, args.synthetic, args.repeat))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,145 @@
+"""
+Microbenchmark of the crop pipeline between detection and the LLM call.
+
+"before" replays the original chain per box: one `.cpu().numpy()` per box,
+PIL crop, JPEG encode, base64 data URL, base64 decode, `Image.open`,
+`convert('RGB')` and a batch-of-one classification. "after" pulls all boxes
+in one transfer, clips them with NumPy, takes crops as views of the frame,
+classifies all perishable crops in one batch and JPEG-encodes each crop once.
+
+Each variant runs in a fresh process so peak RSS is comparable. Uses the
+real classifier weights when present, otherwise a randomly initialized
+MobileNetV2 of the same shape (timings are identical).
+
+Usage:
+    python benchmarks/crop_pipeline.py [--width 4000] [--height 3000] [--boxes 20] [--repeat 5]
+"""
+import argparse
+import base64
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_inputs(width, height, n_boxes, seed=0):
+    import numpy as np
+    import torch
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    # Smooth gradients plus noise compress like a photo rather than like pure noise
+    yy, xx = np.mgrid[0:height, 0:width]
+    frame = np.stack([(xx * 255 // width), (yy * 255 // height), ((xx + yy) * 127 // (width + height))], axis=-1)
+    frame = (frame + rng.integers(0, 32, frame.shape)).clip(0, 255).astype(np.uint8)
+    pil_image = Image.fromarray(frame)
+
+    x1 = rng.integers(0, width - 200, n_boxes)
+    y1 = rng.integers(0, height - 200, n_boxes)
+    x2 = np.minimum(x1 + rng.integers(100, 800, n_boxes), width)
+    y2 = np.minimum(y1 + rng.integers(100, 800, n_boxes), height)
+    xyxy = torch.tensor(np.stack([x1, y1, x2, y2], axis=1), dtype=torch.float32)
+    class_ids = torch.tensor(rng.integers(0, 2, n_boxes), dtype=torch.float32)
+    return pil_image, xyxy, class_ids
+
+
+def load_classifier():
+    import torch.nn as nn
+    from torchvision import models
+
+    import freshness_classifier
+
+    try:
+        return freshness_classifier.get_classifier_model()
+    except FileNotFoundError:
+        model = models.mobilenet_v2()
+        model.classifier[1] = nn.Linear(model.classifier[1].in_features, 2)
+        return model.to(freshness_classifier.device).eval()
+
+
+def before(pil_image, xyxy, class_ids, model):
+    import freshness_classifier
+    import utils
+    from PIL import Image
+
+    for i in range(len(xyxy)):
+        x1, y1, x2, y2 = xyxy[i:i + 1][0].cpu().numpy()
+        class_id = int(class_ids[i])
+        x, y, w, h = int(x1), int(y1), int(x2 - x1), int(y2 - y1)
+        cropped_image = pil_image.crop((x, y, x + w, y + h))
+        buffered = io.BytesIO()
+        cropped_image.save(buffered, format="JPEG")
+        base64_url = utils.image_to_base64_url_bytes(buffered.getvalue(), f"{i}.jpg")
+        if class_id == 0:
+            _, encoded = base64_url.split(',', 1)
+            image = Image.open(io.BytesIO(base64.b64decode(encoded))).convert('RGB')
+            freshness_classifier.classify_image(image, model, freshness_classifier.device, threshold=0.9)
+
+
+def after(pil_image, xyxy, class_ids, model):
+    import numpy as np
+
+    import freshness_classifier
+    import utils
+
+    boxes = xyxy.cpu().numpy()
+    classes = class_ids.cpu().numpy().astype(int)
+    width, height = pil_image.size
+    boxes = np.clip(boxes, 0, [width, height, width, height])
+    bboxes = np.column_stack([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]]).astype(int)
+    detections = [{"bbox": bbox.tolist(), "class_id": int(c)} for bbox, c in zip(bboxes, classes)]
+
+    frame = np.asarray(pil_image)
+    crops = utils.crop_detections(frame, detections)
+    perishable = [crop for crop, det in zip(crops, detections) if det["class_id"] == 0]
+    freshness_classifier.classify_images(perishable, model, freshness_classifier.device, threshold=0.9)
+    for i, crop in enumerate(crops, start=1):
+        utils.encode_image_for_llm(crop, f"{i}.jpg", max_side=None, quality=75)
+
+
+def measure(variant, width, height, n_boxes, repeat, queue):
+    import torch
+
+    torch.set_num_threads(1)
+    model = load_classifier()
+    inputs = make_inputs(width, height, n_boxes)
+    fn = before if variant == "before" else after
+    fn(*inputs, model)  # warmup: kernel selection, lazy imports
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn(*inputs, model)
+        cpu_times.append(time.process_time() - start)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((min(cpu_times), sum(cpu_times) / len(cpu_times), peak_rss, peak_rss - baseline_rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--boxes", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{args.width}x{args.height} frame, {args.boxes} boxes, {args.repeat} runs, 1 torch thread")
+    print(f"{'variant':<10}{'min cpu ms':>12}{'mean cpu ms':>13}{'peak RSS MiB':>14}{'growth MiB':>12}")
+    for variant in ("before", "after"):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=measure, args=(variant, args.width, args.height, args.boxes, args.repeat, queue))
+        proc.start()
+        cpu_min, cpu_mean, peak_rss, growth = queue.get()
+        proc.join()
+        # ru_maxrss is reported in KiB on Linux
+        print(f"{variant:<10}{cpu_min * 1000:>12.1f}{cpu_mean * 1000:>13.1f}{peak_rss / 1024:>14.1f}{growth / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Decode time and peak RSS of the upload decode path, per photo size.
+
+"full" is the original path: decode the whole upload at native resolution
+and take crops as views of that frame. "reduced" decodes the JPEG near the
+detector's working size (DETECTION_DECODE_SIDE) via draft mode, then
+decodes the crops at just the resolution they are sent to the LLM at.
+The detector itself is not run, only ultralytics' input conversion and
+640px letterbox resize of the frame it is given. Boxes are synthetic,
+either "shelf" sized (3-8% of the width, typical of a whole-shelf photo)
+or "closeup" sized (20-40% of the width).
+
+Each (size, variant) runs in a fresh process so peak RSS is comparable.
+
+Usage:
+    python benchmarks/decode_path.py [--sizes 4000x3000 6000x4000 8000x6000] [--boxes 20] [--repeat 3]
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BOX_FRACTIONS = {"shelf": (0.03, 0.08), "closeup": (0.2, 0.4)}
+
+
+def make_jpeg(width, height, seed=0):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    # Smooth gradients plus noise compress like a photo rather than like pure noise
+    yy, xx = np.mgrid[0:height, 0:width]
+    frame = np.stack([(xx * 255 // width), (yy * 255 // height), ((xx + yy) * 127 // (width + height))], axis=-1)
+    frame = (frame + rng.integers(0, 32, frame.shape)).clip(0, 255).astype(np.uint8)
+    buffered = io.BytesIO()
+    Image.fromarray(frame).save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+def make_detections(width, height, n_boxes, box_kind, seed=0):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    low, high = BOX_FRACTIONS[box_kind]
+    sides = (rng.uniform(low, high, n_boxes) * width).astype(int)
+    x1 = rng.integers(0, width - sides)
+    y1 = rng.integers(0, height - np.minimum(sides, height - 1))
+    return [
+        {"bbox": [int(x), int(y), int(s), int(min(s, height - y))], "class_id": int(c)}
+        for x, y, s, c in zip(x1, y1, sides, rng.integers(0, 2, n_boxes))
+    ]
+
+
+def detector_input(pil_image, imgsz=640):
+    # What ultralytics does with a PIL source: RGB->BGR array, then a letterbox resize
+    import cv2
+    import numpy as np
+
+    frame = np.ascontiguousarray(np.asarray(pil_image)[..., ::-1])
+    scale = imgsz / max(frame.shape[:2])
+    return cv2.resize(frame, (round(frame.shape[1] * scale), round(frame.shape[0] * scale)), interpolation=cv2.INTER_LINEAR)
+
+
+def full(image_data, detections):
+    import numpy as np
+    from PIL import Image
+
+    import utils
+
+    pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
+    detector_input(pil_image)
+    # The frame stays referenced by the crops until the request finishes
+    return pil_image, utils.crop_detections(np.asarray(pil_image), detections)
+
+
+def reduced(image_data, detections):
+    import main
+    import utils
+
+    pil_image, full_size = utils.decode_for_detection(image_data, main.DETECTION_DECODE_SIDE)
+    detector_input(pil_image)
+    scaled = utils.scale_detections(detections, full_size, pil_image.size)
+    # What the detector would return, mapped back to full-resolution coordinates
+    detections = utils.scale_detections(scaled, pil_image.size, full_size)
+    max_sides = [main.crop_decode_side(det["class_id"]) for det in detections]
+    return utils.decode_crops(image_data, detections, max_sides, pil_image)
+
+
+def peak_rss():
+    # VmHWM rather than ru_maxrss, which a spawned child inherits from its parent
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+
+
+def measure(variant, image_data, detections, repeat, queue):
+    import psutil
+
+    process = psutil.Process()
+    fn = full if variant == "full" else reduced
+    fn(make_jpeg(64, 48), [])  # warmup on a tiny image: lazy imports without raising the peak
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # reset VmHWM to the current RSS
+    baseline_rss = peak_rss()
+
+    times, held = [], 0
+    for _ in range(repeat):
+        rss_before = process.memory_info().rss
+        start = time.perf_counter()
+        result = fn(image_data, detections)
+        times.append(time.perf_counter() - start)
+        # What stays alive for the rest of the request, while the LLM calls run
+        held = max(held, process.memory_info().rss - rss_before)
+        del result
+    queue.put((min(times), peak_rss() - baseline_rss, held))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["4000x3000", "6000x4000", "8000x6000"])
+    parser.add_argument("--boxes", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{args.boxes} boxes, {args.repeat} runs, min wall time")
+    print("peak: RSS growth while decoding; held: memory still referenced when the LLM calls start")
+    print(f"{'size':<12}{'boxes':<9}{'variant':<9}{'decode ms':>11}{'peak MiB':>10}{'held MiB':>10}")
+    for size in args.sizes:
+        width, height = (int(v) for v in size.split("x"))
+        # Generated here: building the test frame would dominate the workers' peak RSS
+        image_data = make_jpeg(width, height)
+        for box_kind in BOX_FRACTIONS:
+            detections = make_detections(width, height, args.boxes, box_kind)
+            results = {}
+            for variant in ("full", "reduced"):
+                queue = ctx.Queue()
+                proc = ctx.Process(target=measure, args=(variant, image_data, detections, args.repeat, queue))
+                proc.start()
+                results[variant] = queue.get()
+                proc.join()
+            for variant, (seconds, peak, held) in results.items():
+                print(f"{size:<12}{box_kind:<9}{variant:<9}{seconds * 1000:>11.1f}{peak / 2**20:>10.1f}{held / 2**20:>10.1f}")
+            (full_s, full_peak, full_held), (red_s, red_peak, red_held) = results["full"], results["reduced"]
+            print(
+                f"{'':<21}{'saved':<9}{(full_s - red_s) * 1000:>11.1f}"
+                f"{(full_peak - red_peak) / 2**20:>10.1f}{(full_held - red_held) / 2**20:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
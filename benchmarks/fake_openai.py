@@ -0,0 +1,173 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Answers `POST /v1/chat/completions` with a structured output that validates
+against the request's `response_format` JSON schema (ProductAnalysis,
+FreshnessAnalysis, ShelfAnalysis, ...), after a configurable latency and
+with a configurable share of 429/500 errors. Point the app at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+--slow-rate is the share of calls that take --slow-ms instead, to give
+the latency distribution a tail (what hedged calls are for).
+
+--unnamed-rate is the share of crops treated as packaged goods the
+detector called fresh produce: FreshnessAnalysis answers for them have no
+product_name, PerishableAnalysis answers have `packaged` set.
+
+Usage:
+    python benchmarks/fake_openai.py [--port 8100] [--latency-ms 800] [--jitter-ms 200] [--error-rate 0.0] [--unnamed-rate 0.0]
+        [--slow-rate 0.0] [--slow-ms 10000]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCY_MS = float(os.getenv("FAKE_OPENAI_LATENCY_MS", "800"))
+JITTER_MS = float(os.getenv("FAKE_OPENAI_JITTER_MS", "200"))
+ERROR_RATE = float(os.getenv("FAKE_OPENAI_ERROR_RATE", "0"))
+UNNAMED_RATE = float(os.getenv("FAKE_OPENAI_UNNAMED_RATE", "0"))
+SLOW_RATE = float(os.getenv("FAKE_OPENAI_SLOW_RATE", "0"))
+SLOW_MS = float(os.getenv("FAKE_OPENAI_SLOW_MS", "10000"))
+
+SAMPLE_STRINGS = {
+    "brand_name": "Acme",
+    "brand_details": "Acme Foods - taste the difference",
+    "pack_size": "500 g",
+    "expiry_date": "12/2026",
+    "mrp": "Rs. 99",
+    "product_name": "Basmati Rice",
+    "category": "grocery staples",
+}
+
+app = FastAPI()
+stats = {"requests": 0, "errors": 0}
+
+
+def sample_value(schema, defs, name=None, n_images=1):
+    """Build a value that validates against a (strict) JSON schema."""
+    if "$ref" in schema:
+        return sample_value(defs[schema["$ref"].split("/")[-1]], defs, name, n_images)
+    if "anyOf" in schema:
+        non_null = [s for s in schema["anyOf"] if s.get("type") != "null"]
+        return sample_value(non_null[0], defs, name, n_images) if non_null else None
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: sample_value(prop, defs, key, n_images) for key, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        # One entry per image, so per-detection lists (ShelfAnalysis.items) line up with the crops
+        items = [sample_value(schema["items"], defs, name, n_images) for _ in range(n_images)]
+        for i, item in enumerate(items):
+            if isinstance(item, dict) and "index" in item:
+                item["index"] = i
+        return items
+    if kind == "integer":
+        return random.randint(1, 10) if name != "index" else 0
+    if kind == "number":
+        return round(random.random(), 3)
+    if kind == "boolean":
+        return False
+    if kind == "string":
+        return SAMPLE_STRINGS.get(name, "sample")
+    return None
+
+
+def image_details(messages):
+    details = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            details.extend(part["image_url"].get("detail", "auto") for part in content if part.get("type") == "image_url")
+    return details
+
+
+def simulate_packaged(answer, schema):
+    # What the model does with a packaged item it was told is fresh produce
+    properties = schema.get("properties", {})
+    if not isinstance(answer, dict) or random.random() >= UNNAMED_RATE:
+        return answer
+    if "packaged" in properties:
+        answer["packaged"] = True
+    elif "estimated_shelf_life_days" in properties:
+        answer["product_name"] = None
+    return answer
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    latency = max(0.0, random.gauss(LATENCY_MS, JITTER_MS)) / 1000
+    if random.random() < SLOW_RATE:
+        latency = SLOW_MS / 1000
+    await asyncio.sleep(latency)
+
+    if random.random() < ERROR_RATE:
+        stats["errors"] += 1
+        if random.random() < 0.5:
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after": "1"},
+                content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            )
+        return JSONResponse(status_code=500, content={"error": {"message": "Internal error", "type": "server_error"}})
+
+    details = image_details(body.get("messages", []))
+    n_images = len(details)
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        answer = sample_value(schema, schema.get("$defs", {}), n_images=n_images)
+        content = json.dumps(simulate_packaged(answer, schema))
+    else:
+        content = "A grocery product."
+
+    # Rough usage: a low-detail image costs 85 tokens, a high-detail crop about 765
+    # (four 512px tiles), the prompt about 150
+    prompt_tokens = 150 + sum(85 if detail == "low" else 765 for detail in details)
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-2024-08-06"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "logprobs": None,
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=JITTER_MS)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    parser.add_argument("--unnamed-rate", type=float, default=UNNAMED_RATE)
+    parser.add_argument("--slow-rate", type=float, default=SLOW_RATE)
+    parser.add_argument("--slow-ms", type=float, default=SLOW_MS)
+    args = parser.parse_args()
+    LATENCY_MS, JITTER_MS, ERROR_RATE = args.latency_ms, args.jitter_ms, args.error_rate
+    UNNAMED_RATE, SLOW_RATE, SLOW_MS = args.unnamed_rate, args.slow_rate, args.slow_ms
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,157 @@
+"""
+Offline end-to-end load test for /analyze_group/ and /multi_image_ocr/.
+
+Starts the fake OpenAI server and the app (with a SQLite stand-in for
+MySQL, and the analysis cache and request coalescing disabled, since the
+same few images are posted over and over), waits for /readyz, then drives each
+endpoint with synthetic shelf images at several concurrency levels and
+reports requests/s and p50/p95/p99 latency. Needs the model weights in
+ml_models/ but no network access.
+
+Usage:
+    python benchmarks/load_test.py [--concurrency 1 4 16] [--requests 32] [--latency-ms 800] [--error-rate 0]
+    python benchmarks/load_test.py --app-url http://127.0.0.1:8000   # against an already running app
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from shelf_images import make_shelf_data_urls  # noqa: E402
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * q
+    lower, upper = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+async def wait_until_ready(client, url, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+async def run_level(client, url, payloads, concurrency, n_requests):
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(n_requests):
+        queue.put_nowait(payloads[i % len(payloads)])
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            payload = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "rps": n_requests / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "mean": statistics.mean(latencies),
+        "errors": errors,
+    }
+
+
+async def run(app_url, concurrency_levels, n_requests, n_images):
+    shelves = make_shelf_data_urls(n_images)
+    rng = random.Random(0)
+    endpoints = {
+        "/analyze_group/": [{"image": image} for image in shelves],
+        "/multi_image_ocr/": [{"images": rng.sample(shelves, min(3, len(shelves)))} for _ in shelves],
+    }
+    async with httpx.AsyncClient(timeout=httpx.Timeout(300.0)) as client:
+        await wait_until_ready(client, f"{app_url}/readyz")
+        print(f"{'endpoint':<20}{'conc':>6}{'req/s':>9}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'errors':>8}")
+        for path, payloads in endpoints.items():
+            for concurrency in concurrency_levels:
+                r = await run_level(client, f"{app_url}{path}", payloads, concurrency, n_requests)
+                print(f"{path:<20}{concurrency:>6}{r['rps']:>9.2f}{r['p50']:>9.2f}{r['p95']:>9.2f}{r['p99']:>9.2f}{r['errors']:>8}")
+
+
+def start_process(args, env):
+    return subprocess.Popen(args, cwd=REPO_DIR, env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="Requests per endpoint and concurrency level")
+    parser.add_argument("--images", type=int, default=8, help="Distinct synthetic shelf images")
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--app-port", type=int, default=8000)
+    parser.add_argument("--openai-port", type=int, default=8100)
+    parser.add_argument("--app-url", help="Use an already running app instead of starting one")
+    args = parser.parse_args()
+
+    if args.app_url:
+        asyncio.run(run(args.app_url, args.concurrency, args.requests, args.images))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="image-app-bench-")
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="sk-local-benchmark",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{args.openai_port}/v1",
+        DB_BACKEND="sqlite",
+        DB_SQLITE_PATH=os.path.join(workdir, "product_analysis.db"),
+        LLM_CACHE_ENABLED="0",
+        SINGLE_FLIGHT_ENABLED="0",
+    )
+    processes = [
+        start_process([
+            sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"),
+            "--port", str(args.openai_port),
+            "--latency-ms", str(args.latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+            "--error-rate", str(args.error_rate),
+        ], env),
+        start_process([
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(args.app_port), "--log-level", "warning",
+        ], env),
+    ]
+    try:
+        asyncio.run(run(f"http://127.0.0.1:{args.app_port}", args.concurrency, args.requests, args.images))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
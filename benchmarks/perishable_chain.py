@@ -0,0 +1,146 @@
+"""
+Compare the ways a crop the detector calls fresh produce can be analyzed.
+
+"sequential" is the original chain: a FreshnessAnalysis call, then a
+ProductAnalysis (label OCR) call on the packaged-goods encoding whenever
+the first comes back without a product name. "speculative" issues both at
+once and cancels the OCR call when the freshness call names the product.
+"combined" sends one PerishableAnalysis call, at packaged-goods size and
+detail, that also reads the label.
+
+Runs against the fake OpenAI server, once per --unnamed-rate (the share of
+crops that are really packaged goods), and reports per-crop latency, calls
+sent (including cancelled ones), calls completed and tokens per crop.
+The classifier is not run; every crop gets the same classification.
+
+Usage:
+    python benchmarks/perishable_chain.py [--crops 64] [--concurrency 8] [--unnamed-rate 0 0.2 0.5] [--latency-ms 800]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from load_test import percentile, start_process, wait_until_ready  # noqa: E402
+from shelf_images import FRUIT_COLORS  # noqa: E402
+
+MODES = ["sequential", "speculative", "combined"]
+
+
+def make_produce_crop(seed: int, size: int = 384) -> np.ndarray:
+    rng = random.Random(seed)
+    image = Image.new('RGB', (size, size), (225, 220, 210))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(1, 4)):
+        r = rng.randint(size // 8, size // 4)
+        x, y = rng.randint(r, size - r), rng.randint(r, size - r)
+        draw.ellipse([x - r, y - r, x + r, y + r], fill=rng.choice(FRUIT_COLORS), outline=(40, 40, 40), width=2)
+    return np.asarray(image)
+
+
+async def run_mode(main, llm_client, client, openai_url, crops, mode, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+    latencies, unnamed = [], 0
+
+    async def one(index, crop):
+        nonlocal unnamed
+        async with slots:
+            filename = f"{index}.jpg"
+            encoded = main.encode_crop(crop, filename, 0)
+            start = time.perf_counter()
+            analysis, _ = await main.analyze_perishable_crop(
+                llm_client.get_client(), crop, filename, encoded, ("fresh", 0.05), mode=mode
+            )
+            latencies.append(time.perf_counter() - start)
+            unnamed += "state" not in analysis
+
+    before = dict(llm_client.usage_totals)
+    sent_before = (await client.get(f"{openai_url}/stats")).json()["requests"]
+    await asyncio.gather(*[one(i, crop) for i, crop in enumerate(crops)])
+    # Let cancelled calls still in transit reach the server before counting
+    await asyncio.sleep(0.1)
+    sent = (await client.get(f"{openai_url}/stats")).json()["requests"] - sent_before
+    after = llm_client.usage_totals
+    n = len(crops)
+    return {
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "mean": statistics.mean(latencies),
+        "sent": sent / n,
+        "completed": (after["calls"] - before["calls"]) / n,
+        "prompt_tokens": (after["prompt_tokens"] - before["prompt_tokens"]) / n,
+        "completion_tokens": (after["completion_tokens"] - before["completion_tokens"]) / n,
+        "packaged": unnamed / n,
+    }
+
+
+async def run(args, openai_url):
+    # Imported here so OPENAI_BASE_URL is set before the client is created
+    import llm_client
+    import main
+
+    crops = [make_produce_crop(seed) for seed in range(args.crops)]
+    print(f"{args.crops} crops, concurrency {args.concurrency}, {args.latency_ms:.0f}ms simulated API latency")
+    print(
+        f"{'unnamed':<9}{'mode':<13}{'p50 s':>8}{'p95 s':>8}{'mean s':>8}{'sent':>7}{'done':>7}"
+        f"{'prompt tok':>12}{'compl tok':>11}{'packaged':>10}"
+    )
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as client:
+        for rate in args.unnamed_rate:
+            # One server per rate; the app side (client, concurrency limit) stays on this loop
+            server = start_process([
+                sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"),
+                "--port", str(args.openai_port),
+                "--latency-ms", str(args.latency_ms),
+                "--jitter-ms", str(args.jitter_ms),
+                "--unnamed-rate", str(rate),
+            ], os.environ)
+            try:
+                await wait_until_ready(client, f"{openai_url}/stats")
+                for mode in MODES:
+                    r = await run_mode(main, llm_client, client, openai_url, crops, mode, args.concurrency)
+                    print(
+                        f"{rate:<9.2f}{mode:<13}{r['p50']:>8.2f}{r['p95']:>8.2f}{r['mean']:>8.2f}{r['sent']:>7.2f}"
+                        f"{r['completed']:>7.2f}{r['prompt_tokens']:>12.0f}{r['completion_tokens']:>11.0f}"
+                        f"{r['packaged']:>10.2f}"
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+                # Connections to the stopped server can't be reused
+                await llm_client.close_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--crops", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--unnamed-rate", type=float, nargs="+", default=[0.0, 0.2, 0.5])
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=200)
+    parser.add_argument("--openai-port", type=int, default=8100)
+    args = parser.parse_args()
+
+    openai_url = f"http://127.0.0.1:{args.openai_port}"
+    os.environ.update(
+        OPENAI_API_KEY="sk-local-benchmark",
+        OPENAI_BASE_URL=f"{openai_url}/v1",
+        LLM_CACHE_ENABLED="0",
+    )
+    asyncio.run(run(args, openai_url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Size and serialization time of an /analyze_group/ response, per crop mode.
+
+Builds the results of one synthetic shelf photo (crops encoded exactly as
+for the LLM, with typical analysis fields) and renders them the way the
+endpoint does: "inline (json)" is the original response (data URLs, the
+standard JSONResponse encoder), the other rows go through ORJSONResponse
+with the crops inline, as /crops/ links or left out ("none", bbox only).
+Serialization time for "url" includes storing the crops.
+
+Usage:
+    python benchmarks/response_payload.py [--detections 20] [--width 1920] [--height 1440] [--repeat 50]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from shelf_images import make_shelf_image  # noqa: E402
+
+
+def make_results(main, detections, width, height, seed=0):
+    rng = random.Random(seed)
+    frame = np.asarray(make_shelf_image(seed, width, height))
+    results = []
+    for index in range(1, detections + 1):
+        class_id = rng.randint(0, 1)
+        w, h = rng.randint(width // 16, width // 6), rng.randint(height // 8, height // 3)
+        x, y = rng.randint(0, width - w), rng.randint(0, height - h)
+        encoded = main.encode_crop(frame[y:y + h, x:x + w], f"{index}.jpg", class_id)
+        analysis = {
+            "brand_name": f"Brand {index}", "brand_details": "Logo with a red tagline", "pack_size": "500 g",
+            "expiry_date": "03/2026", "mrp": "Rs. 120", "product_name": f"Product {index}",
+            "item_count": "2", "category": "household items",
+        }
+        if class_id == 0:
+            analysis = {"product_name": f"Produce {index}", "state": "fresh", "estimated_shelf_life_days": 5}
+        results.append({
+            "bbox": [x, y, w, h],
+            "base64_image": encoded["url"],
+            "encoded_bytes": encoded["encoded_bytes"],
+            "estimated_image_tokens": encoded["estimated_image_tokens"],
+            **analysis,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--detections", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1440)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    from fastapi.responses import JSONResponse, ORJSONResponse
+    import main as app_main
+
+    results = make_results(app_main, args.detections, args.width, args.height)
+    variants = {
+        "inline (json)": lambda: JSONResponse(content=results),
+        "inline": lambda: ORJSONResponse(content=[app_main.present_crop(r, "inline") for r in results]),
+        "url": lambda: ORJSONResponse(content=[app_main.present_crop(r, "url") for r in results]),
+        "none": lambda: ORJSONResponse(content=[app_main.present_crop(r, "none") for r in results]),
+    }
+    print(f"{args.detections} detections on a {args.width}x{args.height} photo, {args.repeat} runs")
+    print(f"{'mode':<16}{'bytes':>12}{'p50 ms':>10}{'mean ms':>10}")
+    for name, render in variants.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            body = render().body
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{name:<16}{len(body):>12}{statistics.median(timings):>10.2f}{statistics.mean(timings):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Synthetic shelf photos for offline benchmarks.
+
+Each image is a shelf with rows of packaged products (labelled boxes) and
+loose produce (round fruit), drawn deterministically from a seed so runs
+are comparable.
+
+Usage:
+    python benchmarks/shelf_images.py out_dir [--count 8] [--width 1920] [--height 1440]
+"""
+import argparse
+import base64
+import io
+import os
+import random
+from typing import Dict, List, Tuple
+
+from PIL import Image, ImageDraw
+
+PRODUCT_COLORS = [(200, 40, 40), (40, 120, 200), (240, 200, 40), (60, 160, 80), (140, 60, 160)]
+FRUIT_COLORS = [(210, 30, 30), (250, 200, 20), (120, 180, 40), (240, 140, 20), (110, 60, 30)]
+
+
+def make_shelf_image(seed: int, width: int = 1920, height: int = 1440) -> Image.Image:
+    return make_shelf(seed, width, height)[0]
+
+
+def make_shelf(seed: int, width: int = 1920, height: int = 1440) -> Tuple[Image.Image, List[Dict]]:
+    """A shelf image and the detections a perfect detector would return for it (class 0 produce, 1 packaged)."""
+    rng = random.Random(seed)
+    detections = []
+    image = Image.new('RGB', (width, height), (225, 220, 210))
+    draw = ImageDraw.Draw(image)
+    rows = 3
+    row_height = height // rows
+    for row in range(rows):
+        top = row * row_height
+        # Shelf board
+        draw.rectangle([0, top + row_height - 20, width, top + row_height], fill=(120, 90, 60))
+        x = rng.randint(10, 60)
+        while x < width - 120:
+            if rng.random() < 0.6:
+                w = rng.randint(120, 260)
+                h = rng.randint(row_height // 2, row_height - 40)
+                y = top + row_height - 20 - h
+                draw.rectangle([x, y, x + w, y + h], fill=rng.choice(PRODUCT_COLORS), outline=(20, 20, 20), width=3)
+                draw.rectangle([x + 10, y + h // 3, x + w - 10, y + h // 2], fill=(250, 250, 250))
+                draw.text((x + 16, y + h // 3 + 8), f"BRAND {rng.randint(1, 99)}", fill=(0, 0, 0))
+                draw.text((x + 16, y + h // 3 + 24), f"MRP Rs.{rng.randint(10, 500)}", fill=(0, 0, 0))
+                draw.text((x + 16, y + h // 3 + 40), f"EXP {rng.randint(1, 12):02d}/2026", fill=(0, 0, 0))
+                detections.append({"bbox": [x, y, w, h], "class_id": 1, "class_name": "packaged", "confidence": 1.0})
+            else:
+                w = rng.randint(100, 180)
+                y = top + row_height - 20 - w
+                color = rng.choice(FRUIT_COLORS)
+                draw.ellipse([x, y, x + w, y + w], fill=color, outline=tuple(c // 2 for c in color), width=4)
+                # A few dark spots on some fruit so both classifier outcomes occur
+                for _ in range(rng.randint(0, 4)):
+                    sx, sy = x + rng.randint(w // 5, 3 * w // 5), y + rng.randint(w // 5, 3 * w // 5)
+                    draw.ellipse([sx, sy, sx + w // 8, sy + w // 8], fill=(60, 40, 20))
+                detections.append({"bbox": [x, y, w, w], "class_id": 0, "class_name": "perishable", "confidence": 1.0})
+            x += w + rng.randint(10, 40)
+    return image, detections
+
+
+def to_data_url(image: Image.Image, quality: int = 90) -> str:
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+def make_shelf_data_urls(count: int, width: int = 1920, height: int = 1440, seed: int = 0) -> List[str]:
+    return [to_data_url(make_shelf_image(seed + i, width, height)) for i in range(count)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--count", type=int, default=8)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1440)
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    for i in range(args.count):
+        path = os.path.join(args.out_dir, f"shelf_{i}.jpg")
+        make_shelf_image(i, args.width, args.height).save(path, quality=90)
+        print(path)
@@ -0,0 +1,122 @@
+"""
+Peak memory of ingesting one upload, per body format.
+
+"json (pydantic)" is the original path: the whole JSON body is read, parsed
+into a `SingleImage`, the data URL split and base64-decoded. "json
+(streaming)" sends the same body through `uploads.read_images`, which
+decodes the base64 as it arrives; "binary" posts the JPEG itself as
+application/octet-stream. The body is fed in 64KiB chunks, as uvicorn
+does, and every variant then decodes the image for the detector
+(DETECTION_DECODE_SIDE). Reports the RSS growth (VmHWM) over the request
+and, for the new paths, the peak `uploads` accounts for itself.
+
+Each (size, variant) runs in a fresh process so peak RSS is comparable.
+
+Usage:
+    python benchmarks/upload_memory.py [--sizes 4000x3000 6000x4000 8000x6000]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from decode_path import make_jpeg, peak_rss  # noqa: E402
+
+CHUNK_BYTES = 64 * 1024
+VARIANTS = ["json (pydantic)", "json (streaming)", "binary"]
+
+
+def make_request(body, content_type):
+    from starlette.requests import Request
+
+    chunks = [body[i:i + CHUNK_BYTES] for i in range(0, len(body), CHUNK_BYTES)] or [b""]
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/analyze_group/",
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    }
+    return Request(scope, receive)
+
+
+async def ingest(variant, body):
+    import main
+    import uploads
+    import utils
+
+    if variant == "json (pydantic)":
+        request = make_request(body, "application/json")
+        payload = main.SingleImage(**json.loads(await request.body()))
+        header, encoded = payload.image.split(",", 1)
+        image_data = base64.b64decode(encoded)
+    else:
+        content_type = "application/octet-stream" if variant == "binary" else "application/json"
+        image_data = (await uploads.read_images(make_request(body, content_type), "image"))[0]
+    pil_image, _ = utils.decode_for_detection(image_data, main.DETECTION_DECODE_SIDE)
+    uploads.hold(pil_image.width * pil_image.height * len(pil_image.getbands()))
+    return pil_image
+
+
+def measure(variant, body, small_body, queue):
+    import uploads
+
+    asyncio.run(ingest(variant, small_body))  # warmup: lazy imports without raising the peak
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # reset VmHWM to the current RSS
+    baseline_rss = peak_rss()
+
+    async def run():
+        tracker = uploads.track_memory()
+        start = time.perf_counter()
+        await ingest(variant, body)
+        return time.perf_counter() - start, tracker.peak
+
+    seconds, accounted = asyncio.run(run())
+    queue.put((seconds, peak_rss() - baseline_rss, accounted))
+
+
+def make_body(variant, jpeg):
+    if variant == "binary":
+        return jpeg
+    return json.dumps({"image": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()}).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["4000x3000", "6000x4000", "8000x6000"])
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    small = make_jpeg(64, 48)
+    print(f"{'size':<12}{'JPEG MiB':>9}  {'variant':<18}{'ms':>8}{'peak MiB':>10}{'accounted MiB':>15}")
+    for size in args.sizes:
+        width, height = (int(v) for v in size.split("x"))
+        jpeg = make_jpeg(width, height)
+        for variant in VARIANTS:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=measure, args=(variant, make_body(variant, jpeg), make_body(variant, small), queue))
+            proc.start()
+            seconds, peak, accounted = queue.get()
+            proc.join()
+            accounted = f"{accounted / 2**20:.1f}" if variant != "json (pydantic)" else "-"
+            print(
+                f"{size:<12}{len(jpeg) / 2**20:>9.1f}  {variant:<18}{seconds * 1000:>8.1f}"
+                f"{peak / 2**20:>10.1f}{accounted:>15}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Offline bulk ingestion of archived shelf photos through the /analyze_group/ pipeline.
+
+Usage:
+    python bulk_ingest.py photos/ --output db
+    python bulk_ingest.py --manifest paths.txt --output results.jsonl [--workers 8]
+    python bulk_ingest.py photos/ --output results.parquet --checkpoint photos.ckpt
+
+Decoding, detection, cropping and freshness classification run in a pool
+of worker processes, each with its own copy of the models. The LLM stage
+(process_detections_with_clients with the shared concurrency limit),
+parse_date_or_days and the output run in the parent on one event loop, so
+throughput scales with cores on the CPU side and with the LLM concurrency
+limit on the API side. Its LLM calls run in the scheduler's "bulk" class
+unless --priority says otherwise; give the job its own share of the quota
+with OPENAI_RPM_LIMIT / OPENAI_TPM_LIMIT when the service runs alongside.
+
+Results are written every --flush-every images: to ProductAnalysis for
+`db`, appended to a JSONL file, or as a new part file in a Parquet
+directory. Only after a flush succeeds are its images appended to the
+checkpoint file, and images listed there are skipped on the next run, so
+a crashed run resumes where it left off. A flush that fails is logged and
+its images are left out of the checkpoint, to be retried by the next run,
+while the run goes on. Images of a flush interrupted mid-write may be
+written twice.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+import freshness_classifier
+import inference_backends
+import llm_client
+import llm_scheduler
+import main
+import persistence
+import utils
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def find_images(directory: str) -> List[str]:
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in files if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    return sorted(paths)
+
+
+def read_manifest(path: str) -> List[str]:
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+# --- Worker processes: decode, detect, crop, classify ---
+
+def _init_worker(threads: int) -> None:
+    import torch
+
+    torch.set_num_threads(threads)
+    main.obj_det_model = inference_backends.load_detector()
+    main.classifier_model = inference_backends.load_classifier()
+
+
+def prepare_image(path: str) -> Dict:
+    """Run the CPU half of the pipeline on one image; crops are copied so they pickle small."""
+    start = time.perf_counter()
+    with Image.open(path) as image:
+        pil_image = image.convert('RGB')
+    detections = main.detect_objects(pil_image)
+    crops = [crop.copy() for crop in utils.crop_detections(np.asarray(pil_image), detections)]
+    perishable_indices = [i for i, det in enumerate(detections) if det['class_id'] == 0 and crops[i].size]
+    classifications = {}
+    if perishable_indices:
+        batch_results = freshness_classifier.classify_images(
+            [crops[i] for i in perishable_indices],
+            main.classifier_model,
+            device=freshness_classifier.device,
+            threshold=0.9
+        )
+        classifications = dict(zip(perishable_indices, batch_results))
+    return {
+        "detections": detections,
+        "crops": crops,
+        "classifications": classifications,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# --- Checkpoint and outputs ---
+
+class Checkpoint:
+    """Append-only list of images whose results have been written."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            self.done = set(read_manifest(path))
+
+    def mark(self, paths: Iterable[str]) -> None:
+        paths = list(paths)
+        self.done.update(paths)
+        if not self.path or not paths:
+            return
+        with open(self.path, "a") as f:
+            f.writelines(f"{path}\n" for path in paths)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _scalar(value):
+    # Parquet needs one type per column; nested values (e.g. error entries' detection) go in as JSON
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+
+class JsonlOutput:
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, rows: List[Dict]) -> None:
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self) -> None:
+        pass
+
+
+class ParquetOutput:
+    """Writes each flush as a new part file of a Parquet dataset directory."""
+
+    def __init__(self, path: str):
+        import pyarrow  # noqa: F401  (fail before any image is processed if it is missing)
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, rows: List[Dict]) -> None:
+        import pandas as pd
+
+        if not rows:
+            return
+        frame = pd.DataFrame([{key: _scalar(value) for key, value in row.items()} for row in rows])
+        part = os.path.join(self.path, f"part-{time.time_ns()}.parquet")
+        frame.to_parquet(part + ".tmp", index=False)
+        os.replace(part + ".tmp", part)
+
+    def close(self) -> None:
+        pass
+
+
+class DatabaseOutput:
+    """Inserts each flush into ProductAnalysis with one executemany and commit."""
+
+    def __init__(self):
+        self.writer = persistence.create_writer()
+
+    def write(self, rows: List[Dict]) -> None:
+        self.writer.write_rows(rows)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def create_output(target: str):
+    if target == "db":
+        return DatabaseOutput()
+    if target.endswith(".jsonl"):
+        return JsonlOutput(target)
+    if target.endswith(".parquet"):
+        return ParquetOutput(target)
+    raise ValueError(f"Unsupported output {target!r}: use db, *.jsonl or *.parquet")
+
+
+# --- Driver ---
+
+class BulkIngest:
+    def __init__(self, output, checkpoint: Checkpoint, flush_every: int, keep_images: bool, analysis_mode: str):
+        self.output = output
+        self.checkpoint = checkpoint
+        self.flush_every = flush_every
+        self.keep_images = keep_images
+        self.analysis_mode = analysis_mode
+        self._rows: List[Dict] = []
+        self._sources: List[str] = []
+        self._flush_lock = asyncio.Lock()
+        self.stats = {
+            "images": 0, "failed": 0, "flush_errors": 0, "detections": 0, "rows": 0, "prepare_seconds": 0.0
+        }
+
+    async def process(self, loop, pool, path: str) -> None:
+        try:
+            prepared = await loop.run_in_executor(pool, prepare_image, path)
+            results = await main.process_detections_with_clients(
+                client=llm_client.get_client(),
+                detections=prepared["detections"],
+                pil_image=None,
+                analysis_mode=self.analysis_mode,
+                crops=prepared["crops"],
+                classifications=prepared["classifications"],
+            )
+        except Exception as e:
+            # Not checkpointed, so the next run retries it
+            self.stats["failed"] += 1
+            logging.error(f"Failed to ingest {path}: {e}", exc_info=True)
+            return
+
+        for index, result in enumerate(results):
+            if "expiry_date" in result:
+                result["expiry_date"] = main.parse_date_or_days(result["expiry_date"])
+            if not self.keep_images:
+                result.pop("base64_image", None)
+            self._rows.append({"source": path, "result_index": index, **result})
+        self._sources.append(path)
+        self.stats["images"] += 1
+        self.stats["detections"] += len(prepared["detections"])
+        self.stats["prepare_seconds"] += prepared["seconds"]
+        if len(self._sources) >= self.flush_every:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            rows, sources = self._rows, self._sources
+            self._rows, self._sources = [], []
+            if not sources:
+                return
+            try:
+                await asyncio.to_thread(self.output.write, rows)
+            except Exception as e:
+                # Not checkpointed, so the next run retries these images; the rest go on
+                self.stats["flush_errors"] += 1
+                self.stats["images"] -= len(sources)
+                self.stats["failed"] += len(sources)
+                logging.error(f"Failed to write {len(rows)} rows for {len(sources)} images: {e}", exc_info=True)
+                return
+            self.checkpoint.mark(sources)
+            self.stats["rows"] += len(rows)
+            logging.info(f"Wrote {len(rows)} rows for {len(sources)} images ({len(self.checkpoint.done)} done)")
+
+    async def run(self, paths: List[str], workers: int, threads: int, max_pending: int, priority: str = "bulk") -> None:
+        loop = asyncio.get_running_loop()
+        # Inherited by every task created below
+        llm_scheduler.set_priority(priority)
+        # Spawned workers don't inherit the parent's torch/OpenMP thread pools
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(threads,)) as pool:
+            # Bounds how many prepared images (and their crops) wait for the LLM stage
+            slots = asyncio.Semaphore(max_pending)
+            tasks = set()
+
+            async def bounded(path):
+                try:
+                    await self.process(loop, pool, path)
+                finally:
+                    slots.release()
+
+            for path in paths:
+                await slots.acquire()
+                task = asyncio.create_task(bounded(path))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        await self.flush()
+        await llm_client.close_client()
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", nargs="?", help="Directory to scan recursively for images")
+    parser.add_argument("--manifest", help="Text file with one image path per line (instead of a directory)")
+    parser.add_argument("--output", required=True, help="db, results.jsonl or results.parquet (a directory of part files)")
+    parser.add_argument("--checkpoint", help="File listing finished images (default: <output>.checkpoint)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Decode/inference processes")
+    parser.add_argument("--threads-per-worker", type=int, default=1, help="torch / ONNX Runtime threads per worker")
+    parser.add_argument("--max-pending", type=int, default=0, help="Images in flight at once (default: 4 per worker)")
+    parser.add_argument("--flush-every", type=int, default=50, help="Images per output write and checkpoint")
+    parser.add_argument("--analysis-mode", choices=["per_crop", "shelf"], default=main.LLM_ANALYSIS_MODE)
+    parser.add_argument("--keep-images", action="store_true", help="Keep the base64 crops in JSONL/Parquet rows")
+    parser.add_argument("--priority", choices=list(llm_scheduler.PRIORITIES), default="bulk", help="LLM scheduler class")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if bool(args.directory) == bool(args.manifest):
+        parser.error("pass either a directory or --manifest")
+    paths = find_images(args.directory) if args.directory else read_manifest(args.manifest)
+    checkpoint = Checkpoint(args.checkpoint or f"{'product_analysis' if args.output == 'db' else args.output}.checkpoint")
+    todo = [path for path in paths if path not in checkpoint.done]
+    print(f"{len(paths)} images, {len(paths) - len(todo)} already done, {len(todo)} to ingest")
+    if not todo:
+        return 0
+
+    # Read by inference_backends when the spawned workers import it
+    os.environ.setdefault("ORT_INTRA_OP_THREADS", str(args.threads_per_worker))
+    os.environ.setdefault("OMP_NUM_THREADS", str(args.threads_per_worker))
+    output = create_output(args.output)
+    ingest = BulkIngest(output, checkpoint, args.flush_every, args.keep_images, args.analysis_mode)
+    start = time.perf_counter()
+    try:
+        asyncio.run(ingest.run(
+            todo, args.workers, args.threads_per_worker, args.max_pending or 4 * args.workers, args.priority
+        ))
+    finally:
+        output.close()
+    elapsed = time.perf_counter() - start
+
+    stats = ingest.stats
+    print(
+        f"Ingested {stats['images']} images ({stats['failed']} failed, {stats['flush_errors']} failed writes) "
+        f"with {stats['detections']} detections "
+        f"into {stats['rows']} rows in {elapsed:.1f}s: {stats['images'] / elapsed:.2f} images/s, "
+        f"{stats['prepare_seconds'] / max(stats['images'], 1):.2f}s CPU stage per image"
+    )
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
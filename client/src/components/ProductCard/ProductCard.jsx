@@ -1,14 +1,36 @@
 import React, { useEffect, useState } from 'react';
 
-const ProductCard = ({ product}) =>{
+// Crops the detected region out of the uploaded image, so the server needn't send crops back
+const cropImage = (src, [x, y, width, height]) => new Promise((resolve, reject) => {
+  const image = new Image();
+  image.onload = () => {
+    const canvas = document.createElement('canvas');
+    canvas.width = width;
+    canvas.height = height;
+    canvas.getContext('2d').drawImage(image, x, y, width, height, 0, 0, width, height);
+    resolve(canvas.toDataURL('image/jpeg', 0.8));
+  };
+  image.onerror = () => reject(new Error("Failed to load image"));
+  image.src = src;
+});
+
+const ProductCard = ({ product, sourceImage }) =>{
 
   const [imageSrc, setImageSrc] = useState(null);
 
   useEffect(()=>{
 
-    setImageSrc(product?.base64_image);
-
-  },[product])
+    let cancelled = false;
+    if (product?.base64_image || !product?.bbox || !sourceImage) {
+      setImageSrc(product?.base64_image);
+      return;
+    }
+    cropImage(sourceImage, product.bbox)
+      .then((src) => { if (!cancelled) setImageSrc(src); })
+      .catch(() => { if (!cancelled) setImageSrc(null); });
+    return () => { cancelled = true; };
+
+  },[product, sourceImage])
 
 
   return (
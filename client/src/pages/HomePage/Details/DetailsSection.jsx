@@ -24,18 +24,18 @@ const DetailsSection = () => {
       );
       setImagePreviews(base64Images); 
     
-      sendImagesToBackend(base64Images);
+      sendImagesToBackend(files);
     };
     
-    const sendImagesToBackend = async (base64Images) => {
+    const sendImagesToBackend = async (files) => {
       try {
         setLoading(true)
+        // Multipart file uploads; the browser sets the Content-Type with its boundary
+        const formData = new FormData();
+        files.forEach((file) => formData.append("images", file));
         const response = await fetch(BASE_URL+"/multi_image_ocr/", {
           method: "POST",
-          headers: {
-            "Content-Type": "application/json",
-          },
-          body: JSON.stringify({ images: base64Images }),
+          body: formData,
         });
     
         if (!response.ok) {
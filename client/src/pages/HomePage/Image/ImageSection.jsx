@@ -25,18 +25,19 @@ const ImageSection = () => {
       );
       setImagePreviews(base64Images); 
     
-      sendImagesToBackend(base64Images);
+      sendImagesToBackend(files);
     };
     
-    const sendImagesToBackend = async (base64Images) => {
+    const sendImagesToBackend = async (files) => {
       try {
         setLoading(true)
-        const response = await fetch(BASE_URL+"/analyze_group/", {
+        const response = await fetch(BASE_URL+"/analyze_group/?crops=none", {
           method: "POST",
+          // The file itself rather than a base64 data URL in JSON
           headers: {
-            "Content-Type": "application/json",
+            "Content-Type": files[0].type || "application/octet-stream",
           },
-          body: JSON.stringify({ image: base64Images[0] }),
+          body: files[0],
         });
     
         if (!response.ok) {
@@ -69,7 +70,7 @@ const ImageSection = () => {
                     {productData.map((product,index)=>(
                       <div className='w-full cursor-pointer border-b' onClick={()=>setShow(index)} key={index}>
                       
-                      <ProductCard  product={product} />
+                      <ProductCard  product={product} sourceImage={imagePreviews?.[0]} />
                       {show===index && (
                           <table className=' mx-auto gap-2 m-5 w-[80%]  '>
                               <thead>
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# How long a crop stays fetchable from /crops/{id} after the response that referenced it
+CROP_STORE_TTL_SECONDS = float(os.getenv("CROP_STORE_TTL_SECONDS", "300"))
+# Upper bound on the encoded crops held in memory; the least recently used go first
+CROP_STORE_MAX_BYTES = int(os.getenv("CROP_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class CropStore:
+    """
+    Short-lived, in-memory store of encoded crops, served by /crops/{id}.
+
+    Ids are content hashes, so a crop never changes under its id and clients
+    and proxies may cache it for as long as they like. The store is per
+    process: with several workers, a crop is only found on the worker that
+    produced it, so route /crops/ with session affinity or use the "none"
+    response mode.
+    """
+
+    def __init__(self, ttl_seconds: float = CROP_STORE_TTL_SECONDS, max_bytes: int = CROP_STORE_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, data: bytes) -> str:
+        crop_id = hashlib.sha256(data).hexdigest()[:32]
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            entry = self._entries.pop(crop_id, None)
+            if entry is not None:
+                self._size -= len(entry[0])
+            self._entries[crop_id] = (data, expires_at)
+            self._size += len(data)
+            self._evict(time.monotonic())
+        return crop_id
+
+    def get(self, crop_id: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(crop_id)
+            if entry is None or entry[1] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(crop_id)
+            self.hits += 1
+            return entry[0]
+
+    def _evict(self, now: float) -> None:
+        # Entries are in least-recently-used order; expired ones are dropped as they reach the front
+        while self._entries:
+            crop_id, (data, expires_at) = next(iter(self._entries.items()))
+            if self._size <= self.max_bytes and expires_at > now:
+                break
+            del self._entries[crop_id]
+            self._size -= len(data)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
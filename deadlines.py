@@ -0,0 +1,68 @@
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Latency budget of a request that doesn't set one (0: no deadline)
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "0"))
+# Upper bound on a budget asked for by a client
+REQUEST_TIMEOUT_MAX_SECONDS = float(os.getenv("REQUEST_TIMEOUT_MAX_SECONDS", "300"))
+# Kept back from the budget for persisting and serializing the (partial) results
+REQUEST_DEADLINE_RESERVE_SECONDS = float(os.getenv("REQUEST_DEADLINE_RESERVE_SECONDS", "0.1"))
+
+# time.monotonic() by which the current request's analysis has to finish
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+_budget: ContextVar[Optional[float]] = ContextVar("request_budget", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    The request's latency budget ran out during `stage`.
+
+    `started` tells whether the work itself had begun (e.g. the LLM call was
+    sent) or was still waiting for its turn.
+    """
+
+    def __init__(self, stage: str, started: bool):
+        super().__init__(f"Deadline exceeded during {stage}")
+        self.stage = stage
+        self.started = started
+
+
+def parse_timeout(value: Optional[str]) -> Optional[float]:
+    """A client-supplied budget in seconds, capped; None when absent or not a positive number."""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    if seconds <= 0:
+        return None
+    return min(seconds, REQUEST_TIMEOUT_MAX_SECONDS)
+
+
+def start(timeout: Optional[float] = None) -> Optional[float]:
+    """Give the current context (and the tasks it spawns) a deadline `timeout` seconds from now."""
+    timeout = timeout or REQUEST_TIMEOUT_SECONDS
+    if not timeout:
+        return None
+    deadline = time.monotonic() + max(0.0, timeout - REQUEST_DEADLINE_RESERVE_SECONDS)
+    _deadline.set(deadline)
+    _budget.set(timeout)
+    return deadline
+
+
+def budget() -> Optional[float]:
+    """The latency budget (seconds) the current deadline was started with."""
+    return _budget.get()
+
+
+def remaining() -> Optional[float]:
+    """Seconds left until the current deadline (never negative), or None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Upper bound on images per batched predict call
+DETECTION_MAX_BATCH_SIZE = int(os.getenv("DETECTION_MAX_BATCH_SIZE", "8"))
+# How long the first request of a batch waits for others to join it
+DETECTION_MAX_WAIT_MS = float(os.getenv("DETECTION_MAX_WAIT_MS", "10"))
+
+
+class DetectionBatcher:
+    """
+    Cross-request micro-batching in front of the object detector.
+
+    Requests from any coroutine are queued to a dedicated worker thread.
+    The worker takes the first waiting image, collects whatever else arrives
+    within `max_wait_ms` (up to `max_batch_size` images), runs them through
+    `predict_batch` in one call and hands each request its own result
+    through a future.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[Any]], List[List[Dict]]],
+        max_batch_size: int = DETECTION_MAX_BATCH_SIZE,
+        max_wait_ms: float = DETECTION_MAX_WAIT_MS
+    ):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.images = 0
+        self.max_queue_depth = 0
+        self.last_batch_size = 0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="detection-worker", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    async def detect(self, image: Any) -> List[Dict]:
+        """Queue one image for detection and wait for its detections."""
+        if self._thread is None:
+            raise RuntimeError("DetectionBatcher has not been started")
+        future: Future = Future()
+        self._queue.put((image, future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await asyncio.wrap_future(future)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch: List[tuple]) -> None:
+        # Skip requests whose caller already gave up
+        batch = [(image, future) for image, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self.predict_batch([image for image, _ in batch])
+        except Exception as e:
+            logging.error(f"Batched detection of {len(batch)} images failed: {e}", exc_info=True)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.images += len(batch)
+        self.last_batch_size = len(batch)
+        for (_, future), detections in zip(batch, results):
+            future.set_result(detections)
+
+    def stats(self) -> Dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "batches": self.batches,
+            "images": self.images,
+            "mean_batch_size": self.images / self.batches if self.batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
@@ -1,18 +1,25 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 import os 
+import asyncio
 import base64
 from freshness_classifier import classify_image , device
-from typing import Optional , Dict , Any 
+from typing import Optional , Dict , Any , Tuple , List
 from PIL import Image 
 import io 
+import logging
+
+import deadlines
+import llm_cache
+import llm_client
+import llm_scheduler
+import metrics
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+MODEL = "gpt-4o-2024-08-06"
 
 # Define the ProductAnalysis model
 class ProductAnalysis(BaseModel):
@@ -44,7 +51,122 @@ class FreshnessAnalysis(BaseModel):
     )
 
 
-def perform_ocr_extraction(base64_image: str, openai_client: OpenAI) -> Dict:
+class PerishableAnalysis(BaseModel):
+    packaged: bool = Field(
+        False,
+        description="True if the item is a packaged product with a printed label rather than loose fresh produce"
+    )
+    product_name: Optional[str] = Field(
+        None,
+        description="Name of the product (e.g., apple, banana, bread, or the name printed on the label)"
+    )
+    item_count: Optional[int] = Field(None, description="Count/quantity of items present in the image")
+    category: Optional[str] = Field(None, description="Category of the product (e.g., fruit, vegetable, bread, personal care)")
+    estimated_shelf_life_days: Optional[int] = Field(None, description="Estimated shelf life in terms of days")
+    brand_name: Optional[str] = Field(None, description="Name of the brand, for packaged products")
+    brand_details: Optional[str] = Field(None, description="Details about the brand, such as logo or tagline")
+    pack_size: Optional[str] = Field(None, description="Size of the product pack")
+    expiry_date: Optional[str] = Field(None, description="Expiry date of the product")
+    mrp: Optional[str] = Field(None, description="Maximum Retail Price of the product")
+
+
+class DetectionAnalysis(BaseModel):
+    index: int = Field(..., description="Number of the image this entry describes, as labelled in the prompt")
+    product: Optional[ProductAnalysis] = Field(
+        None,
+        description="Extracted label information, filled for packaged products"
+    )
+    freshness: Optional[FreshnessAnalysis] = Field(
+        None,
+        description="Freshness information, filled for fresh produce"
+    )
+
+
+class ShelfAnalysis(BaseModel):
+    items: List[DetectionAnalysis] = Field(
+        default_factory=list,
+        description="One entry per image, in the order the images were given"
+    )
+
+
+async def _parse_structured(
+    prompt: str,
+    image_urls: List[str],
+    response_format: type,
+    openai_client: Optional[AsyncOpenAI] = None,
+    image_labels: Optional[List[str]] = None,
+    image_details: Optional[List[str]] = None
+) -> Dict:
+    """
+    Run one structured-output gpt-4o call over a prompt and a list of image URLs.
+
+    When image_labels is given, each image is preceded by its label so the
+    model can refer to it. image_details sets the `detail` level per image.
+    Results are served from the analysis cache when
+    an identical or near-identical set of images was already analyzed with
+    the same prompt and schema.
+    """
+    cache = llm_cache.get_cache()
+    if cache is not None:
+        # Hashing decodes every image, so keep it off the event loop
+        with metrics.span("llm_cache_lookup"):
+            cache_key = await asyncio.to_thread(llm_cache.make_key, MODEL, prompt, response_format, image_urls)
+        if image_labels or image_details:
+            extras = "\n".join(image_labels or []) + "|" + ",".join(image_details or [])
+            cache_key = f"{cache_key}:{llm_cache.hash_text(extras)}"
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            return cached
+
+    # Prepare the messages with text and images
+    content = [{"type": "text", "text": prompt}]
+    for i, url in enumerate(image_urls):
+        if image_labels:
+            content.append({"type": "text", "text": image_labels[i]})
+        image_url = {"url": url}
+        if image_details and image_details[i]:
+            image_url["detail"] = image_details[i]
+        content.append({"type": "image_url", "image_url": image_url})
+    messages = [
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
+
+    # Make the API call on the shared client, admitted (and retried) by the scheduler
+    openai_client = openai_client or llm_client.get_client()
+
+    async def call():
+        with metrics.span("llm"):
+            return await openai_client.beta.chat.completions.parse(
+                model=MODEL,
+                messages=messages,
+                response_format=response_format,
+                temperature=0
+            )
+
+    estimated_tokens = llm_scheduler.estimate_tokens(prompt, image_details or [None] * len(image_urls))
+    try:
+        completion = await llm_client.get_scheduler().run_hedged(call, estimated_tokens)
+    except Exception as e:
+        metrics.LLM_ERRORS.labels(type(e).__name__).inc()
+        raise
+
+    llm_client.record_usage(completion.usage)
+
+    # Extract the parsed message
+    result = completion.choices[0].message.parsed.model_dump()
+    if cache is not None:
+        await cache.aset(cache_key, result)
+    return result
+
+
+async def perform_ocr_extraction(
+    base64_image: str,
+    openai_client: Optional[AsyncOpenAI] = None,
+    detail: Optional[str] = None
+) -> Dict:
     prompt = """
 Analyze the image of a grocery product and extract the following information: 
 - Brand name
@@ -58,45 +180,22 @@ Analyze the image of a grocery product and extract the following information:
 """
 
     try:
-        # Prepare the messages with text and image
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"{base64_image}" 
-                        }
-                    }
-                ]
-            }
-        ]
-
-        # Make the API call
-        completion = openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=messages,
-            response_format=ProductAnalysis,
-            temperature=0
+        return await _parse_structured(
+            prompt, [base64_image], ProductAnalysis, openai_client, image_details=[detail]
         )
 
-        # Extract the parsed message
-        result = completion.choices[0].message.parsed
-    
-
-        return result.model_dump()
-
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"An error occurred during OCR extraction: {e}")
         return None
 
 
-async def analyze_freshness(base64_image: str, openai_client: OpenAI) -> Dict:
+async def analyze_freshness(
+    base64_image: str,
+    openai_client: Optional[AsyncOpenAI] = None,
+    detail: Optional[str] = None
+) -> Dict:
     prompt = """
 Analyze the image of a grocery product and extract the following information:
 - Name of the product (e.g., apple, banana, bread, etc.)
@@ -108,36 +207,15 @@ Edge Case
 If in case the fruit seems spoiled then the estimated shelf life is 0
 """
     try:
-        # Prepare the messages with text and image
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}" 
-                        }
-                    }
-                ]
-            }
-        ]
-
-        # Make the API call
-        completion = openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=messages,
-            response_format=FreshnessAnalysis,
-            temperature=0
+        result = await _parse_structured(
+            prompt, [f"data:image/jpeg;base64,{base64_image}"], FreshnessAnalysis, openai_client,
+            image_details=[detail]
         )
-        result = completion.choices[0].message.parsed
         print(result)
-        return result.model_dump()
+        return result
 
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"An error occurred during OCR extraction: {e}")
         return None
@@ -148,9 +226,18 @@ async def perishable_analyze(
     client: Any,
     classifier_model: Any,
     device: Optional[Any] = None,
-    threshold: float = 0.9
+    threshold: float = 0.9,
+    classification: Optional[Tuple[str, float]] = None,
+    detail: Optional[str] = None,
+    image: Optional[Any] = None,
+    combined: bool = False
 ) -> Dict[str, Any]:
-    # Step 1: Decode the Base64 image
+    # With `combined`, one PerishableAnalysis call also reads the label, and a
+    # crop that turns out to be a packaged product comes back with the
+    # ProductAnalysis fields instead of the freshness ones
+
+    # Step 1: Strip the data URL prefix; the image itself is only decoded when
+    # neither a precomputed classification nor the crop (PIL or array) was given
     try:
         # If the Base64 string includes the data URL prefix, remove it
         if base64_image.startswith('data:'):
@@ -158,45 +245,105 @@ async def perishable_analyze(
         else:
             encoded = base64_image
 
-        image_data = base64.b64decode(encoded)
-        image = Image.open(io.BytesIO(image_data)).convert('RGB')
+        if classification is None and image is None:
+            image_data = base64.b64decode(encoded)
+            image = Image.open(io.BytesIO(image_data)).convert('RGB')
     except Exception as e:
         return {"error": f"Failed to decode or open image: {str(e)}"}
 
-    # Step 2: Classify the image
+    # Step 2: Classify the image, unless the caller already did it as part of a batch
     try:
-        predicted_label, probability = classify_image(
-            image,
-            classifier_model,
-            device=device,
-            threshold=threshold
-        )
+        if classification is not None:
+            predicted_label, probability = classification
+        else:
+            predicted_label, probability = classify_image(
+                image,
+                classifier_model,
+                device=device,
+                threshold=threshold
+            )
     except Exception as e:
         return {"error": f"Image classification failed: {str(e)}"}
 
     # Step 3: Analyze the image using the freshness analysis API
     try:
-        analysis_result =await analyze_freshness(encoded , client)
+        if combined:
+            analysis_result = await analyze_perishable(encoded, client, detail=detail)
+        else:
+            analysis_result =await analyze_freshness(encoded , client, detail=detail)
+        if analysis_result is None:
+            return {"error": "Freshness analysis failed"}
         if 'error' in analysis_result:
             return analysis_result  # Return the error from analyze_freshness
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         return {"error": f"Freshness analysis failed: {str(e)}"}
 
+    if combined and analysis_result.get("packaged"):
+        return {key: analysis_result.get(key) for key in ProductAnalysis.model_fields}
+
     # Step 4: Combine the results
     try:
-        result = {
-            "product_name": analysis_result.get("product_name", None),
-            "item_count": analysis_result.get("item_count", None),
-            "category": analysis_result.get("category", None),
-            "estimated_shelf_life_days": analysis_result.get("estimated_shelf_life_days", None),
-            "state": predicted_label,             # Classifier model prediction ('fresh' or 'rotten')
-            "freshness": (1 - probability)       # Classifier model probability
-        }
-        return result
+        return combine_freshness(analysis_result, predicted_label, probability)
     except Exception as e:
         return {"error": f"Failed to combine results: {str(e)}"}
 
 
+async def analyze_perishable(
+    base64_image: str,
+    openai_client: Optional[AsyncOpenAI] = None,
+    detail: Optional[str] = None
+) -> Dict:
+    """
+    Freshness analysis and label OCR of a crop the detector called fresh produce, in one call.
+
+    Covers what used to take a FreshnessAnalysis call followed by a
+    ProductAnalysis call when the first came back without a product name.
+    """
+    prompt = """
+Analyze the image of a grocery item that was detected as fresh produce and extract the following information:
+- Whether it is actually a packaged product with a printed label rather than loose fresh produce
+- Name of the product (e.g., apple, banana, bread, etc., or the name printed on the label)
+- Count/quantity of items - count of the identified product present in the image (eg - 1,2 ...)
+- Category of the product (e.g., fruit, vegetable, bread, personal care, household items)
+- Estimated shelf life (in terms of days)
+
+If it is a packaged product, also extract from the label:
+- Brand name
+- Brand details (e.g., logo/tagline)
+- Pack size
+- Expiry date
+- MRP (Maximum Retail Price)
+
+Edge Case 
+If in case the fruit seems spoiled then the estimated shelf life is 0
+"""
+    try:
+        return await _parse_structured(
+            prompt, [f"data:image/jpeg;base64,{base64_image}"], PerishableAnalysis, openai_client,
+            image_details=[detail]
+        )
+
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        print(f"An error occurred during perishable analysis: {e}")
+        return None
+
+
+def combine_freshness(analysis_result: Dict[str, Any], predicted_label: str, probability: float) -> Dict[str, Any]:
+    """Merge a FreshnessAnalysis result with the classifier's prediction for the same crop."""
+    return {
+        "product_name": analysis_result.get("product_name", None),
+        "item_count": analysis_result.get("item_count", None),
+        "category": analysis_result.get("category", None),
+        "estimated_shelf_life_days": analysis_result.get("estimated_shelf_life_days", None),
+        "state": predicted_label,             # Classifier model prediction ('fresh' or 'rotten')
+        "freshness": (1 - probability)       # Classifier model probability
+    }
+
+
 # Example usage
 if __name__ == "__main__":
     def encode_image(image_path: str) -> str:
@@ -224,9 +371,13 @@ if __name__ == "__main__":
     image_path ="Data/rotten-apple.webp"
     base64_image = encode_image(image_path)
 
-    print(perishable_analyze(base64_image , client , model , device))
+    print(asyncio.run(perishable_analyze(base64_image , llm_client.get_client() , model , device)))
 
-def ocr_mulitple_images(b64_images , openai_client)-> Dict:
+async def ocr_mulitple_images(
+    b64_images,
+    openai_client: Optional[AsyncOpenAI] = None,
+    details: Optional[List[str]] = None
+)-> Dict:
     prompt = """
 Following are the images of a single grocery product from different angles 
 Analyze the images of the given grocery product and extract the following information: 
@@ -241,31 +392,80 @@ Analyze the images of the given grocery product and extract the following inform
 """
 
     try:
-        # Prepare the messages with text and image
-        content = [
-            {"type": "text","text": prompt}
-            ]
-        content.extend([{"type": "image_url" , "image_url": {"url": f"{b64_image}"}} for b64_image in b64_images])
-        messages = [
-            {
-                "role": "user",
-                "content": content
-            }
-        ]
-
-        # Make the API call
-        completion = openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=messages,
-            response_format=ProductAnalysis,
-            temperature=0
-        )
-
-        # Extract the parsed message
-        result = completion.choices[0].message.parsed
-
-        return result.model_dump()
+        return await _parse_structured(prompt, b64_images, ProductAnalysis, openai_client, image_details=details)
 
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"An error occurred during OCR extraction: {e}")
         return None
+
+
+async def analyze_shelf(
+    base64_images: List[str],
+    class_ids: List[int],
+    openai_client: Optional[AsyncOpenAI] = None,
+    details: Optional[List[str]] = None
+) -> List[Optional[Dict]]:
+    """
+    Analyze every crop of one shelf image in a single structured-output call.
+
+    Args:
+        base64_images (List[str]): Data URLs of the crops, in detection order.
+        class_ids (List[int]): Detector class per crop; 0 is fresh produce, 1 is a packaged product.
+        openai_client (AsyncOpenAI): Optional client, defaults to the shared one.
+        details (List[str]): Optional image `detail` level per crop.
+
+    Returns:
+        List[Optional[Dict]]: Per crop, the ProductAnalysis (class 1) or FreshnessAnalysis
+        (class 0) fields, or None when the model returned nothing usable for that crop.
+    """
+    prompt = """
+Following are images of different grocery products cropped from one store shelf.
+Each image is preceded by its number and its kind. Return exactly one entry per image, using its number as the index.
+
+For a packaged product, fill `product` with:
+- Brand name
+- Brand details (e.g., logo/tagline)
+- Pack size
+- Expiry date
+- MRP (Maximum Retail Price)
+- Product name
+- Count/quantity of items - count of the product present in the image 
+- Category of the product (e.g., personal care, household items, health supplements, etc.)
+
+For fresh produce, fill `freshness` with:
+- Name of the product (e.g., apple, banana, bread, etc.)
+- Count/quantity of items - count of the identified product present in the image (eg - 1,2 ...)
+- Category of the product (e.g., fruit, vegetable, bread)
+- Estimated shelf life (in terms of days)
+
+Edge Case 
+If in case the fruit seems spoiled then the estimated shelf life is 0
+"""
+    labels = [
+        f"Image {i} ({'fresh produce' if class_id == 0 else 'packaged product'}):"
+        for i, class_id in enumerate(class_ids)
+    ]
+    results: List[Optional[Dict]] = [None] * len(base64_images)
+    if not base64_images:
+        return results
+
+    try:
+        shelf = await _parse_structured(
+            prompt, base64_images, ShelfAnalysis, openai_client, image_labels=labels, image_details=details
+        )
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        logging.error(f"Shelf analysis failed: {e}", exc_info=True)
+        return results
+
+    for item in shelf.get("items") or []:
+        index = item.get("index")
+        if not isinstance(index, int) or not 0 <= index < len(results):
+            continue
+        entry = item.get("freshness") if class_ids[index] == 0 else item.get("product")
+        if entry and any(value is not None for value in entry.values()):
+            results[index] = entry
+    return results
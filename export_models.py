@@ -0,0 +1,192 @@
+"""
+Export the detector and freshness classifier for CPU inference backends, and
+check that exported models agree with the original weights.
+
+Usage:
+    python export_models.py export [--int8]
+    python export_models.py check --backend onnx [--int8] image1.jpg [image2.jpg ...]
+
+`export` writes TorchScript and ONNX files next to the weights in ml_models/,
+plus dynamically INT8-quantized ONNX files with --int8. `check` runs both the
+PyTorch weights and the selected backend on the given images and fails when
+classifier probabilities or detections diverge beyond the tolerances.
+"""
+import argparse
+import shutil
+import sys
+import time
+
+import numpy as np
+import torch
+
+import freshness_classifier
+import inference_backends
+import utils
+from inference_backends import CLASSIFIER_WEIGHTS, DETECTOR_WEIGHTS, exported_path
+
+
+def quantize_int8(src: str, dst: str) -> None:
+    """Dynamically quantize an ONNX model to INT8 weights, keeping its metadata (e.g. YOLO class names)."""
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+    source, quantized = onnx.load(src), onnx.load(dst)
+    if not quantized.metadata_props:
+        quantized.metadata_props.extend(source.metadata_props)
+        onnx.save(quantized, dst)
+
+
+def export_detector(int8: bool) -> None:
+    from ultralytics import YOLO
+
+    model = YOLO(DETECTOR_WEIGHTS)
+    print("Exported", model.export(format="torchscript"))
+    # Dynamic axes so the detection worker can run batches of any size
+    onnx_path = model.export(format="onnx", dynamic=True, simplify=True)
+    expected = exported_path(DETECTOR_WEIGHTS, "onnx")
+    if onnx_path != expected:
+        shutil.move(onnx_path, expected)
+    print("Exported", expected)
+    if int8:
+        int8_path = exported_path(DETECTOR_WEIGHTS, "onnx", int8=True)
+        quantize_int8(expected, int8_path)
+        print("Exported", int8_path)
+
+
+def export_classifier(int8: bool) -> None:
+    model = freshness_classifier.get_classifier_model().cpu()
+    dummy = torch.randn(1, 3, 224, 224)
+
+    torchscript_path = exported_path(CLASSIFIER_WEIGHTS, "torchscript")
+    with torch.inference_mode():
+        torch.jit.trace(model, dummy).save(torchscript_path)
+    print("Exported", torchscript_path)
+
+    onnx_path = exported_path(CLASSIFIER_WEIGHTS, "onnx")
+    torch.onnx.export(
+        model,
+        dummy,
+        onnx_path,
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+    print("Exported", onnx_path)
+    if int8:
+        int8_path = exported_path(CLASSIFIER_WEIGHTS, "onnx", int8=True)
+        quantize_int8(onnx_path, int8_path)
+        print("Exported", int8_path)
+
+
+def box_iou(a, b) -> float:
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """Greedily match candidate detections to reference ones of the same class; returns the matched IoUs."""
+    unmatched = list(candidate)
+    ious = []
+    for ref in sorted(reference, key=lambda d: -d["confidence"]):
+        best, best_iou = None, iou_threshold
+        for cand in unmatched:
+            if cand["class_id"] != ref["class_id"]:
+                continue
+            iou = box_iou(ref["bbox"], cand["bbox"])
+            if iou >= best_iou:
+                best, best_iou = cand, iou
+        if best is not None:
+            unmatched.remove(best)
+            ious.append(best_iou)
+    return ious
+
+
+def detections_for(model, image):
+    result = model.predict(source=image, conf=0.25, iou=0.5, max_det=20, agnostic_nms=True, verbose=False)[0]
+    xyxy = result.boxes.xyxy.cpu().numpy()
+    bboxes = np.column_stack([xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2]]).astype(int)
+    return [
+        {"bbox": bbox.tolist(), "confidence": float(conf), "class_id": int(cls)}
+        for bbox, conf, cls in zip(bboxes, result.boxes.conf.cpu().numpy(), result.boxes.cls.cpu().numpy())
+    ]
+
+
+def check(backend: str, int8: bool, images, max_prob_diff: float, min_match_rate: float) -> bool:
+    from PIL import Image
+
+    ref_detector = inference_backends.load_detector("pytorch")
+    detector = inference_backends.load_detector(backend, int8)
+    ref_classifier = inference_backends.load_classifier("pytorch")
+    classifier = inference_backends.load_classifier(backend, int8)
+    device = freshness_classifier.device
+
+    n_ref = n_matched = 0
+    ious, prob_diffs, label_agreement = [], [], []
+    ref_seconds = backend_seconds = 0.0
+    for path in images:
+        image = Image.open(path).convert('RGB')
+
+        start = time.perf_counter()
+        reference = detections_for(ref_detector, image)
+        ref_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        candidate = detections_for(detector, image)
+        backend_seconds += time.perf_counter() - start
+
+        matched = match_detections(reference, candidate)
+        n_ref += len(reference)
+        n_matched += len(matched)
+        ious.extend(matched)
+
+        # Compare the classifier on the reference crops (and the whole image when nothing was detected)
+        crops = utils.crop_detections(np.asarray(image), reference) or [np.asarray(image)]
+        crops = [crop for crop in crops if crop.size]
+        if crops:
+            ref_results = freshness_classifier.classify_images(crops, ref_classifier, device, threshold=0.9)
+            results = freshness_classifier.classify_images(crops, classifier, device, threshold=0.9)
+            for (ref_label, ref_prob), (label, prob) in zip(ref_results, results):
+                prob_diffs.append(abs(ref_prob - prob))
+                label_agreement.append(ref_label == label)
+
+    match_rate = n_matched / n_ref if n_ref else 1.0
+    worst_prob_diff = max(prob_diffs) if prob_diffs else 0.0
+    print(f"backend={backend} int8={int8} images={len(images)}")
+    print(f"detector: {n_matched}/{n_ref} reference boxes matched ({match_rate:.1%}), "
+          f"mean IoU {np.mean(ious) if ious else 0:.3f}, "
+          f"{ref_seconds / len(images) * 1000:.0f} ms -> {backend_seconds / len(images) * 1000:.0f} ms per image")
+    print(f"classifier: max |dp| {worst_prob_diff:.4f}, label agreement "
+          f"{np.mean(label_agreement) if label_agreement else 1:.1%} over {len(prob_diffs)} crops")
+    ok = match_rate >= min_match_rate and worst_prob_diff <= max_prob_diff
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write TorchScript and ONNX models to ml_models/")
+    export_parser.add_argument("--int8", action="store_true", help="Also write dynamically INT8-quantized ONNX models")
+
+    check_parser = subparsers.add_parser("check", help="Compare a backend against the PyTorch weights")
+    check_parser.add_argument("images", nargs="+")
+    check_parser.add_argument("--backend", choices=["torchscript", "onnx"], default="onnx")
+    check_parser.add_argument("--int8", action="store_true")
+    check_parser.add_argument("--max-prob-diff", type=float, default=0.05,
+                              help="Largest allowed difference in the classifier's 'rotten' probability")
+    check_parser.add_argument("--min-match-rate", type=float, default=0.95,
+                              help="Smallest allowed share of reference boxes matched at IoU >= 0.5")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_detector(args.int8)
+        export_classifier(args.int8)
+    else:
+        sys.exit(0 if check(args.backend, args.int8, args.images, args.max_prob_diff, args.min_match_rate) else 1)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torchvision import models, transforms
 import os 
+import numpy as np
 from PIL import Image 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -28,58 +29,77 @@ def get_classifier_model():
     return model
 
 
-def classify_image(image_input, classifier_model, device, threshold=0.5):
+# Define the transformation pipeline once; it is stateless and shared by every call
+preprocess = transforms.Compose([
+    transforms.Resize(256),                # Resize the shorter side to 256 pixels
+    transforms.CenterCrop(224),            # Crop the center 224x224 pixels
+    transforms.ToTensor(),                 # Convert PIL Image to Tensor
+    transforms.Normalize(                  # Normalize with ImageNet mean and std
+        mean=[0.485, 0.456, 0.406],
+        std=[0.229, 0.224, 0.225]
+    )
+])
+
+
+def classify_images(image_inputs, classifier_model, device, threshold=0.5):
     """
-    Classify an image using the provided classifier_model and threshold.
+    Classify a batch of images in a single forward pass.
 
     Parameters:
-    - image_input (PIL.Image.Image): A PIL Image object.
+    - image_inputs (list of PIL.Image.Image or np.ndarray): PIL Images or HxWx3 RGB uint8 arrays,
+      e.g. every perishable crop of a shelf image.
     - classifier_model (torch.nn.Module): The pre-trained and loaded PyTorch classifier_model.
     - device (torch.device): The device to run the classifier_model on (CPU or GPU).
     - threshold (float): Threshold for classifying as 'rotten'. Default is 0.5.
 
     Returns:
-    - predicted_class (str): The predicted class label ('fresh' or 'rotten').
-    - probability (float): The probability of the image belonging to the 'rotten' class.
+    - results (list of tuple): One (predicted_class, probability) pair per input, in input order.
     """
+    if not image_inputs:
+        return []
+
+    tensors = []
+    for image_input in image_inputs:
+        if isinstance(image_input, np.ndarray):
+            image = Image.fromarray(np.ascontiguousarray(image_input))
+        elif isinstance(image_input, Image.Image):
+            image = image_input if image_input.mode == 'RGB' else image_input.convert('RGB')
+        else:
+            raise ValueError("image_input must be a PIL Image or a NumPy array.")
+        tensors.append(preprocess(image))
 
-    # Define the transformation pipeline
-    preprocess = transforms.Compose([
-        transforms.Resize(256),                # Resize the shorter side to 256 pixels
-        transforms.CenterCrop(224),            # Crop the center 224x224 pixels
-        transforms.ToTensor(),                 # Convert PIL Image to Tensor
-        transforms.Normalize(                  # Normalize with ImageNet mean and std
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225]
-        )
-    ])
-
-    # Ensure the input is a PIL Image
-    if isinstance(image_input, Image.Image):
-        image = image_input.convert('RGB')
-    else:
-        raise ValueError("image_input must be a PIL Image.")
-
-    # Apply the preprocessing transformations
-    input_tensor = preprocess(image)
-
-    # Create a mini-batch as expected by the classifier_model
-    input_batch = input_tensor.unsqueeze(0).to(device)  # Shape: [1, 3, 224, 224]
-
-    with torch.no_grad():
-        # Get classifier_model outputs
-        outputs = classifier_model(input_batch)  # Shape: [1, num_classes]
+    input_batch = torch.stack(tensors).to(device)  # Shape: [N, 3, 224, 224]
 
-        # Apply softmax to get probabilities
-        probabilities = nn.functional.softmax(outputs, dim=1)
+    with torch.inference_mode():
+        # Get classifier_model outputs
+        outputs = classifier_model(input_batch)  # Shape: [N, num_classes]
 
-        # Get the probability of the positive class (class 1)
-        prob_positive = probabilities[0][1].item()
+        # Apply softmax to get probabilities and keep the positive class (class 1)
+        probs_positive = nn.functional.softmax(outputs, dim=1)[:, 1].tolist()
 
+    results = []
+    for prob_positive in probs_positive:
         # Determine the predicted class based on the threshold
         if prob_positive >= threshold:
             predicted_class = 'rotten'  # Assuming class 1 is 'rotten'
         else:
             predicted_class = 'fresh'   # Assuming class 0 is 'fresh'
+        results.append((predicted_class, prob_positive))
+    return results
 
-    return predicted_class, prob_positive
\ No newline at end of file
+
+def classify_image(image_input, classifier_model, device, threshold=0.5):
+    """
+    Classify an image using the provided classifier_model and threshold.
+
+    Parameters:
+    - image_input (PIL.Image.Image or np.ndarray): A PIL Image object or HxWx3 RGB uint8 array.
+    - classifier_model (torch.nn.Module): The pre-trained and loaded PyTorch classifier_model.
+    - device (torch.device): The device to run the classifier_model on (CPU or GPU).
+    - threshold (float): Threshold for classifying as 'rotten'. Default is 0.5.
+
+    Returns:
+    - predicted_class (str): The predicted class label ('fresh' or 'rotten').
+    - probability (float): The probability of the image belonging to the 'rotten' class.
+    """
+    return classify_images([image_input], classifier_model, device, threshold=threshold)[0]
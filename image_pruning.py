@@ -0,0 +1,151 @@
+import io
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+import llm_cache
+import utils
+from stream_tracking import crop_sharpness, hamming_distance
+
+load_dotenv()
+
+# Images whose dHashes agree on at least this share of bits count as the same shot; above 1 disables pruning
+OCR_DEDUP_SIMILARITY = float(os.getenv("OCR_DEDUP_SIMILARITY", "0.9"))
+# Side of the dHash grid; 16 gives a 256-bit hash
+OCR_DEDUP_HASH_SIZE = int(os.getenv("OCR_DEDUP_HASH_SIZE", "16"))
+# Estimated image tokens one /multi_image_ocr/ request may send (0: no budget)
+OCR_IMAGE_TOKEN_BUDGET = int(os.getenv("OCR_IMAGE_TOKEN_BUDGET", "3000"))
+OCR_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "85"))
+
+# Images are hashed and scored for sharpness at no more than this size
+INSPECT_SIDE = 256
+# Caps on the longest side tried, largest first, when fitting a request into the budget
+BUDGET_MAX_SIDES = (2048, 1536, 1024, 768, 512)
+# Formats gpt-4o takes as they are, with the extension that gives their MIME type; others are sent as JPEG
+LLM_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+
+@dataclass
+class _Image:
+    data: bytes
+    size: Tuple[int, int]
+    format: Optional[str]
+    hash: str = ""
+    sharpness: float = 0.0
+
+
+@dataclass
+class PrunedImages:
+    """The images to send, their `detail` levels and what pruning saved."""
+
+    urls: List[str] = field(default_factory=list)
+    details: List[str] = field(default_factory=list)
+    received: int = 0
+    dropped: int = 0
+    downscaled: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+def similarity(hash_a: str, hash_b: str) -> float:
+    """Share of matching bits between two hex hashes of the same length."""
+    return 1 - hamming_distance(hash_a, hash_b) / (len(hash_a) * 4)
+
+
+def capped_size(size: Tuple[int, int], max_side: Optional[int]) -> Tuple[int, int]:
+    """(width, height) after fitting `size` into max_side x max_side; never upscales."""
+    scale = min(1.0, max_side / max(size)) if max_side else 1.0
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def _inspect(data: bytes, hash_size: int) -> _Image:
+    header = Image.open(io.BytesIO(data))
+    image = _Image(data, header.size, header.format)
+    small = utils.decode_reduced(data, utils.jpeg_scale(max(image.size) / INSPECT_SIDE))
+    small.thumbnail((INSPECT_SIDE, INSPECT_SIDE), Image.Resampling.BILINEAR)
+    image.hash = llm_cache.perceptual_hash(small, hash_size)
+    image.sharpness = crop_sharpness(np.asarray(small))
+    return image
+
+
+def _deduplicate(images: List[_Image], threshold: float) -> List[_Image]:
+    # The sharpest shot of each group is kept; the rest keep their original order
+    kept: List[_Image] = []
+    for image in sorted(images, key=lambda img: img.sharpness, reverse=True):
+        if all(similarity(image.hash, other.hash) < threshold for other in kept):
+            kept.append(image)
+    kept_ids = {id(image) for image in kept}
+    return [image for image in images if id(image) in kept_ids]
+
+
+def _tokens(images: List[_Image], max_side: Optional[int] = None, detail: str = "auto") -> int:
+    return sum(
+        utils.estimate_image_tokens(*capped_size(image.size, max_side), detail) for image in images
+    )
+
+
+def _fit_budget(images: List[_Image], budget: int) -> Tuple[Optional[int], str]:
+    # The largest common cap on the longest side that fits; low detail when even 512px doesn't
+    if not budget:
+        return None, "auto"
+    for max_side in (None, *BUDGET_MAX_SIDES):
+        if _tokens(images, max_side) <= budget:
+            return max_side, "auto"
+    # The API downsizes low-detail images to 512px anyway
+    return 512, "low"
+
+
+def prune_images(
+    images_data: List[bytes],
+    threshold: float = OCR_DEDUP_SIMILARITY,
+    token_budget: int = OCR_IMAGE_TOKEN_BUDGET,
+    hash_size: int = OCR_DEDUP_HASH_SIZE
+) -> PrunedImages:
+    """
+    Drop near-duplicate shots of a product and shrink the rest to a token budget.
+
+    Images whose dHashes are at least `threshold` similar to a sharper image
+    that is kept are dropped. If the survivors are estimated to cost more
+    than `token_budget` image tokens, all of them are capped to the largest
+    common longest side that fits, falling back to low detail; only images
+    above the cap, or in a format gpt-4o doesn't take, are re-encoded.
+
+    Args:
+        images_data (List[bytes]): The encoded images, already checked by `uploads.check_image`.
+        threshold (float): Share of matching hash bits from which two images count as duplicates.
+        token_budget (int): Estimated image tokens allowed for the request; 0 for no limit.
+        hash_size (int): Side of the dHash grid.
+
+    Returns:
+        PrunedImages: The data URLs and detail levels to send, in the original order.
+    """
+    images = [_inspect(data, hash_size) for data in images_data]
+    kept = _deduplicate(images, threshold)
+    max_side, detail = _fit_budget(kept, token_budget)
+
+    result = PrunedImages(
+        received=len(images),
+        dropped=len(images) - len(kept),
+        tokens_before=_tokens(images),
+        tokens_after=_tokens(kept, max_side, detail)
+    )
+    for image in kept:
+        if max_side and max(image.size) > max_side:
+            decoded = utils.decode_reduced(image.data, utils.jpeg_scale(max(image.size) / max_side))
+            url, _, _ = utils.encode_image_for_llm(decoded, "image.jpg", max_side, OCR_JPEG_QUALITY)
+            result.downscaled += 1
+        elif image.format in LLM_FORMATS:
+            url = utils.image_to_base64_url_bytes(image.data, f"image.{LLM_FORMATS[image.format]}")
+        else:
+            url, _, _ = utils.encode_image_for_llm(utils.decode_reduced(image.data, 1), "image.jpg", None, OCR_JPEG_QUALITY)
+        result.urls.append(url)
+        result.details.append(detail)
+    return result
@@ -0,0 +1,88 @@
+import os
+from pathlib import Path
+from typing import Any
+
+import torch
+from dotenv import load_dotenv
+
+import freshness_classifier
+
+load_dotenv()
+
+DETECTOR_WEIGHTS = "ml_models/yolov11m_30k_10ep.pt"
+CLASSIFIER_WEIGHTS = "ml_models/mobilenetv2_freshness_classifier.pth"
+
+# "pytorch" runs the eager .pt/.pth weights, "torchscript" and "onnx" the files written by export_models.py
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "pytorch")
+CLASSIFIER_BACKEND = os.getenv("CLASSIFIER_BACKEND", "pytorch")
+# Use the dynamically INT8-quantized ONNX files instead of the FP32 ones
+INFERENCE_INT8 = os.getenv("INFERENCE_INT8", "0") == "1"
+# Threads per ONNX Runtime session; 0 lets ONNX Runtime decide
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", "0"))
+
+
+def exported_path(weights: str, backend: str, int8: bool = False) -> str:
+    """
+    Path of the exported artifact for a weights file and backend.
+
+    Follows ultralytics' export naming: `<stem>.onnx` and `<stem>.torchscript`
+    next to the weights, with `<stem>.int8.onnx` for the quantized variant.
+    """
+    path = Path(weights)
+    if backend == "pytorch":
+        return str(path)
+    if backend == "torchscript":
+        return str(path.with_suffix(".torchscript"))
+    if backend == "onnx":
+        return str(path.with_suffix(".int8.onnx" if int8 else ".onnx"))
+    raise ValueError(f"Unsupported inference backend: {backend}")
+
+
+class OnnxClassifier:
+    """
+    ONNX Runtime session with the calling convention of the PyTorch classifier.
+
+    Takes a normalized [N, 3, 224, 224] tensor and returns a logits tensor,
+    so `freshness_classifier.classify_images` works unchanged.
+    """
+
+    def __init__(self, path: str, intra_op_threads: int = ORT_INTRA_OP_THREADS):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input_batch: torch.Tensor) -> torch.Tensor:
+        outputs = self.session.run(None, {self.input_name: input_batch.cpu().numpy()})[0]
+        return torch.from_numpy(outputs)
+
+    def eval(self):
+        return self
+
+
+def load_detector(backend: str = DETECTOR_BACKEND, int8: bool = INFERENCE_INT8) -> Any:
+    """Load the YOLO detector for the given backend; ultralytics picks the runtime from the file type."""
+    from ultralytics import YOLO
+
+    path = exported_path(DETECTOR_WEIGHTS, backend, int8)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Detector weights for backend '{backend}' not found at {path}; run export_models.py export")
+    return YOLO(path, task="detect")
+
+
+def load_classifier(backend: str = CLASSIFIER_BACKEND, int8: bool = INFERENCE_INT8) -> Any:
+    """Load the freshness classifier for the given backend."""
+    if backend == "pytorch":
+        return freshness_classifier.get_classifier_model()
+
+    path = exported_path(CLASSIFIER_WEIGHTS, backend, int8)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Classifier weights for backend '{backend}' not found at {path}; run export_models.py export")
+    if backend == "torchscript":
+        model = torch.jit.load(path, map_location=freshness_classifier.device)
+        return model.eval()
+    return OnnxClassifier(path)
@@ -0,0 +1,240 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+
+from dotenv import load_dotenv
+from PIL import Image
+
+load_dotenv()
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "4096"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+# Optional SQLite file for the on-disk tier; leave unset to keep the cache in memory only
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH")
+# Rows kept in the on-disk tier; the ones closest to expiry go first
+LLM_CACHE_DB_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DB_MAX_ENTRIES", "100000"))
+# The on-disk tier is pruned (expired rows, then down to its cap) every this many writes
+DB_PRUNE_EVERY = 100
+# Side of the dHash grid; 8 gives a 64-bit hash
+LLM_CACHE_HASH_SIZE = int(os.getenv("LLM_CACHE_HASH_SIZE", "8"))
+
+
+def decode_base64_image(base64_image: str) -> Image.Image:
+    """Decode a base64 string or data URL into a PIL image."""
+    if base64_image.startswith('data:'):
+        _, base64_image = base64_image.split(',', 1)
+    return Image.open(io.BytesIO(base64.b64decode(base64_image)))
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = LLM_CACHE_HASH_SIZE) -> str:
+    """
+    Compute a difference hash (dHash) of an image.
+
+    Crops of the same product that differ only by re-encoding, slight
+    lighting changes or a few pixels of box jitter map to the same hash.
+
+    Args:
+        image (Image.Image): The image to hash.
+        hash_size (int): Side of the comparison grid.
+
+    Returns:
+        str: The hash as a hex string.
+    """
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+@lru_cache(maxsize=None)
+def _namespace(model: str, prompt: str, response_format: type) -> str:
+    # Any change to the model, prompt or schema invalidates previous entries
+    schema = json.dumps(response_format.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(f"{model}\n{prompt}\n{schema}".encode('utf-8')).hexdigest()[:16]
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def make_key(model: str, prompt: str, response_format: type, base64_images: Iterable[str]) -> str:
+    """Build a cache key from the prompt/schema version and the perceptual hash of every image."""
+    hashes = []
+    for b64 in base64_images:
+        try:
+            hashes.append(perceptual_hash(decode_base64_image(b64)))
+        except Exception:
+            # Not a decodable inline image (e.g. a remote URL); fall back to an exact content hash
+            hashes.append(hash_text(b64))
+    return f"{_namespace(model, prompt, response_format)}:{'-'.join(hashes)}"
+
+
+class AnalysisCache:
+    """
+    Two-tier cache for per-crop LLM analysis results.
+
+    The first tier is an in-memory LRU with a TTL. The optional second tier
+    is a SQLite table that survives restarts; entries read from it are
+    promoted back into memory. From the event loop use `aget`/`aset`, which
+    only touch the in-memory tier on the loop and query or commit the SQLite
+    tier on a worker thread.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        ttl_seconds: float = 86400,
+        db_path: Optional[str] = None,
+        db_max_entries: int = LLM_CACHE_DB_MAX_ENTRIES
+    ):
+        self.max_entries = max_entries
+        self.db_max_entries = db_max_entries
+        self._db_writes = 0
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Held across SQLite calls, so the in-memory tier never waits for a commit
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache (expires_at)")
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = self._get_disk(key, now)
+        return value
+
+    async def aget(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = await asyncio.to_thread(self._get_disk, key, now)
+        return value
+
+    def set(self, key: str, value: Dict) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._put(key, dict(value), expires_at)
+        if self._db is not None:
+            self._set_disk(key, value, expires_at)
+
+    async def aset(self, key: str, value: Dict) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._put(key, dict(value), expires_at)
+        if self._db is not None:
+            await asyncio.to_thread(self._set_disk, key, value, expires_at)
+
+    def _get_memory(self, key: str, now: float) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(value)
+                del self._entries[key]
+            if self._db is None:
+                self.misses += 1
+            return None
+
+    def _get_disk(self, key: str, now: float) -> Optional[Dict]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            value = json.loads(row[0])
+            self._put(key, value, row[1])
+            self.disk_hits += 1
+            return dict(value)
+
+    def _set_disk(self, key: str, value: Dict, expires_at: float) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at)
+            )
+            self._db_writes += 1
+            if self._db_writes % DB_PRUNE_EVERY == 0:
+                self._prune_disk(time.time())
+            self._db.commit()
+
+    def _prune_disk(self, now: float) -> None:
+        # Lookups already ignore expired rows; this only keeps the file from growing
+        self._db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+        (rows,) = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if rows > self.db_max_entries:
+            self._db.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY expires_at LIMIT ?)",
+                (rows - self.db_max_entries,)
+            )
+
+    def _put(self, key: str, value: Dict, expires_at: float) -> None:
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "enabled": True,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+_cache: Optional[AnalysisCache] = None
+
+
+def get_cache() -> Optional[AnalysisCache]:
+    """Return the process-wide cache, or None when LLM_CACHE_ENABLED is off."""
+    global _cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = AnalysisCache(
+            max_entries=LLM_CACHE_MAX_ENTRIES,
+            ttl_seconds=LLM_CACHE_TTL_SECONDS,
+            db_path=LLM_CACHE_DB_PATH,
+            db_max_entries=LLM_CACHE_DB_MAX_ENTRIES,
+        )
+    return _cache
+
+
+def stats() -> Dict:
+    cache = get_cache()
+    return cache.stats() if cache is not None else {"enabled": False}
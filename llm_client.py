@@ -0,0 +1,81 @@
+import os
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+import llm_scheduler
+import metrics
+
+load_dotenv()
+
+# Size of the shared HTTP connection pool used by the client
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+
+_client: Optional[AsyncOpenAI] = None
+_scheduler: Optional[llm_scheduler.LLMScheduler] = None
+
+# Running totals of the `usage` reported by every completion
+usage_totals = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def get_client() -> AsyncOpenAI:
+    """
+    Return the process-wide AsyncOpenAI client, creating it on first use.
+
+    All requests share a single httpx connection pool, so keep-alive
+    connections to the API are reused across detections and requests.
+    """
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            # Retries go back through the scheduler so they respect the rate limits
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                ),
+                event_hooks={"response": [_count_retryable_response]},
+            ),
+        )
+    return _client
+
+
+async def _count_retryable_response(response: httpx.Response) -> None:
+    # Counted as they arrive; the scheduler decides whether to retry
+    if response.status_code in (408, 409, 429) or response.status_code >= 500:
+        metrics.LLM_RETRIES.inc()
+
+
+def get_scheduler() -> llm_scheduler.LLMScheduler:
+    """Return the process-wide scheduler every gpt-4o call is admitted through."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = llm_scheduler.LLMScheduler()
+    return _scheduler
+
+
+def record_usage(usage) -> None:
+    """Add a completion's token usage to the running totals."""
+    usage_totals["calls"] += 1
+    metrics.LLM_CALLS.inc()
+    if usage is None:
+        return
+    usage_totals["prompt_tokens"] += usage.prompt_tokens or 0
+    usage_totals["completion_tokens"] += usage.completion_tokens or 0
+    usage_totals["total_tokens"] += usage.total_tokens or 0
+    metrics.LLM_TOKENS.labels("prompt").inc(usage.prompt_tokens or 0)
+    metrics.LLM_TOKENS.labels("completion").inc(usage.completion_tokens or 0)
+
+
+async def close_client() -> None:
+    """Close the shared client and its connection pool."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,376 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import openai
+from dotenv import load_dotenv
+
+import deadlines
+import metrics
+
+load_dotenv()
+
+# Ceiling of gpt-4o calls in flight across the whole process; the adaptive limit moves below it
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", "1"))
+# The account's quotas (0 disables a bucket); set below the real limits to leave room for other clients
+OPENAI_RPM_LIMIT = float(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_TPM_LIMIT = float(os.getenv("OPENAI_TPM_LIMIT", "0"))
+# How many seconds of quota can be spent in one burst
+OPENAI_BURST_SECONDS = float(os.getenv("OPENAI_BURST_SECONDS", "10"))
+# Retries of 408/409/429/5xx responses and connection errors, on top of the first attempt
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", "30"))
+# Calls still running at this percentile of recent latencies get a hedged duplicate (0 disables)
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+# Recent call latencies the percentile is taken over, and how many are needed before hedging starts
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# Completion tokens assumed per call when charging the token bucket up front
+COMPLETION_TOKEN_ESTIMATE = int(os.getenv("COMPLETION_TOKEN_ESTIMATE", "150"))
+
+# Lower rank is served first; a waiting call is never overtaken by one of a lower class
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+# Priority of the LLM calls made by the current request or job
+_priority: ContextVar[str] = ContextVar("llm_priority", default="interactive")
+
+T = TypeVar("T")
+
+
+def set_priority(priority: str) -> None:
+    """Run the LLM calls of the current context (and tasks it spawns) in this priority class."""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown LLM priority {priority!r}: use one of {', '.join(PRIORITIES)}")
+    _priority.set(priority)
+
+
+def estimate_tokens(prompt: str, image_details: List[Optional[str]]) -> int:
+    """Rough token cost of a call before it is made: ~4 characters per token, 85 per low-detail image."""
+    # A non-low crop of at most 1024px is four 512px tiles: 85 + 4 * 170
+    image_tokens = sum(85 if detail == "low" else 765 for detail in image_details)
+    return len(prompt) // 4 + image_tokens + COMPLETION_TOKEN_ESTIMATE
+
+
+class TokenBucket:
+    """Refills `per_minute` units a minute, holding at most `burst_seconds` worth; 0 means unlimited."""
+
+    def __init__(self, per_minute: float, burst_seconds: float = OPENAI_BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken (a call larger than the burst waits for a full bucket)."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        # May go negative: a call that used more than estimated delays the next ones
+        if self.rate:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level - amount)
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit with additive increase and multiplicative decrease.
+
+    Every success raises the limit by 1/limit (about one slot per limit's
+    worth of successes); a rate-limit response halves it, at most once per
+    `cooldown` seconds so the 429s of calls already in flight count once.
+    """
+
+    def __init__(self, minimum: int = OPENAI_MIN_CONCURRENCY, maximum: int = OPENAI_MAX_CONCURRENCY, cooldown: float = 2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.cooldown = cooldown
+        self.limit = float(self.maximum)
+        self._last_decrease = float("-inf")
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def on_success(self) -> None:
+        self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def on_throttled(self, now: float) -> None:
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._last_decrease = now
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the API asked us to wait, from `retry-after-ms` or `retry-after` (seconds or HTTP date)."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    """
+    Admission control in front of every gpt-4o call.
+
+    A call waits in a priority queue until it fits the adaptive concurrency
+    limit, the requests-per-minute bucket and the tokens-per-minute bucket
+    (charged with an estimate, corrected by the reported usage). Only the
+    head of the queue is considered, so bulk calls never take quota an
+    interactive call is waiting for. Retryable failures go back to the queue
+    after a jittered backoff, or after the server's Retry-After, keeping
+    their place in line; a 429 also halves the concurrency limit and holds
+    back every queued call until the Retry-After has passed.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = OPENAI_MAX_CONCURRENCY,
+        min_concurrency: int = OPENAI_MIN_CONCURRENCY,
+        rpm: float = OPENAI_RPM_LIMIT,
+        tpm: float = OPENAI_TPM_LIMIT,
+        max_retries: int = OPENAI_MAX_RETRIES,
+        retry_base: float = OPENAI_RETRY_BASE_SECONDS,
+        retry_max: float = OPENAI_RETRY_MAX_SECONDS,
+        hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+        hedge_window: int = LLM_HEDGE_WINDOW,
+        hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES
+    ):
+        self.concurrency = AdaptiveLimit(min_concurrency, max_concurrency)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        # Durations of recent successful calls, from admission to response
+        self.latencies = deque(maxlen=hedge_window)
+        self.in_flight = 0
+        # (priority rank, sequence number, future, estimated tokens)
+        self._waiting: List[tuple] = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failed = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    async def run(self, call: Callable[[], Awaitable[T]], estimated_tokens: int = 0, priority: Optional[str] = None) -> T:
+        """
+        Run `call()` once admitted, retrying retryable API errors; raises the last error.
+
+        Within a request deadline, waiting for admission, the call itself and
+        any retry backoff are all cut off at the deadline (DeadlineExceeded).
+        """
+        rank = PRIORITIES[priority or _priority.get()]
+        sequence = next(self._sequence)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._acquire(rank, sequence, estimated_tokens), deadlines.remaining())
+            except asyncio.TimeoutError:
+                raise deadlines.DeadlineExceeded("llm_queue", started=attempt > 0) from None
+            metrics.observe("llm_queue", time.perf_counter() - start)
+            call_start = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(call(), deadlines.remaining())
+            except asyncio.TimeoutError:
+                self.failed += 1
+                raise deadlines.DeadlineExceeded("llm", started=True) from None
+            except Exception as e:
+                delay = self._failed(e, attempt)
+                if delay is None:
+                    self.failed += 1
+                    raise
+                error = e
+            else:
+                self.calls += 1
+                self.latencies.append(time.perf_counter() - call_start)
+                self.concurrency.on_success()
+                usage = getattr(result, "usage", None)
+                if usage is not None and usage.total_tokens:
+                    self.tokens.take(usage.total_tokens - estimated_tokens)
+                return result
+            finally:
+                self._release()
+            left = deadlines.remaining()
+            if left is not None and delay >= left:
+                self.failed += 1
+                raise deadlines.DeadlineExceeded("llm_retry", started=True) from error
+            self.retries += 1
+            logging.warning(f"Retrying LLM call in {delay:.2f}s (attempt {attempt + 2} of {self.max_retries + 1})")
+            await asyncio.sleep(delay)
+
+    async def run_hedged(
+        self,
+        call: Callable[[], Awaitable[T]],
+        estimated_tokens: int = 0,
+        priority: Optional[str] = None
+    ) -> T:
+        """
+        Like `run`, but an interactive call still running after the
+        `hedge_percentile` latency of recent calls gets a duplicate; the
+        first to succeed wins and the other is cancelled.
+
+        Hedges are only sent while the scheduler has a free slot and nothing
+        waiting, so they never delay other calls or push past the rate limits.
+        """
+        priority = priority or _priority.get()
+        threshold = self.hedge_threshold()
+        if threshold is None or priority != "interactive":
+            return await self.run(call, estimated_tokens, priority)
+
+        primary = asyncio.create_task(self.run(call, estimated_tokens, priority))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=threshold)
+            if done or not self._has_spare_capacity():
+                return await primary
+            self.hedges += 1
+            hedge = asyncio.create_task(self.run(call, estimated_tokens, priority))
+            running = {primary, hedge}
+            while running:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Both failed: report the primary's error
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def hedge_threshold(self) -> Optional[float]:
+        """The `hedge_percentile` latency of recent calls, or None while hedging is off or warming up."""
+        if not self.hedge_percentile or len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))]
+
+    def _has_spare_capacity(self) -> bool:
+        return self.in_flight < self.concurrency.current and not any(not entry[2].cancelled() for entry in self._waiting)
+
+    def _failed(self, error: Exception, attempt: int) -> Optional[float]:
+        """Record a failed attempt; returns how long to wait before retrying, or None to give up."""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            return None
+        wait = retry_after(error)
+        if isinstance(error, openai.RateLimitError):
+            now = time.monotonic()
+            self.throttled += 1
+            self.concurrency.on_throttled(now)
+            if wait is not None:
+                # The quota is shared, so nothing else should go out before then either
+                self._paused_until = max(self._paused_until, now + wait)
+        if wait is not None:
+            # Spread the retries of calls throttled together over a little more than the asked wait
+            return min(wait, self.retry_max) * random.uniform(1.0, 1.2)
+        # Equal jitter: at least half the exponential backoff
+        backoff = min(self.retry_max, self.retry_base * 2 ** attempt)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    async def _acquire(self, rank: int, sequence: int, estimated_tokens: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (rank, sequence, future, estimated_tokens))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as the caller went away
+                self._release()
+            else:
+                self._dispatch()
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        while self._waiting:
+            _, _, future, estimated_tokens = self._waiting[0]
+            if future.cancelled():
+                heapq.heappop(self._waiting)
+                continue
+            if self.in_flight >= self.concurrency.current:
+                return
+            delay = max(
+                self._paused_until - now,
+                self.requests.delay(1, now),
+                self.tokens.delay(estimated_tokens, now),
+            )
+            if delay > 0:
+                self._schedule_wakeup(delay)
+                return
+            heapq.heappop(self._waiting)
+            self.requests.take(1)
+            self.tokens.take(estimated_tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float) -> None:
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def stats(self) -> Dict:
+        waiting = [entry for entry in self._waiting if not entry[2].cancelled()]
+        return {
+            "in_flight": self.in_flight,
+            "concurrency_limit": self.concurrency.current,
+            "waiting": {name: sum(1 for entry in waiting if entry[0] == rank) for name, rank in PRIORITIES.items()},
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 3),
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "failed": self.failed,
+            "hedge_threshold_seconds": self.hedge_threshold(),
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -4,27 +4,243 @@ from pydantic import BaseModel
 import pytz
 import asyncio
 import logging
-from typing import List, Dict
-from fastapi import FastAPI, HTTPException, File, UploadFile
+import time
+from typing import Callable, List, Dict, Optional, Tuple, Union
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+import orjson
 from PIL import Image
 import io
-from ultralytics import YOLO
+import numpy as np
 from dotenv import load_dotenv
 import utils
 import entity_extraction
 import freshness_classifier
-from openai import OpenAI
-import mysql.connector
+import inference_backends
+from openai import AsyncOpenAI
+import llm_cache
+import llm_client
+import llm_scheduler
+import persistence
+import detection_worker
+import metrics
+import deadlines
+import stream_tracking
+import single_flight
+import crop_store
+import uploads
+import image_pruning
+import model_server
 import re
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
 
-# Initialize FastAPI once
-app = FastAPI()
 load_dotenv()
 
+DATA_DIR = "Data"
+# "per_crop" sends one gpt-4o request per detection, "shelf" one request per image
+LLM_ANALYSIS_MODE = os.getenv("LLM_ANALYSIS_MODE", "per_crop")
+# Longest side (px) uploads are decoded at for the detector (JPEG draft mode picks
+# the nearest larger 1/2, 1/4 or 1/8 scale); 0 decodes at full resolution
+DETECTION_DECODE_SIDE = int(os.getenv("DETECTION_DECODE_SIDE", "1280"))
+# Longest side (px) of crops sent to the LLM; 0 keeps the detection resolution
+CROP_MAX_SIDE = int(os.getenv("CROP_MAX_SIDE", "1024"))
+CROP_JPEG_QUALITY = int(os.getenv("CROP_JPEG_QUALITY", "80"))
+# How crops the detector calls fresh produce are analyzed: "combined" (one call, sent at
+# packaged-goods size and detail, that also reads the label of a packaged item),
+# "speculative" (freshness and label OCR in parallel, OCR cancelled once the product is
+# named, but still billed) or "sequential" (label OCR only after the freshness call comes
+# back without a product name)
+PERISHABLE_ANALYSIS = os.getenv("PERISHABLE_ANALYSIS", "combined")
+# gpt-4o image `detail` per detector class: 0 is fresh produce, 1 is packaged goods
+CLASS_IMAGE_DETAIL = {
+    0: os.getenv("LLM_DETAIL_PERISHABLE", "low"),
+    1: os.getenv("LLM_DETAIL_PACKAGED", "high"),
+}
+# Dummy-image passes through the detector and classifier before reporting ready; 0 skips warmup
+WARMUP_RUNS = int(os.getenv("WARMUP_RUNS", "1"))
+WARMUP_IMAGE_SIZE = int(os.getenv("WARMUP_IMAGE_SIZE", "640"))
+# Open a database connection at startup instead of on the first write
+DB_WARMUP = os.getenv("DB_WARMUP", "1") == "1"
+# Attach a Server-Timing header with the stage breakdown to every response
+# (otherwise only when the request sends `X-Debug-Timings: 1`)
+STAGE_TIMING_HEADER = os.getenv("STAGE_TIMING_HEADER", "0") == "1"
+# How /analyze_group/ returns each crop unless the request asks (?crops=): "inline" (a base64
+# data URL in the JSON), "url" (a /crops/{id} link) or "none" (only the bbox; the client crops)
+RESPONSE_CROPS = os.getenv("RESPONSE_CROPS", "inline")
+CROP_MODES = ("inline", "url", "none")
+# Result statuses of work the request deadline cut off
+UNFINISHED_STATUSES = ("timed_out", "pending")
+
+# Loaded in the background by the lifespan; PyTorch, TorchScript or ONNX Runtime,
+# per DETECTOR_BACKEND / CLASSIFIER_BACKEND
+classifier_model = None
+obj_det_model = None
+
+# Per-component startup state reported by /readyz
+component_status = {
+    "detector": "pending",
+    "classifier": "pending",
+    "database": "pending",
+    "llm_client": "pending",
+}
+# Components that must be warm before the service reports ready
+REQUIRED_COMPONENTS = ["detector", "classifier"]
+_models_task = None
+_database_task = None
+
+# Cross-request micro-batching of YOLO predict calls on a dedicated thread
+# (late-bound so detect_objects_batch can be defined further down)
+detection_batcher = detection_worker.DetectionBatcher(lambda images: detect_objects_batch(images))
+
+def set_model_status(status: str) -> None:
+    component_status["detector"] = component_status["classifier"] = status
+
+
+# With MODEL_SERVER_SOCKET set, detection and classification run in the node's
+# model server (model_server.py) and this worker loads no models; /readyz follows
+# the connection, so a worker that lost the server is taken out of rotation
+model_server_client = (
+    model_server.ModelServerClient(on_status=set_model_status) if model_server.MODEL_SERVER_SOCKET else None
+)
+
+# Write-behind persistence: inserts are queued and written in batches off the event loop
+product_writer = persistence.create_writer()
+# Dashboard aggregates, read from the rollup the writer maintains
+product_reader = persistence.create_reader()
+
+# Identical uploads in flight at the same time share one analysis (and one set of rows)
+request_coalescer = single_flight.SingleFlight()
+
+# Encoded crops behind the /crops/{id} links of "url" mode responses
+crops_cache = crop_store.CropStore()
+
+metrics.register_gauge(
+    "image_app_detection_queue_depth", "Images waiting for the detection worker",
+    lambda: detection_batcher.stats()["queue_depth"]
+)
+metrics.register_gauge(
+    "image_app_llm_concurrency_limit", "Current adaptive limit on gpt-4o calls in flight",
+    lambda: llm_client.get_scheduler().concurrency.current
+)
+metrics.register_gauge(
+    "image_app_llm_waiting", "gpt-4o calls waiting for the scheduler",
+    lambda: sum(llm_client.get_scheduler().stats()["waiting"].values())
+)
+metrics.register_gauge(
+    "image_app_db_queue_depth", "ProductAnalysis rows waiting to be written",
+    lambda: product_writer.stats()["queued"] + product_writer.stats()["pending_retry"]
+)
+
+
+async def _load_component(name, loader):
+    component_status[name] = "loading"
+    try:
+        component = await asyncio.to_thread(loader)
+    except Exception:
+        component_status[name] = "error"
+        raise
+    component_status[name] = "loaded"
+    return component
+
+
+def warmup_models(runs: int = WARMUP_RUNS):
+    # Lets torch/ONNX Runtime pick kernels and allocate buffers before the first real request
+    dummy = Image.new('RGB', (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE), (127, 127, 127))
+    for _ in range(runs):
+        detect_objects_batch([dummy])
+        freshness_classifier.classify_images(
+            [dummy] * 4, classifier_model, device=freshness_classifier.device, threshold=0.9
+        )
+
+
+async def load_models():
+    """Load the detector and classifier in parallel, then warm them up."""
+    global classifier_model, obj_det_model
+    if model_server_client is not None:
+        set_model_status("connecting")
+        status = await model_server_client.connect()
+        set_model_status(status["models"])
+        if status["models"] != "warm":
+            raise RuntimeError(f"Model server models are {status['models']}")
+        return
+    obj_det_model, classifier_model = await asyncio.gather(
+        _load_component("detector", inference_backends.load_detector),
+        _load_component("classifier", inference_backends.load_classifier),
+    )
+    if WARMUP_RUNS > 0:
+        component_status["detector"] = component_status["classifier"] = "warming"
+        await asyncio.to_thread(warmup_models)
+    component_status["detector"] = component_status["classifier"] = "warm"
+
+
+async def connect_database():
+    component_status["database"] = "connecting"
+    try:
+        await product_writer.warmup()
+        # Rows are still written, without the columns and rollup the migration adds
+        component_status["database"] = "connected" if product_writer.schema_current else "schema outdated"
+    except Exception as e:
+        # Writes are queued and retried, so a database outage does not block startup
+        component_status["database"] = "error"
+        logging.error(f"Database warmup failed: {e}")
+
+
+async def ensure_models():
+    """Wait for the models to finish loading; requests that arrive during startup queue here."""
+    try:
+        await asyncio.shield(_models_task)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Models failed to load: {e}")
+
+
+def _log_model_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Model loading failed: {task.exception()}")
+
+
+def _log_database_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        component_status["database"] = "error"
+        logging.error(f"Database warmup failed: {task.exception()}", exc_info=task.exception())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _models_task, _database_task
+    await product_writer.start()
+    if model_server_client is None:
+        detection_batcher.start()
+    llm_client.get_client()
+    component_status["llm_client"] = "ready"
+
+    # Model loading and warmup run in the background so /healthz answers immediately
+    _models_task = asyncio.create_task(load_models())
+    _models_task.add_done_callback(_log_model_failure)
+    if DB_WARMUP:
+        # Kept referenced so it isn't garbage-collected mid-flight
+        _database_task = asyncio.create_task(connect_database())
+        _database_task.add_done_callback(_log_database_failure)
+    else:
+        component_status["database"] = "lazy"
+
+    yield
+
+    _models_task.cancel()
+    if _database_task is not None:
+        _database_task.cancel()
+    if model_server_client is not None:
+        await model_server_client.close()
+    await llm_client.close_client()
+    await product_writer.stop()
+    await asyncio.to_thread(detection_batcher.stop)
+
+
+# Initialize FastAPI once
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
 class ImageData(BaseModel):
     images: List[str] 
 class SingleImage(BaseModel):
@@ -37,41 +253,78 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  
     allow_headers=["*"], 
+    expose_headers=["Server-Timing", "X-Upload-Peak-Bytes"],
 )
-classifier_model = freshness_classifier.get_classifier_model()
-obj_det_model = YOLO("ml_models/yolov11m_30k_10ep.pt")  # Ensure correct path and model
-DATA_DIR = "Data"
 
-try:
-    connection = mysql.connector.connect(
-            host=os.getenv("db_host"),  
-            user=os.getenv("db_user"),     
-            password=os.getenv("db_password"),
-            database='flipkart'  
-        )
-    if connection.is_connected():
-            print("Connected to AWS RDS")
-except Exception as e:
-        print(f"Error: {e}")
+
+@app.middleware("http")
+async def record_stage_timings(request: Request, call_next):
+    # Every span inside this request (including its child tasks) lands in `timings`
+    timings = metrics.start_request()
+    start = time.perf_counter()
+    response = await call_next(request)
+    if STAGE_TIMING_HEADER or request.headers.get("x-debug-timings") == "1":
+        timings["total"] = [time.perf_counter() - start]
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+
+@app.middleware("http")
+async def report_upload_memory(request: Request, call_next):
+    # Peak bytes the request held for its images: body buffers, encoded images and the decoded frame
+    tracker = uploads.track_memory()
+    response = await call_next(request)
+    if tracker.peak:
+        metrics.UPLOAD_PEAK_BYTES.labels(request.url.path).observe(tracker.peak)
+        response.headers["X-Upload-Peak-Bytes"] = str(tracker.peak)
+    return response
+
+
+@app.middleware("http")
+async def assign_deadline(request: Request, call_next):
+    # Latency budget in seconds from `X-Request-Timeout` or `?timeout=`, else REQUEST_TIMEOUT_SECONDS;
+    # LLM calls still running at the deadline are cut off and reported as timed_out/pending
+    deadlines.start(
+        deadlines.parse_timeout(request.headers.get("x-request-timeout"))
+        or deadlines.parse_timeout(request.query_params.get("timeout"))
+    )
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def assign_llm_priority(request: Request, call_next):
+    # Back-fill clients send `X-LLM-Priority: bulk` so their calls queue behind interactive traffic
+    priority = request.headers.get("x-llm-priority")
+    if priority in llm_scheduler.PRIORITIES:
+        llm_scheduler.set_priority(priority)
+    return await call_next(request)
+
+
+@app.get("/metrics", summary="Prometheus metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/healthz", summary="Liveness: the process is up and serving")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz", summary="Readiness: every required component is loaded and warm")
+async def readyz():
+    ready = all(component_status[name] == "warm" for name in REQUIRED_COMPONENTS)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "components": component_status}
+    )
 
 # Set timezone
 kolkata_tz = pytz.timezone('Asia/Kolkata')
 
 def insert_into_product_analysis(data):
-    keys = [
-        "brand_name", "brand_details", "pack_size", "expiry_date",
-        "mrp", "product_name", "item_count", "category", "estimated_shelf_life_days"
-    ]
-    values = tuple(data.get(key, None) for key in keys)
-    query = """
-    INSERT INTO ProductAnalysis 
-    (brand_name, brand_details, pack_size, expiry_date, mrp, product_name, item_count, category, estimated_shelf_life_days)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """
-    cursor = connection.cursor()
-    cursor.execute(query, values)
-    connection.commit()
-    print("Inserted into ProductAnalysis")
+    # Only enqueues the row; the writer batches it into the next executemany/commit
+    product_writer.submit(data)
 
 
 def parse_date_or_days(input_text):
@@ -92,68 +345,192 @@ def parse_date_or_days(input_text):
     return None
 
 
-## NOTE : uncomment first three lines and commnet until the first exception block 
+async def detect(pil_image: Image.Image) -> List[Dict]:
+    """Detections of one frame, batched with concurrent requests (in the model server, if configured)."""
+    if model_server_client is not None:
+        return await model_server_client.detect(pil_image)
+    return await detection_batcher.detect(pil_image)
 
-@app.post("/analyze_group/")
-async def analyze_group(b64_image:SingleImage):
-    header, encoded = b64_image.image.split(",", 1)
-    image_data = base64.b64decode(encoded)
-    pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
 
-# async def analyze_image(images: List[UploadFile] = File(...)):
-#     if not images:
-#         raise HTTPException(status_code=400, detail="No image uploaded")
-    
-#     image = images[0]  # Process the first image in the list
+async def classify_crops(crops: List[np.ndarray], threshold: float = 0.9) -> List[tuple]:
+    """Freshness (label, probability) of each crop in one forward pass, off the event loop."""
+    if model_server_client is not None:
+        return await model_server_client.classify(crops, threshold)
+    return await asyncio.to_thread(
+        freshness_classifier.classify_images,
+        crops,
+        classifier_model,
+        device=freshness_classifier.device,
+        threshold=threshold
+    )
+
+
+def detect_objects_batch(pil_images: List[Image.Image]) -> List[List[Dict]]:
+    """
+    Run the detector on several images in one predict call and return the detections of each.
+
+    Images are PIL images or, in the model server, BGR uint8 arrays.
+    """
+    res = obj_det_model.predict(
+        source=pil_images,
+        conf=0.25,  # Confidence threshold
+        iou=0.5,    # IoU threshold for NMS
+        max_det=20 ,  # Maximum number of detections per image
+        agnostic_nms=True,
+        verbose=False
+    )
+    return [extract_detections(result, utils.image_size(image)) for result, image in zip(res, pil_images)]
+
+
+def detect_objects(pil_image: Image.Image) -> List[Dict]:
+    return detect_objects_batch([pil_image])[0]
+
+
+def extract_detections(result, image_size: Tuple[int, int]) -> List[Dict]:
+    logging.debug(f"Number of detections: {len(result)}")
+
+    # Pull every box out of the result in one device-to-host transfer
+    boxes = result.boxes
+    xyxy = boxes.xyxy.cpu().numpy()  # Bounding box coordinates
+    confs = boxes.conf.cpu().numpy()  # Confidence scores
+    class_ids = boxes.cls.cpu().numpy().astype(int)
+
+    # Clip all boxes to the image bounds at once
+    img_width, img_height = image_size
+    xyxy = np.clip(xyxy, 0, [img_width, img_height, img_width, img_height])
+    # Detection format: [xmin, ymin, width, height]
+    bboxes = np.column_stack([xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2]]).astype(int)
+
+    detections = [
+        {
+            "bbox": bbox.tolist(),
+            "confidence": float(conf),
+            "class_id": int(class_id),
+            "class_name": obj_det_model.names[int(class_id)]
+        }
+        for bbox, conf, class_id in zip(bboxes, confs, class_ids)
+    ]
+    logging.debug(f"Detections: {detections}")
+    return detections
+
+
+@app.post("/analyze_group/", openapi_extra=uploads.openapi_body(SingleImage))
+async def analyze_group(request: Request, crops: Optional[str] = None):
+    """
+    Detect and analyze every product in one image.
+
+    The image comes as a binary body (application/octet-stream or image/*),
+    as a multipart file or, as before, as a base64 data URL in a JSON body.
+    """
+    crops = response_crop_mode(crops)
+    with metrics.span("upload"):
+        image_data = (await uploads.read_images(request, "image"))[0]
+
+    # The same image posted again while it is being analyzed (scanner retries)
+    # shares this computation, its result and its inserted rows
+    # Only requests with the same latency budget share results
+    analysis_results, shared = await request_coalescer.run(
+        ("analyze_group", single_flight.content_key(image_data), deadlines.budget()),
+        lambda: analyze_image_data(image_data),
+        reusable=is_complete
+    )
+    if shared:
+        metrics.COALESCED_REQUESTS.labels("analyze_group").inc()
+    return ORJSONResponse(content=[present_crop(result, crops) for result in analysis_results])
+
+
+def response_crop_mode(requested: Optional[str]) -> str:
+    mode = requested or RESPONSE_CROPS
+    if mode not in CROP_MODES:
+        raise HTTPException(status_code=400, detail=f"crops must be one of {', '.join(CROP_MODES)}")
+    return mode
+
+
+def present_crop(result: Dict, mode: str) -> Dict:
+    """
+    A result as returned to the client, with its crop inline, as a /crops/ link or left out.
+
+    Results may be shared by coalesced requests, so a copy is returned
+    instead of changing `result`.
+    """
+    data_url = result.get("base64_image")
+    if mode == "inline" or "base64_image" not in result:
+        return result
+    presented = {key: value for key, value in result.items() if key != "base64_image"}
+    if mode == "url" and data_url:
+        crop_id = crops_cache.put(base64.b64decode(data_url.split(",", 1)[1]))
+        presented["crop_url"] = f"/crops/{crop_id}"
+    return presented
+
+
+@app.get("/crops/{crop_id}", summary="A crop referenced by a `crops=url` analysis response")
+async def get_crop(crop_id: str):
+    data = crops_cache.get(crop_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Crop not found or expired")
+    # Ids are content hashes, so the bytes behind one never change
+    return Response(
+        content=data,
+        media_type="image/jpeg",
+        headers={
+            "Cache-Control": f"private, max-age={int(crops_cache.ttl_seconds)}, immutable",
+            "ETag": f'"{crop_id}"',
+        }
+    )
 
-#     try:
-#         # Read the image bytes
-#         image_bytes = await image.read()
-        
-#         # Open the image using PIL for processing
-#         pil_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-#     except Exception as e:
-#         raise HTTPException(status_code=400, detail=f"Failed to read image file: {e}")
 
+async def detect_upload(image_data: bytes) -> Tuple[List[Dict], List[np.ndarray]]:
+    """
+    Detect the products in an uploaded image and decode their crops.
+
+    The detector gets a reduced-resolution decode (DETECTION_DECODE_SIDE), and
+    the crops are decoded at no more resolution than they are sent to the LLM
+    at, so large phone photos are only decoded at full size when a crop
+    needs it. Returned bboxes are in full-resolution coordinates.
+    """
+    with metrics.span("decode"):
+        try:
+            pil_image, full_size = utils.decode_for_detection(image_data, DETECTION_DECODE_SIDE)
+        except (OSError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    uploads.hold(pil_image.width * pil_image.height * len(pil_image.getbands()))
 
+    await ensure_models()
     try:
-        res = obj_det_model.predict(
-            source=pil_image,
-            conf=0.25,  # Confidence threshold
-            iou=0.5,    # IoU threshold for NMS
-            max_det=20 ,  # Maximum number of detections per image
-            agnostic_nms=True
-        )
-        logging.debug(f"Number of detections: {len(res[0])}")
-        
-        # Extract detections using your custom method
-        detections = []
-        for box in res[0].boxes:
-            xyxy = box.xyxy[0].cpu().numpy()  # Bounding box coordinates
-            conf = box.conf[0].cpu().numpy()  # Confidence score
-            class_id = int(box.cls[0])
-            class_name = obj_det_model.names[class_id]
-            # Detection format: [xmin, ymin, width, height]
-            x1, y1, x2, y2 = xyxy
-            w = x2 - x1
-            h = y2 - y1
-            detections.append({
-                "bbox": [int(x1), int(y1), int(w), int(h)],
-                "confidence": float(conf),
-                "class_id": class_id,
-                "class_name": class_name
-            })
-        logging.debug(f"Detections: {detections}")
+        # Batched with concurrent requests on the detection worker thread
+        with metrics.span("detect"):
+            detections = await asyncio.wait_for(detect(pil_image), deadlines.remaining())
+        metrics.DETECTIONS_PER_IMAGE.observe(len(detections))
+    except asyncio.TimeoutError:
+        # Nothing to return partially before the detector has run
+        raise HTTPException(status_code=504, detail="Deadline exceeded before object detection finished")
     except Exception as e:
         logging.error(f"Object Detection Error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Object detection failed: {e}")
+    detections = utils.scale_detections(detections, pil_image.size, full_size)
+
+    with metrics.span("crop"):
+        crops = await asyncio.to_thread(
+            utils.decode_crops,
+            image_data,
+            detections,
+            [crop_decode_side(det['class_id']) for det in detections],
+            pil_image
+        )
+    return detections, crops
+
+
+async def analyze_image_data(image_data: bytes) -> List[Dict]:
+    """Detect, analyze and persist every product in one uploaded image."""
+    detections, crops = await detect_upload(image_data)
 
     analysis_results = []
     try:
         analysis_results = await process_detections_with_clients(
-            clients=[OpenAI(api_key=os.getenv("OPENAI_API_KEY")) for _ in range(len(detections))], 
+            client=llm_client.get_client(), 
             detections=detections, 
-            pil_image=pil_image, 
+            pil_image=None, 
+            crops=crops,
         )
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
@@ -164,84 +541,557 @@ async def analyze_group(b64_image:SingleImage):
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
     # Return the list of analysis results as a JSON response
-    print("data",analysis_results)
-    for i in analysis_results:
-        if "expiry_date" in i:
-            i["expiry_date"]=parse_date_or_days(i["expiry_date"])
-        insert_into_product_analysis(i)
-    return JSONResponse(content=analysis_results)
-
-
-
-## NOTE : uncomment the till base64 part and comment till finallty block
-@app.post("/multi_image_ocr/", summary="Upload images and process them")
-async def upload_image(data: ImageData):
-    base64_images = []
-    for index, image_base64 in enumerate(data.images):
-        base64_images.append(image_base64)
-# async def upload_images(files: List[UploadFile]= File(...)): #->Dict :
-#     base64_images = []
-#     for file in files:
-#         # Validate the file type (optional but recommended)
-#         if not file.content_type.startswith("image/"):
-#             raise HTTPException(
-#                 status_code=400, 
-#                 detail=f"Invalid file type: {file.filename}. Only image files are allowed."
-#             )
-        
-#         try:
-#             # Read the file content
-#             contents = await file.read()
-#             image = Image.open(io.BytesIO(contents))
-#             image.verify()  # This will raise an exception if the image is not valid
-#             base64_str = base64.b64encode(contents).decode('utf-8')
-#             base64_images.append(base64_str)
-#         except Exception as e:
-#             raise HTTPException(
-#                 status_code=400, 
-#                 detail=f"Failed to process file {file.filename}: {str(e)}"
-#             )
-#         finally:
-#             await file.close()
-    data= entity_extraction.ocr_mulitple_images(base64_images , OpenAI(api_key=os.getenv("OPENAI_API_KEY")))
+    persist_results(analysis_results)
+    return analysis_results
+
+
+@app.post(
+    "/analyze_group/stream",
+    summary="Like /analyze_group/, streaming each result as soon as it is ready",
+    openapi_extra=uploads.openapi_body(SingleImage)
+)
+async def analyze_group_stream(request: Request, crops: Optional[str] = None):
+    """
+    Stream the analysis of one shelf image as NDJSON, or as Server-Sent
+    Events when the request accepts `text/event-stream`.
+
+    Records, in order: one "detections" record right after the detector, one
+    "result" record per detection in completion order (with its `index` in
+    the detections list), and a closing "summary" record. Under a request
+    deadline, detections left unanalyzed come as results with a `status` of
+    "timed_out" or "pending". The image and `crops` are taken as for /analyze_group/.
+    """
+    crops_mode = response_crop_mode(crops)
+    with metrics.span("upload"):
+        image_data = (await uploads.read_images(request, "image"))[0]
+    detections, crops = await detect_upload(image_data)
+
+    use_sse = "text/event-stream" in request.headers.get("accept", "")
+
+    def format_record(record: Dict) -> bytes:
+        payload = orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY)
+        if use_sse:
+            return f"event: {record['type']}\ndata: ".encode() + payload + b"\n\n"
+        return payload + b"\n"
+
+    async def records():
+        start = time.perf_counter()
+        first_result_seconds = None
+        errors = 0
+        unfinished = {"timed_out": 0, "pending": 0}
+        ready: asyncio.Queue = asyncio.Queue()
+        yield format_record({"type": "detections", "count": len(detections), "detections": detections})
+
+        task = asyncio.create_task(process_detections_with_clients(
+            client=llm_client.get_client(),
+            detections=detections,
+            pil_image=None,
+            on_result=lambda index, result: ready.put_nowait((index, result)),
+            crops=crops,
+        ))
+        received = 0
+        try:
+            while received < len(detections):
+                getter = asyncio.ensure_future(ready.get())
+                await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    if task.exception() is not None:
+                        logging.error(f"Image Analysis Error: {task.exception()}", exc_info=task.exception())
+                        yield format_record({"type": "error", "error": f"Internal server error: {task.exception()}"})
+                        break
+                    continue
+                index, result = getter.result()
+                received += 1
+                if first_result_seconds is None:
+                    first_result_seconds = time.perf_counter() - start
+                errors += "error" in result
+                if result.get("status") in unfinished:
+                    unfinished[result["status"]] += 1
+                persist_results([result])
+                yield format_record({"type": "result", "index": index, **present_crop(result, crops_mode)})
+        finally:
+            # Only still running if the client went away; stop paying for the remaining LLM calls
+            task.cancel()
+
+        yield format_record({
+            "type": "summary",
+            "detections": len(detections),
+            "errors": errors,
+            **unfinished,
+            "first_result_seconds": first_result_seconds,
+            "total_seconds": time.perf_counter() - start,
+        })
+
+    return StreamingResponse(
+        records(),
+        media_type="text/event-stream" if use_sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+def is_complete(results: Union[Dict, List[Dict]]) -> bool:
+    """Whether no part of a result was cut off by the deadline (and a retry could get more)."""
+    if isinstance(results, dict):
+        results = [results]
+    return not any(result.get("status") in UNFINISHED_STATUSES for result in results)
+
+
+def persist_results(analysis_results: List[Dict]) -> None:
+    with metrics.span("persist"):
+        for i in analysis_results:
+            if i.get("status") in UNFINISHED_STATUSES:
+                continue
+            if "expiry_date" in i:
+                i["expiry_date"]=parse_date_or_days(i["expiry_date"])
+            insert_into_product_analysis(i)
+
+
+async def analyze_tracked_product(client: AsyncOpenAI, product: stream_tracking.TrackedProduct) -> Dict:
+    """Analyze one tracked product on its best crop, with the same pipeline as a still image."""
+    height, width = product.best_crop.shape[:2]
+    detection = {**product.detection, "bbox": [0, 0, width, height]}
+    results = await process_detections_with_clients(
+        client=client,
+        detections=[detection],
+        pil_image=Image.fromarray(product.best_crop),
+        analysis_mode="per_crop",
+    )
+    return {
+        "track_id": product.track_id,
+        "first_frame": product.first_frame,
+        "last_frame": product.last_frame,
+        "frames_seen": product.frames_seen,
+        **results[0]
+    }
+
+
+@app.websocket("/analyze_stream/")
+async def analyze_stream(websocket: WebSocket):
+    """
+    Analyze a live frame stream, e.g. a conveyor or a shelf walk-through.
+
+    The client sends frames as binary JPEG/PNG messages or as base64 data
+    URLs, then the text message "end". Frames nearly identical to the last
+    processed one are skipped; the rest go through the shared detector and a
+    tracker owned by this connection. Every tracked product is analyzed once,
+    on its best crop, when it leaves the view (or the stream ends), so LLM
+    calls scale with unique products rather than frames.
+
+    Messages sent back:
+        {"type": "frame", "frame": n, "skipped": bool, "tracks": [...]}
+        {"type": "product", "track_id": id, ...analysis}
+        {"type": "error", "frame": n, "error": "..."}
+        {"type": "summary", "frames_received": ..., "products_analyzed": ...}
+    """
+    await websocket.accept()
+    try:
+        await ensure_models()
+    except HTTPException as e:
+        await websocket.close(code=1011, reason=str(e.detail)[:120])
+        return
+
+    client = llm_client.get_client()
+    deduplicator = stream_tracking.FrameDeduplicator()
+    tracker = stream_tracking.ProductTracker()
+    counters = {"frames_received": 0, "frames_processed": 0, "frames_skipped": 0, "products_analyzed": 0}
+    # A single sender task owns the socket; frame handling and analyses only enqueue
+    outbox: asyncio.Queue = asyncio.Queue()
+    analysis_tasks = set()
+
+    async def sender():
+        while (message := await outbox.get()) is not None:
+            await websocket.send_json(message)
+
+    async def analyze(product: stream_tracking.TrackedProduct):
+        try:
+            result = await analyze_tracked_product(client, product)
+            persist_results([result])
+        except Exception as e:
+            logging.error(f"Error analyzing track {product.track_id}: {e}", exc_info=True)
+            result = {"track_id": product.track_id, "analysis": None, "error": str(e)}
+        counters["products_analyzed"] += 1
+        outbox.put_nowait({"type": "product", **result})
+
+    def schedule(products):
+        for product in products:
+            task = asyncio.create_task(analyze(product))
+            analysis_tasks.add(task)
+            task.add_done_callback(analysis_tasks.discard)
+
+    sender_task = asyncio.create_task(sender())
+    disconnected = False
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            disconnected = True
+            break
+        if message.get("text") is not None:
+            if message["text"].strip() == "end":
+                break
+            payload = message["text"]
+        else:
+            payload = message.get("bytes")
+
+        counters["frames_received"] += 1
+        frame_number = counters["frames_received"]
+        try:
+            with metrics.span("decode"):
+                if isinstance(payload, str):
+                    payload = base64.b64decode(payload.split(",", 1)[-1])
+                pil_image = Image.open(io.BytesIO(payload)).convert('RGB')
+            if deduplicator.is_duplicate(pil_image):
+                counters["frames_skipped"] += 1
+                outbox.put_nowait({"type": "frame", "frame": frame_number, "skipped": True})
+                continue
+            with metrics.span("detect"):
+                detections = await detect(pil_image)
+            with metrics.span("track"):
+                tracks = await asyncio.to_thread(tracker.update, np.asarray(pil_image), detections)
+        except Exception as e:
+            logging.error(f"Error processing stream frame {frame_number}: {e}", exc_info=True)
+            outbox.put_nowait({"type": "error", "frame": frame_number, "error": str(e)})
+            continue
+        counters["frames_processed"] += 1
+        outbox.put_nowait({"type": "frame", "frame": frame_number, "skipped": False, "tracks": tracks})
+        schedule(tracker.finished_tracks())
+
+    # Products still in view at the end of the stream get their analysis too
+    schedule(tracker.finished_tracks(flush=True))
+    if analysis_tasks:
+        await asyncio.gather(*analysis_tasks)
+    if disconnected:
+        sender_task.cancel()
+        return
+    outbox.put_nowait({
+        "type": "summary",
+        **counters,
+        "products_tracked": len(tracker.tracks) + len(tracker.released_ids),
+    })
+    outbox.put_nowait(None)
+    await sender_task
+    await websocket.close()
+
+
+
+@app.get("/cache_stats/", summary="Hit/miss counters of the LLM analysis cache")
+async def cache_stats():
+    return llm_cache.stats()
+
+
+@app.get("/detection_stats/", summary="Queue depth and batch sizes of the detection worker")
+async def detection_stats():
+    if model_server_client is not None:
+        return (await model_server_client.stats())["detection"]
+    return detection_batcher.stats()
+
+
+@app.get("/llm_stats/", summary="Concurrency limit, queue and retry counters of the LLM scheduler")
+async def llm_stats():
+    return llm_client.get_scheduler().stats()
+
+
+async def read_stats(query: Callable, *args):
+    # Off the event loop; a 503 when every database connection stays busy
+    try:
+        return await asyncio.to_thread(query, *args)
+    except TimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.get("/stats/expiring/", summary="Products expiring in a month (default: the current one), paginated")
+async def expiring_products(
+    month: Optional[str] = Query(None, pattern=r"^\d{4}-(0[1-9]|1[0-2])$", description="YYYY-MM"),
+    limit: int = Query(50, ge=1, le=500),
+    after_id: int = Query(0, ge=0, description="`next_after_id` of the previous page")
+):
+    month = month or datetime.now(kolkata_tz).strftime("%Y-%m")
+    return await read_stats(product_reader.expiring, month, limit, after_id)
+
+
+@app.get("/stats/counts/{dimension}", summary="Product counts per category, brand_name, state or expiry_month")
+async def product_counts(
+    dimension: str,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="`next_cursor` of the previous page")
+):
+    if dimension not in persistence.ROLLUP_DIMENSIONS:
+        raise HTTPException(status_code=404, detail=f"dimension must be one of {', '.join(persistence.ROLLUP_DIMENSIONS)}")
+    try:
+        return await read_stats(product_reader.counts, dimension, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/stats/freshness/", summary="Fresh and rotten perishables and the rotten share")
+async def freshness_stats():
+    fresh, rotten = await asyncio.gather(
+        read_stats(product_reader.count, "state", "fresh"),
+        read_stats(product_reader.count, "state", "rotten")
+    )
+    return {"fresh": fresh, "rotten": rotten, "rotten_share": rotten / (fresh + rotten) if fresh + rotten else None}
+
+
+@app.post(
+    "/multi_image_ocr/",
+    summary="Upload images and process them",
+    openapi_extra=uploads.openapi_body(ImageData, multiple=True)
+)
+async def upload_image(request: Request):
+    """
+    Read the product details off several photos of one product.
+
+    The images come as multipart files or, as before, as base64 data URLs
+    in a JSON body.
+    """
+    with metrics.span("upload"):
+        images = await uploads.read_images(request, "images", max_images=uploads.UPLOAD_MAX_IMAGES)
+    data, shared = await request_coalescer.run(
+        (
+            "multi_image_ocr",
+            single_flight.content_key(*images),
+            deadlines.budget()
+        ),
+        lambda: ocr_and_persist(images),
+        reusable=is_complete
+    )
+    if shared:
+        metrics.COALESCED_REQUESTS.labels("multi_image_ocr").inc()
+    return data
+
+
+async def ocr_and_persist(images: List[bytes]) -> Dict:
+    # Hashing and re-encoding decode every image, so keep them off the event loop
+    with metrics.span("image_pruning"):
+        try:
+            pruned = await asyncio.to_thread(image_pruning.prune_images, images)
+        except (OSError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    try:
+        data= await entity_extraction.ocr_mulitple_images(pruned.urls , llm_client.get_client(), pruned.details)
+    except deadlines.DeadlineExceeded as e:
+        return {"status": "timed_out" if e.started else "pending"}
+    if data is None:
+        raise HTTPException(status_code=502, detail="OCR extraction failed")
     if "expiry_date" in data:
             data["expiry_date"]=parse_date_or_days(data["expiry_date"])
     insert_into_product_analysis(data)
+    # Reported only; not columns of product_analysis
+    data["images_dropped"] = pruned.dropped
+    data["estimated_tokens_saved"] = pruned.tokens_saved
     return data
     
 
 
+def crop_max_side(class_id: int) -> Optional[int]:
+    """Longest side (px) crops of this class are sent to the LLM at; None keeps the detection resolution."""
+    max_side = CROP_MAX_SIDE
+    if CLASS_IMAGE_DETAIL.get(class_id, "auto") == "low":
+        # The API downsizes low-detail images to 512px anyway, so don't upload more
+        max_side = min(max_side, 512) if max_side else 512
+    return max_side or None
+
+
+def crop_decode_side(class_id: int) -> Optional[int]:
+    """
+    Longest side (px) crops of this class are decoded at.
+
+    Fresh-produce crops may turn out to be packaged goods whose label is
+    read at the packaged-goods size, so they are decoded at that size and
+    only shrunk for the low-detail freshness call by `encode_crop`.
+    """
+    if class_id == 0:
+        return crop_max_side(1)
+    return crop_max_side(class_id)
+
+
+def encode_crop(cropped_image: np.ndarray, filename: str, class_id: int) -> Dict:
+    """
+    Encode a crop for the LLM with the size, quality and detail level configured for its class.
+
+    Returns a dict with the data URL, the `detail` level to request, the
+    encoded JPEG size in bytes and the estimated image tokens it will cost.
+    """
+    detail = CLASS_IMAGE_DETAIL.get(class_id, "auto")
+    max_side = crop_max_side(class_id)
+
+    with metrics.span("encode"):
+        base64_url, encoded_bytes, (width, height) = utils.encode_image_for_llm(
+            cropped_image, filename, max_side=max_side, quality=CROP_JPEG_QUALITY
+        )
+    estimated_tokens = utils.estimate_image_tokens(width, height, detail)
+    logging.debug(f"Encoded {filename}: {width}x{height}, {encoded_bytes} bytes, ~{estimated_tokens} image tokens ({detail})")
+    return {
+        "url": base64_url,
+        "detail": detail,
+        "encoded_bytes": encoded_bytes,
+        "estimated_image_tokens": estimated_tokens,
+    }
+
+
+async def analyze_perishable_crop(
+    client: AsyncOpenAI,
+    cropped_image: np.ndarray,
+    filename: str,
+    encoded: Dict,
+    classification: Optional[tuple] = None,
+    mode: str = PERISHABLE_ANALYSIS
+) -> Tuple[Dict, Dict]:
+    """
+    Analyze a class-0 crop, falling back to label OCR when it is a packaged product.
+
+    Returns the analysis and the encoding it was made from (the
+    packaged-goods one when the OCR result is used, and always for
+    "combined", whose single call may have to read a label). "combined" and
+    "speculative" both take one LLM round-trip; "sequential" takes two
+    whenever the freshness call cannot name the product.
+    """
+    def freshness(encoded: Dict, combined: bool = False):
+        return entity_extraction.perishable_analyze(
+            base64_image=encoded["url"],
+            client=client,
+            classifier_model=classifier_model,
+            image=cropped_image,
+            device=freshness_classifier.device,
+            threshold=0.9,
+            classification=classification,
+            detail=encoded["detail"],
+            combined=combined
+        )
+
+    async def label_ocr(ocr_encoded: Dict):
+        analysis = await entity_extraction.perform_ocr_extraction(
+            base64_image=ocr_encoded["url"],
+            openai_client=client,
+            detail=ocr_encoded["detail"]
+        )
+        if analysis is None:
+            raise RuntimeError("Label OCR failed")
+        return analysis
+
+    if mode == "combined":
+        combined_encoded = encode_crop(cropped_image, filename, 1)
+        analysis = await freshness(combined_encoded, combined=True)
+        if 'error' in analysis:
+            raise RuntimeError(analysis['error'])
+        return analysis, combined_encoded
+
+    # Label OCR needs the packaged-goods encoding
+    if mode == "speculative":
+        ocr_encoded = encode_crop(cropped_image, filename, 1)
+        ocr_task = asyncio.create_task(label_ocr(ocr_encoded))
+        # A discarded OCR call that failed anyway shouldn't log "exception never retrieved"
+        ocr_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            analysis = await freshness(encoded)
+        except BaseException:
+            ocr_task.cancel()
+            raise
+        if analysis.get('product_name'):
+            # Releases its concurrency slot, or aborts the request if it was already sent
+            ocr_task.cancel()
+            return analysis, encoded
+        return await ocr_task, ocr_encoded
+
+    analysis = await freshness(encoded)
+    if analysis.get('product_name'):
+        return analysis, encoded
+    ocr_encoded = encode_crop(cropped_image, filename, 1)
+    return await label_ocr(ocr_encoded), ocr_encoded
+
+
 async def process_detections_with_clients(
-    clients: List[OpenAI],
+    client: AsyncOpenAI,
     detections: List[Dict],
-    pil_image: Image.Image,
+    pil_image: Optional[Image.Image],
+    analysis_mode: str = LLM_ANALYSIS_MODE,
+    on_result: Optional[Callable[[int, Dict], None]] = None,
+    crops: Optional[List[np.ndarray]] = None,
+    classifications: Optional[Dict[int, tuple]] = None,
 ) -> List[Dict]:
+    """
+    Crop, classify and analyze every detection of one shelf image.
+
+    With analysis_mode "per_crop" every crop gets its own gpt-4o call. With
+    "shelf" all crops go out in one multi-image call, and only crops whose
+    entry comes back empty fall back to a per-crop call.
+
+    `on_result(index, result)`, if given, is called as each detection's
+    result is ready (index is 0-based in `detections`), before the others finish.
+
+    Under a request deadline (see deadlines.py), a detection whose LLM call
+    was cut off gets a {"detection", "status": "timed_out"} entry, and one
+    whose call never got sent a "pending" entry, so the caller can return
+    what finished in time.
+
+    Callers that already cropped the detections (detect_upload's
+    reduced-resolution decode, bulk_ingest's worker processes) pass `crops`,
+    and optionally `classifications` ({detection index: (label, probability)}),
+    and may leave `pil_image` as None.
+    """
 
     analysis_results = []
-    client_queue = asyncio.Queue()
 
-    # Populate the queue with clients
-    for client in clients:
-        await client_queue.put(client)
+    # Crop every detection up front, as views of one decoded frame, so all
+    # perishable crops can be classified together
+    if crops is None:
+        with metrics.span("crop"):
+            frame = np.asarray(pil_image)
+            crops = utils.crop_detections(frame, detections)
+    perishable_indices = [i for i, det in enumerate(detections) if det['class_id'] == 0 and crops[i].size]
+    precomputed = classifications
+    classifications = dict(precomputed or {})
+    classify_timed_out = False
+    if precomputed is None and perishable_indices:
+        try:
+            # One batched forward pass for the whole shelf, off the event loop
+            with metrics.span("classify"):
+                batch_results = await asyncio.wait_for(
+                    classify_crops([crops[i] for i in perishable_indices], threshold=0.9),
+                    deadlines.remaining()
+                )
+            classifications = dict(zip(perishable_indices, batch_results))
+        except asyncio.TimeoutError:
+            # Out of time: leave the perishable crops pending rather than classify them one by one
+            classify_timed_out = True
+        except Exception as e:
+            # Fall back to per-crop classification inside perishable_analyze
+            logging.error(f"Batched freshness classification failed: {e}", exc_info=True)
+
+    # In shelf mode, analyze every encodable crop in one structured-output call
+    shelf_results = [None] * len(detections)
+    crop_encodings = {}
+    shelf_timeout: Optional[deadlines.DeadlineExceeded] = None
+    if analysis_mode == "shelf" and detections:
+        for index, cropped_image in enumerate(crops, start=1):
+            try:
+                crop_encodings[index] = encode_crop(cropped_image, f"{index}.jpg", detections[index - 1]['class_id'])
+            except Exception as e:
+                logging.error(f"Failed to encode crop {index}: {e}", exc_info=True)
+        shelf_indices = list(crop_encodings)
+        try:
+            entries = await entity_extraction.analyze_shelf(
+                [crop_encodings[i]["url"] for i in shelf_indices],
+                [detections[i - 1]['class_id'] for i in shelf_indices],
+                openai_client=client,
+                details=[crop_encodings[i]["detail"] for i in shelf_indices]
+            )
+        except deadlines.DeadlineExceeded as e:
+            # No time left for per-crop fallbacks; every crop of the shelf call reports the timeout
+            shelf_timeout = e
+            entries = []
+        for i, entry in zip(shelf_indices, entries):
+            shelf_results[i - 1] = entry
 
     # Use enumerate to assign sequential numbers starting from 1
     async def analyze_detection(det: Dict, index: int) -> None:
         nonlocal analysis_results
-        client = await client_queue.get()
         try:
-            x, y, w, h = det["bbox"]
             class_id = det['class_id']
             conf = det['confidence']
             class_name = det['class_name']
-            # Ensure bounding box is within image bounds
-            img_width, img_height = pil_image.size
-            x = max(0, x)
-            y = max(0, y)
-            w = min(w, img_width - x)
-            h = min(h, img_height - y)
 
-            # Crop the image using PIL
-            cropped_image = pil_image.crop((x, y, x + w, y + h))
+            cropped_image = crops[index - 1]
 
             # Save cropped image to Data/ directory with sequential filename
             filename = f"{index}.jpg"
@@ -249,65 +1099,33 @@ async def process_detections_with_clients(
             # cropped_image.save(save_path, format="JPEG")
             # logging.debug(f"Saved cropped image to {save_path}")
 
-            # Correctly encode the cropped image to bytes
-            buffered = io.BytesIO()
-            cropped_image.save(buffered, format="JPEG")
-            cropped_image_bytes = buffered.getvalue()
-
-            # Convert the cropped image to a base64-encoded URL
-            base64_url = utils.image_to_base64_url_bytes(cropped_image_bytes, filename)
-
-            # Call the perform_ocr_extraction function with the base64 URL and the assigned client
-            # Depending on whether perform_ocr_extraction is async or sync, handle accordingly
-
-            # If perform_ocr_extraction is asynchronous
-            if class_id == 0:
-            # Call perishable_analyze
-            # Assuming perishable_analyze is synchronous
-                if asyncio.iscoroutinefunction(entity_extraction.perishable_analyze):
-                    analysis = await entity_extraction.perishable_analyze(
-                        base64_image=base64_url,
-                        client=client,
-                        classifier_model=classifier_model,
-                        device=freshness_classifier.device,
-                        threshold=0.9
-                    )
-                    # logging.debug(analysis.keys())
-                    if not analysis['product_name'] : 
-                        analysis = analysis = await asyncio.to_thread(
-                        entity_extraction.perform_ocr_extraction,
-                        base64_image=base64_url,
-                        openai_client=client)
-
-                else:
-                    # Run perishable_analyze in a separate thread if it's synchronous
-                    analysis = await asyncio.to_thread(
-                        entity_extraction.perishable_analyze,
-                        base64_image=base64_url,
-                        client=client,
-                        classifier_model=classifier_model,
-                        device=freshness_classifier.device,
-                        threshold=0.9
-                    )
-                    if not analysis['product_name'] : 
-                        analysis  = await asyncio.to_thread(
-                        entity_extraction.perform_ocr_extraction,
-                        base64_image=base64_url,
-                        openai_client=client)
+            if shelf_timeout is not None and index in crop_encodings:
+                raise shelf_timeout
+            encoded = crop_encodings.get(index) or encode_crop(cropped_image, filename, class_id)
+            base64_url = encoded["url"]
+            shelf_entry = shelf_results[index - 1]
+
+            # All LLM calls are non-blocking on the shared client; the global
+            # concurrency limit is enforced inside entity_extraction
+            if class_id == 0 and shelf_entry and shelf_entry.get('product_name') and (index - 1) in classifications:
+                # Shelf mode already analyzed this crop
+                analysis = entity_extraction.combine_freshness(shelf_entry, *classifications[index - 1])
+            elif class_id == 1 and shelf_entry:
+                analysis = shelf_entry
+            elif class_id == 0:
+                if classify_timed_out:
+                    raise deadlines.DeadlineExceeded("classify", started=False)
+                analysis, encoded = await analyze_perishable_crop(
+                    client, cropped_image, filename, encoded, classifications.get(index - 1)
+                )
+                base64_url = encoded["url"]
             elif class_id == 1:
                 # Call perform_ocr_extraction
-                if asyncio.iscoroutinefunction(entity_extraction.perform_ocr_extraction):
-                    analysis = await entity_extraction.perform_ocr_extraction(
-                        base64_image=base64_url,
-                        client=client
-                    )
-                else:
-                    # Run perform_ocr_extraction in a separate thread if it's synchronous
-                    analysis = await asyncio.to_thread(
-                        entity_extraction.perform_ocr_extraction,
-                        base64_image=base64_url,
-                        openai_client=client
-                    )
+                analysis = await entity_extraction.perform_ocr_extraction(
+                    base64_image=base64_url,
+                    openai_client=client,
+                    detail=encoded["detail"]
+                )
             else:
                 # Handle unexpected class_id values if necessary
                 raise ValueError(f"Unsupported class_id: {class_id}")
@@ -315,23 +1133,33 @@ async def process_detections_with_clients(
 #            logging.debug(f"Analysis for {filename}: {analysis}")
 
             # Append the result including the Base64-encoded image
-            analysis_results.append({
+            result = {
+                "bbox": det["bbox"],
                 "base64_image": base64_url , 
+                "encoded_bytes": encoded["encoded_bytes"],
+                "estimated_image_tokens": encoded["estimated_image_tokens"],
                   **analysis  # Add the Base64 image here
-            })
+            }
 
+        except deadlines.DeadlineExceeded as e:
+            result = {
+                "detection": det,
+                "status": "timed_out" if e.started else "pending",
+                "analysis": None,
+                "base64_image": None
+            }
         except Exception as e:
             logging.error(f"Error processing detection {det}: {e}", exc_info=True)
-            analysis_results.append({
+            result = {
                 "detection": det,
                 "analysis": None,
                 "error": str(e),
                 "saved_filename": filename if 'filename' in locals() else None,
                 "base64_image": None
-            })
-        finally:
-            # Put the client back into the queue
-            await client_queue.put(client)
+            }
+        analysis_results.append(result)
+        if on_result is not None:
+            on_result(index - 1, result)
 
     # Create a list of tasks with enumeration for sequential filenames
     tasks = [
@@ -0,0 +1,134 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# Under `uvicorn --workers N`, point this at an empty directory shared by the workers (wipe it
+# before each start) so /metrics reports counters and histograms summed over every worker, not
+# just the one that answered the scrape. It must be set before the workers start.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+
+class _WorkerGauges:
+    """
+    Gauges computed on scrape (queue depths, limits) from the state of the
+    worker that answers it; a collector rather than Gauge objects so they
+    stay out of the multiprocess files.
+    """
+
+    def __init__(self):
+        self.gauges = []
+
+    def collect(self):
+        for name, documentation, function in self.gauges:
+            yield GaugeMetricFamily(name, documentation, value=function())
+
+
+_worker_gauges = _WorkerGauges()
+_worker_registry = CollectorRegistry()
+_worker_registry.register(_worker_gauges)
+
+STAGE_SECONDS = Histogram(
+    "image_app_stage_seconds",
+    "Time spent in each pipeline stage",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+DETECTIONS_PER_IMAGE = Histogram(
+    "image_app_detections_per_image",
+    "Objects detected per analyzed image",
+    buckets=(0, 1, 2, 5, 10, 15, 20),
+)
+LLM_CALLS = Counter("image_app_llm_calls_total", "Completed gpt-4o calls")
+LLM_TOKENS = Counter("image_app_llm_tokens_total", "Tokens reported in completion usage", ["kind"])
+LLM_ERRORS = Counter("image_app_llm_errors_total", "gpt-4o calls that raised", ["error"])
+LLM_RETRIES = Counter(
+    "image_app_llm_retries_total",
+    "Retryable API responses (408/409/429/5xx) received by the OpenAI client"
+)
+COALESCED_REQUESTS = Counter(
+    "image_app_coalesced_requests_total",
+    "Requests answered by an identical request's in-flight analysis",
+    ["endpoint"]
+)
+UPLOAD_PEAK_BYTES = Histogram(
+    "image_app_upload_peak_bytes",
+    "Peak bytes one request held for its uploaded images (buffers, encoded images, decoded frame)",
+    ["endpoint"],
+    buckets=(2**20, 4 * 2**20, 16 * 2**20, 32 * 2**20, 64 * 2**20, 128 * 2**20, 256 * 2**20, 512 * 2**20),
+)
+DB_WRITE_SECONDS = Histogram(
+    "image_app_db_write_seconds",
+    "Latency of one batched ProductAnalysis write",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_ROWS_WRITTEN = Counter("image_app_db_rows_written_total", "ProductAnalysis rows written")
+DB_WRITE_ERRORS = Counter("image_app_db_write_errors_total", "Failed ProductAnalysis batch writes")
+DB_ROWS_REJECTED = Counter(
+    "image_app_db_rows_rejected_total", "ProductAnalysis rows dropped because the database rejected their data"
+)
+
+# Stage timings of the request being handled; a dict shared by every task the request spawns
+_request_timings: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("request_timings", default=None)
+
+
+def start_request() -> Dict[str, List[float]]:
+    """Begin collecting the stage breakdown of the current request."""
+    timings: Dict[str, List[float]] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def observe(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.setdefault(stage, []).append(seconds)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block as one occurrence of `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def server_timing(timings: Dict[str, List[float]]) -> str:
+    """
+    Format a stage breakdown as a Server-Timing header value.
+
+    Stages that ran several times (e.g. one LLM call per crop) report their
+    summed duration and the count; concurrent spans can add up to more than
+    the request's wall time.
+    """
+    entries = []
+    for stage, durations in timings.items():
+        entry = f"{stage};dur={sum(durations) * 1000:.1f}"
+        if len(durations) > 1:
+            entry += f';desc="{len(durations)}x, max {max(durations) * 1000:.1f}ms"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+
+def register_gauge(name: str, documentation: str, function) -> None:
+    """A gauge read from `function` at scrape time; it describes only the worker that answers the scrape."""
+    _worker_gauges.gauges.append((name, documentation, function))
+
+
+def render():
+    """Return the Prometheus exposition body and its content type."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_worker_registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,414 @@
+"""
+One inference process per node, shared by every uvicorn worker.
+
+Usage:
+    python model_server.py [--socket /tmp/image-app-models.sock] [--threads 8]
+    MODEL_SERVER_SOCKET=/tmp/image-app-models.sock PROMETHEUS_MULTIPROC_DIR=/tmp/image-app-metrics \
+        uvicorn main:app --workers 8
+
+The server loads the detector and classifier once and serves them over a
+Unix socket. Frames and crops don't go through the socket: each web worker
+writes them into shared-memory segments it owns and reuses, and sends only
+the segment name and layout. The server maps those segments and hands the
+models views of them, so an image is copied once into shared memory and
+never pickled. Detection requests from all workers are micro-batched by one
+DetectionBatcher, so inference threads (--threads) are sized independently
+of the number of web workers.
+
+Protocol: 4-byte big-endian length, then a JSON object, in both
+directions. Requests carry an `id` that the response echoes, so one
+connection pipelines any number of requests.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+load_dotenv()
+
+# Web workers use the model server instead of loading the models when this is set
+MODEL_SERVER_SOCKET = os.getenv("MODEL_SERVER_SOCKET", "")
+# How long a web worker waits for the model server to come up at startup
+MODEL_SERVER_CONNECT_TIMEOUT_SECONDS = float(os.getenv("MODEL_SERVER_CONNECT_TIMEOUT_SECONDS", "120"))
+# Backoff between attempts to reconnect after the model server dropped the connection
+MODEL_SERVER_RECONNECT_MIN_SECONDS = float(os.getenv("MODEL_SERVER_RECONNECT_MIN_SECONDS", "0.5"))
+MODEL_SERVER_RECONNECT_MAX_SECONDS = float(os.getenv("MODEL_SERVER_RECONNECT_MAX_SECONDS", "10"))
+# Shared-memory segments are allocated in multiples of this many bytes, so they can be reused
+SHM_SEGMENT_ALIGN = 1 << 20
+
+_HEADER = struct.Struct(">I")
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Dict]:
+    try:
+        header = await reader.readexactly(_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = _HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+def encode_message(message: Dict) -> bytes:
+    body = json.dumps(message).encode('utf-8')
+    return _HEADER.pack(len(body)) + body
+
+
+def attach_segment(name: str) -> shared_memory.SharedMemory:
+    """Map a segment created by another process without taking over its cleanup."""
+    segment = shared_memory.SharedMemory(name=name)
+    # Before Python 3.13 attaching registers the segment with this process's resource
+    # tracker, which would unlink it (under the owner's feet) when this process exits
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+    return segment
+
+
+def close_segment(segment: shared_memory.SharedMemory) -> None:
+    try:
+        segment.close()
+    except BufferError:
+        # Still viewed by an inference call; unmapped when the process exits instead
+        pass
+
+
+# --- Web worker side ---
+
+class SegmentPool:
+    """Shared-memory segments owned by one web worker, reused across requests."""
+
+    def __init__(self, align: int = SHM_SEGMENT_ALIGN):
+        self.align = align
+        self._free: List[shared_memory.SharedMemory] = []
+        self._all: List[shared_memory.SharedMemory] = []
+
+    def acquire(self, size: int) -> shared_memory.SharedMemory:
+        fitting = [segment for segment in self._free if segment.size >= size]
+        if fitting:
+            segment = min(fitting, key=lambda s: s.size)
+            self._free.remove(segment)
+            return segment
+        segment = shared_memory.SharedMemory(create=True, size=max(self.align, -(-size // self.align) * self.align))
+        self._all.append(segment)
+        return segment
+
+    def release(self, segment: shared_memory.SharedMemory) -> None:
+        self._free.append(segment)
+
+    def discard(self, segment: shared_memory.SharedMemory) -> None:
+        # For a request abandoned mid-flight: the server may still be reading it, so it can't be reused
+        self._all.remove(segment)
+        segment.close()
+        segment.unlink()
+
+    def close(self) -> None:
+        for segment in self._all:
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self._free, self._all = [], []
+
+
+class ModelServerClient:
+    """
+    A web worker's connection to the model server.
+
+    If the server drops the connection (e.g. it restarted), requests fail
+    with ConnectionError while the client reconnects in the background with
+    exponential backoff. `on_status` is called with "disconnected" when the
+    connection is lost and with the server's model status as it comes back,
+    so readiness can follow it.
+    """
+
+    def __init__(self, socket_path: str = MODEL_SERVER_SOCKET, on_status: Optional[Callable[[str], None]] = None):
+        self.socket_path = socket_path
+        self.on_status = on_status
+        self.segments = SegmentPool()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+
+    async def connect(self, timeout: float = MODEL_SERVER_CONNECT_TIMEOUT_SECONDS) -> Dict:
+        """Connect, retrying until the server is up, and return its status once its models are warm."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await self._open()
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
+        while True:
+            status = await self.request({"op": "status"})
+            if status["models"] == "warm" or time.monotonic() > deadline:
+                return status
+            await asyncio.sleep(0.5)
+
+    async def request(self, message: Dict) -> Dict:
+        if self._writer is None:
+            raise ConnectionError("Not connected to the model server")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(encode_message({"id": request_id, **message}))
+            await self._writer.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _open(self) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        self._reader_task = asyncio.create_task(self._read_responses(reader))
+
+    async def _read_responses(self, reader: asyncio.StreamReader) -> None:
+        error = ConnectionError("Model server closed the connection")
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                future = self._pending.get(message["id"])
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(RuntimeError(f"Model server: {message['error']}"))
+                else:
+                    future.set_result(message["result"])
+        except Exception as e:
+            error = ConnectionError(f"Model server connection failed: {e}")
+        self._writer = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        if self._closing:
+            return
+        self._set_status("disconnected")
+        # Already running when the connection was lost again mid-reconnect
+        if self._reconnect_task is None or self._reconnect_task.done():
+            logging.error(f"{error}; reconnecting")
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = MODEL_SERVER_RECONNECT_MIN_SECONDS
+        while not self._closing:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MODEL_SERVER_RECONNECT_MAX_SECONDS)
+            try:
+                if self._writer is None:
+                    await self._open()
+                status = await self.request({"op": "status"})
+            except (OSError, RuntimeError) as e:
+                logging.warning(f"Reconnecting to the model server failed: {e}")
+                continue
+            # A restarted server may still be loading its models
+            self._set_status(status["models"])
+            if status["models"] == "warm":
+                logging.info("Reconnected to the model server")
+                return
+
+    def _set_status(self, status: str) -> None:
+        if self.on_status is not None:
+            self.on_status(status)
+
+    async def detect(self, pil_image: Image.Image) -> List[Dict]:
+        """Detections of one RGB frame, batched with the other workers' frames."""
+        width, height = pil_image.size
+        segment = self.segments.acquire(width * height * 3)
+        # Written in BGR, the order the detector takes arrays in, so the server uses it as is
+        frame = np.ndarray((height, width, 3), dtype=np.uint8, buffer=segment.buf)
+        frame[...] = np.asarray(pil_image)[..., ::-1]
+        del frame
+        return await self._request_on(segment, {"op": "detect", "shape": [height, width, 3]})
+
+    async def classify(self, crops: List[np.ndarray], threshold: float) -> List[Tuple[str, float]]:
+        """Freshness (label, probability) of each RGB crop, in one forward pass."""
+        if not crops:
+            return []
+        layout, offset = [], 0
+        for crop in crops:
+            layout.append([offset, crop.shape[0], crop.shape[1]])
+            offset += crop.shape[0] * crop.shape[1] * 3
+        segment = self.segments.acquire(offset)
+        buffer = np.ndarray((offset,), dtype=np.uint8, buffer=segment.buf)
+        for crop, (start, height, width) in zip(crops, layout):
+            buffer[start:start + height * width * 3].reshape(height, width, 3)[...] = crop
+        del buffer
+        results = await self._request_on(segment, {"op": "classify", "crops": layout, "threshold": threshold})
+        return [tuple(result) for result in results]
+
+    async def _request_on(self, segment: shared_memory.SharedMemory, message: Dict):
+        try:
+            result = await self.request({**message, "shm": segment.name})
+        except BaseException:
+            self.segments.discard(segment)
+            if self._writer is not None:
+                # Let the server unmap it; best effort, the connection may be gone
+                self._writer.write(encode_message({"id": next(self._ids), "op": "release", "shm": segment.name}))
+            raise
+        self.segments.release(segment)
+        return result
+
+    async def stats(self) -> Dict:
+        return await self.request({"op": "status"})
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self.segments.close()
+
+
+# --- Server side ---
+
+class ModelServer:
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.status = "loading"
+        self.started = time.time()
+        self.requests = 0
+        # Classification gets its own thread so it can overlap with a detection batch
+        self._classify_executor = ThreadPoolExecutor(1, thread_name_prefix="classifier")
+        self.batcher = None
+
+    def load(self) -> None:
+        import detection_worker
+        import freshness_classifier
+        import inference_backends
+        import main
+
+        main.obj_det_model = inference_backends.load_detector()
+        main.classifier_model = inference_backends.load_classifier()
+        self.status = "warming"
+        if main.WARMUP_RUNS > 0:
+            main.warmup_models()
+        self.batcher = detection_worker.DetectionBatcher(main.detect_objects_batch)
+        self.batcher.start()
+        self._classify = lambda crops, threshold: freshness_classifier.classify_images(
+            crops, main.classifier_model, device=freshness_classifier.device, threshold=threshold
+        )
+        self.status = "warm"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Segments this worker sent us, kept mapped for as long as it stays connected
+        segments: Dict[str, shared_memory.SharedMemory] = {}
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def respond(message: Dict) -> None:
+            try:
+                response = {"id": message["id"], "result": await self.dispatch(message, segments)}
+            except Exception as e:
+                logging.error(f"Model server {message.get('op')} request failed: {e}", exc_info=True)
+                response = {"id": message["id"], "error": str(e)}
+            async with write_lock:
+                writer.write(encode_message(response))
+                await writer.drain()
+
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                task = asyncio.create_task(respond(message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            for segment in segments.values():
+                close_segment(segment)
+
+    async def dispatch(self, message: Dict, segments: Dict[str, shared_memory.SharedMemory]):
+        op = message["op"]
+        if op == "status":
+            return {
+                "models": self.status,
+                "pid": os.getpid(),
+                "threads": self.threads,
+                "requests": self.requests,
+                "uptime_seconds": time.time() - self.started,
+                "detection": self.batcher.stats() if self.batcher is not None else None,
+            }
+        if op == "release":
+            segment = segments.pop(message["shm"], None)
+            if segment is not None:
+                close_segment(segment)
+            return None
+        if self.status != "warm":
+            raise RuntimeError(f"Models are {self.status}")
+        self.requests += 1
+        segment = segments.get(message["shm"])
+        if segment is None:
+            segment = segments[message["shm"]] = attach_segment(message["shm"])
+        if op == "detect":
+            height, width, channels = message["shape"]
+            frame = np.ndarray((height, width, channels), dtype=np.uint8, buffer=segment.buf)
+            return await self.batcher.detect(frame)
+        if op == "classify":
+            buffer = np.ndarray((segment.size,), dtype=np.uint8, buffer=segment.buf)
+            crops = [buffer[start:start + height * width * 3].reshape(height, width, 3) for start, height, width in message["crops"]]
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._classify_executor, self._classify, crops, message["threshold"])
+        raise ValueError(f"Unknown op {op!r}")
+
+
+async def serve(socket_path: str, threads: int) -> None:
+    server = ModelServer(threads)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    unix_server = await asyncio.start_unix_server(server.handle, path=socket_path)
+    logging.info(f"Model server listening on {socket_path}, loading models")
+    # Workers can connect (and wait for "warm") while the models load
+    await asyncio.to_thread(server.load)
+    logging.info(f"Models warm; {threads} inference threads")
+    async with unix_server:
+        await unix_server.serve_forever()
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--socket", default=MODEL_SERVER_SOCKET or "/tmp/image-app-models.sock")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="torch / ONNX Runtime threads")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    # Read by inference_backends and OpenMP when they are imported
+    os.environ.setdefault("ORT_INTRA_OP_THREADS", str(args.threads))
+    os.environ.setdefault("OMP_NUM_THREADS", str(args.threads))
+    import torch
+
+    torch.set_num_threads(args.threads)
+    try:
+        asyncio.run(serve(args.socket, args.threads))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
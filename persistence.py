@@ -0,0 +1,707 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import date
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# "mysql" writes to the RDS instance, "sqlite" to a local file (handy as a stand-in for tests and benchmarks)
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql")
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH", "product_analysis.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+# How long a dashboard read waits for a free pooled connection before giving up
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "5"))
+# A batch is flushed when it reaches DB_BATCH_SIZE rows or has waited DB_FLUSH_INTERVAL_SECONDS
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "50"))
+DB_FLUSH_INTERVAL_SECONDS = float(os.getenv("DB_FLUSH_INTERVAL_SECONDS", "1.0"))
+DB_MAX_RETRIES = int(os.getenv("DB_MAX_RETRIES", "3"))
+# Rows kept for retry while the database is unreachable; the oldest are dropped beyond this
+DB_MAX_PENDING_ROWS = int(os.getenv("DB_MAX_PENDING_ROWS", "10000"))
+# Let the writer add the expiry_month/state columns, their index and the rollup table on its first
+# connection. Off by default: every worker would race the ALTER TABLE on the production table, so
+# run `python persistence.py` once per deployment instead. The SQLite stand-in is always migrated.
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "0") == "1"
+
+# Copied from the analysis result; `state` is the classifier verdict ("fresh"/"rotten") of perishables
+PRODUCT_ANALYSIS_COLUMNS = [
+    "brand_name", "brand_details", "pack_size", "expiry_date",
+    "mrp", "product_name", "item_count", "category", "estimated_shelf_life_days", "state"
+]
+# Filled at insert time: the first day of the `expiry_date` month, as an ISO date, so it can be range-indexed
+DERIVED_COLUMNS = ["expiry_month"]
+# Dimensions ProductAnalysisRollup keeps product counts by, updated in the same transaction as the inserts
+ROLLUP_DIMENSIONS = ["category", "brand_name", "state", "expiry_month"]
+ROLLUP_VALUE_MAX_LENGTH = 255
+PLACEHOLDERS = {"mysql": "%s", "sqlite": "?"}
+
+SQLITE_SCHEMA = [
+    """
+CREATE TABLE IF NOT EXISTS ProductAnalysis (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    brand_name TEXT,
+    brand_details TEXT,
+    pack_size TEXT,
+    expiry_date TEXT,
+    mrp TEXT,
+    product_name TEXT,
+    item_count INTEGER,
+    category TEXT,
+    estimated_shelf_life_days INTEGER,
+    state TEXT,
+    expiry_month TEXT
+)
+""",
+    """
+CREATE TABLE IF NOT EXISTS ProductAnalysisRollup (
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    products INTEGER NOT NULL,
+    PRIMARY KEY (dimension, value)
+)
+""",
+]
+SQLITE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_product_analysis_expiry ON ProductAnalysis (expiry_month, id)",
+    "CREATE INDEX IF NOT EXISTS idx_product_analysis_rollup_rank ON ProductAnalysisRollup (dimension, products, value)",
+]
+# ProductAnalysis itself predates this service's migrations; only what it adds is created here
+MYSQL_ROLLUP_TABLE = """
+CREATE TABLE IF NOT EXISTS ProductAnalysisRollup (
+    dimension VARCHAR(32) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    products BIGINT NOT NULL,
+    PRIMARY KEY (dimension, value),
+    INDEX idx_product_analysis_rollup_rank (dimension, products, value)
+)
+"""
+NEW_COLUMNS = {
+    "mysql": {"state": "VARCHAR(16) NULL", "expiry_month": "DATE NULL"},
+    "sqlite": {"state": "TEXT", "expiry_month": "TEXT"},
+}
+ROLLUP_UPSERT = {
+    "mysql": (
+        "INSERT INTO ProductAnalysisRollup (dimension, value, products) VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE products = products + VALUES(products)"
+    ),
+    "sqlite": (
+        "INSERT INTO ProductAnalysisRollup (dimension, value, products) VALUES (?, ?, ?) "
+        "ON CONFLICT (dimension, value) DO UPDATE SET products = products + excluded.products"
+    ),
+}
+
+_EXPIRY_DATE = re.compile(r"^(0[1-9]|1[0-2])/(\d{4})$")
+
+
+def expiry_month(expiry_date: Optional[str]) -> Optional[str]:
+    """First day of the month of an `MM/YYYY` expiry (as made by parse_date_or_days), as an ISO date."""
+    match = _EXPIRY_DATE.match(expiry_date.strip()) if isinstance(expiry_date, str) else None
+    if match is None:
+        return None
+    return date(int(match.group(2)), int(match.group(1)), 1).isoformat()
+
+
+def to_row(data: Dict) -> tuple:
+    """The ProductAnalysis values (PRODUCT_ANALYSIS_COLUMNS, then DERIVED_COLUMNS) of one analysis result."""
+    return tuple(data.get(key, None) for key in PRODUCT_ANALYSIS_COLUMNS) + (expiry_month(data.get("expiry_date")),)
+
+
+def rollup_value(dimension: str, value: Any) -> Optional[str]:
+    """How a row's value is keyed in ProductAnalysisRollup; None when the row doesn't count for `dimension`."""
+    if value is None:
+        return None
+    # MySQL returns DATE columns as dates
+    value = value.isoformat() if isinstance(value, date) else str(value).strip()
+    if dimension == "expiry_month":
+        # "YYYY-MM"
+        value = value[:7]
+    return value[:ROLLUP_VALUE_MAX_LENGTH] or None
+
+
+def rollup_deltas(rows: List[tuple]) -> List[Tuple[str, str, int]]:
+    """Per-(dimension, value) product counts of a batch of rows, sorted so concurrent writers lock keys in the same order."""
+    columns = PRODUCT_ANALYSIS_COLUMNS + DERIVED_COLUMNS
+    positions = [(dimension, columns.index(dimension)) for dimension in ROLLUP_DIMENSIONS]
+    counts = Counter()
+    for row in rows:
+        for dimension, position in positions:
+            value = rollup_value(dimension, row[position])
+            if value is not None:
+                counts[(dimension, value)] += 1
+    return sorted((dimension, value, products) for (dimension, value), products in counts.items())
+
+
+def is_data_error(error: Exception) -> bool:
+    """Whether the database rejected the rows themselves (e.g. a value too long for its column), not the connection."""
+    # DB-API names, shared by sqlite3 and mysql.connector
+    return any(cls.__name__ in ("DataError", "IntegrityError") for cls in type(error).__mro__)
+
+
+class UnwrittenRows(Exception):
+    """A batch write gave up on `rows` (none of them committed) after retrying the connection."""
+
+    def __init__(self, rows: List[tuple], cause: Exception):
+        super().__init__(f"{len(rows)} ProductAnalysis rows not written: {cause}")
+        self.rows = rows
+
+
+def table_columns(cursor, dialect: str, table: str) -> set:
+    """Column names of `table`; empty when it doesn't exist."""
+    if dialect == "sqlite":
+        cursor.execute(f"PRAGMA table_info({table})")
+        return {row[1] for row in cursor.fetchall()}
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def ensure_schema(connection, dialect: str) -> None:
+    """Create or migrate the tables and indexes this service reads and writes; safe to run repeatedly."""
+    cursor = connection.cursor()
+    try:
+        if dialect == "sqlite":
+            for statement in SQLITE_SCHEMA:
+                cursor.execute(statement)
+        else:
+            cursor.execute(MYSQL_ROLLUP_TABLE)
+        existing = table_columns(cursor, dialect, "ProductAnalysis")
+        # Tables created before these columns existed
+        for column, definition in NEW_COLUMNS[dialect].items():
+            if column not in existing:
+                logging.info(f"Adding ProductAnalysis.{column}")
+                cursor.execute(f"ALTER TABLE ProductAnalysis ADD COLUMN {column} {definition}")
+        if dialect == "sqlite":
+            for statement in SQLITE_INDEXES:
+                cursor.execute(statement)
+        else:
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() "
+                "AND TABLE_NAME = 'ProductAnalysis' AND INDEX_NAME = 'idx_product_analysis_expiry'"
+            )
+            if not cursor.fetchone()[0]:
+                logging.info("Adding index idx_product_analysis_expiry")
+                cursor.execute("CREATE INDEX idx_product_analysis_expiry ON ProductAnalysis (expiry_month, id)")
+    finally:
+        cursor.close()
+    connection.commit()
+
+
+def rebuild_rollups(connection, dialect: str, batch_size: int = 1000) -> int:
+    """
+    Backfill expiry_month for rows written before it existed and recompute ProductAnalysisRollup from scratch.
+
+    Scans the whole table, so run it once after upgrading (or to repair the
+    rollup), with the writers stopped. Returns the number of rows counted.
+    """
+    placeholder = PLACEHOLDERS[dialect]
+    cursor = connection.cursor()
+    try:
+        last_id = 0
+        while True:
+            cursor.execute(
+                f"SELECT id, expiry_date FROM ProductAnalysis WHERE id > {placeholder} "
+                f"AND expiry_month IS NULL AND expiry_date IS NOT NULL ORDER BY id LIMIT {int(batch_size)}",
+                (last_id,)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = [(month, row_id) for row_id, expiry in rows if (month := expiry_month(expiry)) is not None]
+            if updates:
+                cursor.executemany(
+                    f"UPDATE ProductAnalysis SET expiry_month = {placeholder} WHERE id = {placeholder}", updates
+                )
+            connection.commit()
+
+        columns = PRODUCT_ANALYSIS_COLUMNS + DERIVED_COLUMNS
+        counts = Counter()
+        total = 0
+        last_id = 0
+        while True:
+            cursor.execute(
+                f"SELECT id, {', '.join(columns)} FROM ProductAnalysis WHERE id > {placeholder} "
+                f"ORDER BY id LIMIT {int(batch_size)}",
+                (last_id,)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            total += len(rows)
+            for dimension, value, products in rollup_deltas([row[1:] for row in rows]):
+                counts[(dimension, value)] += products
+        cursor.execute("DELETE FROM ProductAnalysisRollup")
+        cursor.executemany(
+            ROLLUP_UPSERT[dialect], [(dimension, value, products) for (dimension, value), products in sorted(counts.items())]
+        )
+    finally:
+        cursor.close()
+    connection.commit()
+    return total
+
+
+def mysql_connection_factory(pool_name: str = "product_analysis") -> Callable[[], Any]:
+    """Create a MySQL connection pool and return a function that checks out a connection from it."""
+    from mysql.connector import pooling
+
+    pool = pooling.MySQLConnectionPool(
+        pool_name=pool_name,
+        pool_size=DB_POOL_SIZE,
+        pool_reset_session=True,
+        host=os.getenv("db_host"),
+        user=os.getenv("db_user"),
+        password=os.getenv("db_password"),
+        database='flipkart'
+    )
+    return pool.get_connection
+
+
+def sqlite_connection_factory(path: str = DB_SQLITE_PATH) -> Callable[[], Any]:
+    """Return a function that opens a SQLite connection; the writer creates the tables."""
+    def connect():
+        return sqlite3.connect(path, check_same_thread=False)
+    return connect
+
+
+class ProductAnalysisWriter:
+    """
+    Write-behind persistence for ProductAnalysis rows.
+
+    Request handlers call `submit`, which only enqueues the row. A background
+    task drains the queue and writes each batch with one `executemany` and a
+    single commit, off the event loop; the batch's ProductAnalysisRollup
+    counts are upserted in the same transaction. A dropped connection is
+    replaced and the batch retried; rows that still fail are kept and
+    retried with the next batch. When the database rejects the data itself
+    (DataError, IntegrityError), the batch is split in halves until the
+    offending rows are isolated; those are logged and dropped so they can't
+    hold back the rows after them.
+
+    On its first connection the writer checks the schema. If ProductAnalysis
+    lacks the columns added by `ensure_schema` (DB_AUTO_MIGRATE is off and
+    `python persistence.py` hasn't been run), it inserts only the columns
+    that exist and skips the rollup, logs an error and reports
+    `schema_current` as False, rather than failing every write.
+    """
+
+    def __init__(
+        self,
+        connection_factory: Callable[[], Callable[[], Any]],
+        dialect: str = "mysql",
+        batch_size: int = DB_BATCH_SIZE,
+        flush_interval: float = DB_FLUSH_INTERVAL_SECONDS,
+        max_retries: int = DB_MAX_RETRIES,
+        max_pending_rows: int = DB_MAX_PENDING_ROWS,
+        migrate: Optional[bool] = None
+    ):
+        self.connection_factory = connection_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_pending_rows = max_pending_rows
+        self.dialect = dialect
+        self._set_columns(PRODUCT_ANALYSIS_COLUMNS + DERIVED_COLUMNS, rollup=True)
+        self.schema_current: Optional[bool] = None
+        # By default DB_AUTO_MIGRATE, and always for SQLite, since a fresh file has no tables yet
+        if migrate is None:
+            migrate = DB_AUTO_MIGRATE or dialect == "sqlite"
+        self._migrated = not migrate
+        self._connect: Optional[Callable[[], Any]] = None
+        self._connection = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: List[tuple] = []
+        # Serializes connection use between the flusher and warmup threads
+        self._connection_lock = threading.Lock()
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.batches_written = 0
+        self.write_errors = 0
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def warmup(self) -> None:
+        """Open the pool and a connection now rather than on the first write."""
+        def connect():
+            with self._connection_lock:
+                self._get_connection()
+        await asyncio.to_thread(connect)
+
+    def submit(self, data: Dict) -> None:
+        """Queue one analysis result for insertion; never blocks."""
+        if self._queue is None:
+            raise RuntimeError("ProductAnalysisWriter has not been started")
+        self._queue.put_nowait(to_row(data))
+
+    def write_rows(self, rows: List[Dict]) -> None:
+        """
+        Insert rows synchronously, bypassing the queue.
+
+        For batch jobs that must know rows are committed (e.g. before
+        checkpointing them); raises UnwrittenRows if the batch still fails
+        after retries. Rows the database rejects are dropped, not raised.
+        """
+        if not rows:
+            return
+        values = [to_row(data) for data in rows]
+        try:
+            with metrics.DB_WRITE_SECONDS.time():
+                written = self._write_batch(values)
+        except Exception:
+            self.write_errors += 1
+            metrics.DB_WRITE_ERRORS.inc()
+            raise
+        self.rows_written += written
+        self.batches_written += 1
+        metrics.DB_ROWS_WRITTEN.inc(written)
+
+    def close(self) -> None:
+        with self._connection_lock:
+            self._close()
+
+    async def stop(self) -> None:
+        """Flush everything still queued, then stop the background task."""
+        if self._task is not None:
+            # The sentinel makes the task write its current batch and exit
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+        # Last attempt for rows that failed earlier
+        await self._write([])
+        await asyncio.to_thread(self._close)
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = []
+            row = await self._queue.get()
+            if row is None:
+                stopping = True
+            else:
+                batch.append(row)
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                else:
+                    batch.append(row)
+            await self._write(batch)
+
+    async def _write(self, rows: List[tuple]) -> None:
+        rows = self._pending + rows
+        self._pending = []
+        if not rows:
+            return
+        try:
+            with metrics.DB_WRITE_SECONDS.time():
+                written = await asyncio.to_thread(self._write_batch, rows)
+            self.rows_written += written
+            self.batches_written += 1
+            metrics.DB_ROWS_WRITTEN.inc(written)
+            logging.debug(f"Inserted {written} rows into ProductAnalysis")
+        except Exception as e:
+            self.write_errors += 1
+            metrics.DB_WRITE_ERRORS.inc()
+            # Rows committed before the connection gave out are not retried
+            if isinstance(e, UnwrittenRows):
+                rows = e.rows
+            logging.error(f"ProductAnalysis batch insert failed, keeping {len(rows)} rows for retry: {e}")
+            if len(rows) > self.max_pending_rows:
+                logging.error(f"Dropping {len(rows) - self.max_pending_rows} oldest ProductAnalysis rows")
+                rows = rows[-self.max_pending_rows:]
+            self._pending = rows
+
+    def _write_batch(self, rows: List[tuple]) -> int:
+        with self._connection_lock:
+            return self._write_batch_locked(rows)
+
+    def _write_batch_locked(self, rows: List[tuple]) -> int:
+        # Chunks still to write, each in its own transaction; a chunk the database
+        # rejects is split in halves until the bad rows are isolated
+        chunks = [rows]
+        written = 0
+        attempt = 0
+        while chunks:
+            chunk = chunks[0]
+            try:
+                self._insert(self._get_connection(), chunk)
+            except Exception as e:
+                if is_data_error(e):
+                    self._rollback()
+                    chunks.pop(0)
+                    if len(chunk) > 1:
+                        middle = len(chunk) // 2
+                        chunks[:0] = [chunk[:middle], chunk[middle:]]
+                    else:
+                        self._reject(chunk[0], e)
+                    continue
+                # Assume the connection is broken and reconnect on the next attempt
+                attempt += 1
+                logging.warning(f"ProductAnalysis write attempt {attempt} failed: {e}")
+                self._close()
+                if attempt >= self.max_retries:
+                    raise UnwrittenRows([row for chunk in chunks for row in chunk], e) from e
+                time.sleep(min(2 ** (attempt - 1) * 0.1, 2.0))
+                continue
+            chunks.pop(0)
+            written += len(chunk)
+        return written
+
+    def _set_columns(self, columns: List[str], rollup: bool) -> None:
+        all_columns = PRODUCT_ANALYSIS_COLUMNS + DERIVED_COLUMNS
+        self._positions = None if columns == all_columns else [all_columns.index(column) for column in columns]
+        self._rollup = rollup
+        self.query = (
+            f"INSERT INTO ProductAnalysis ({', '.join(columns)}) "
+            f"VALUES ({', '.join([PLACEHOLDERS[self.dialect]] * len(columns))})"
+        )
+
+    def _check_schema(self, connection) -> None:
+        cursor = connection.cursor()
+        try:
+            existing = table_columns(cursor, self.dialect, "ProductAnalysis")
+            has_rollup = bool(table_columns(cursor, self.dialect, "ProductAnalysisRollup"))
+        finally:
+            cursor.close()
+        columns = [column for column in PRODUCT_ANALYSIS_COLUMNS + DERIVED_COLUMNS if column in existing]
+        missing = [column for column in PRODUCT_ANALYSIS_COLUMNS + DERIVED_COLUMNS if column not in existing]
+        self.schema_current = not missing and has_rollup
+        if not self.schema_current:
+            logging.error(
+                "ProductAnalysis schema is outdated (missing columns: "
+                f"{', '.join(missing) or 'none'}; rollup table: {'present' if has_rollup else 'missing'}); "
+                "writing only the existing columns. Run `python persistence.py` or set DB_AUTO_MIGRATE=1."
+            )
+        self._set_columns(columns, rollup=has_rollup)
+
+    def _insert(self, connection, rows: List[tuple]) -> None:
+        cursor = connection.cursor()
+        try:
+            if self._positions is None:
+                cursor.executemany(self.query, rows)
+            else:
+                cursor.executemany(self.query, [tuple(row[i] for i in self._positions) for row in rows])
+            # Committed with the rows, so the rollup never counts a row that isn't there
+            deltas = rollup_deltas(rows) if self._rollup else []
+            if deltas:
+                cursor.executemany(ROLLUP_UPSERT[self.dialect], deltas)
+        finally:
+            cursor.close()
+        connection.commit()
+
+    def _rollback(self) -> None:
+        try:
+            self._connection.rollback()
+        except Exception:
+            self._close()
+
+    def _reject(self, row: tuple, error: Exception) -> None:
+        self.rows_rejected += 1
+        metrics.DB_ROWS_REJECTED.inc()
+        logging.error(f"Dropping a ProductAnalysis row the database rejects ({error}): {row}")
+
+    def _get_connection(self):
+        if self._connect is None:
+            self._connect = self.connection_factory()
+        if self._connection is None:
+            self._connection = self._connect()
+            if not self._migrated:
+                ensure_schema(self._connection, self.dialect)
+                self._migrated = True
+            if self.schema_current is None:
+                self._check_schema(self._connection)
+        return self._connection
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "pending_retry": len(self._pending),
+            "schema_current": self.schema_current,
+            "rows_written": self.rows_written,
+            "rows_rejected": self.rows_rejected,
+            "batches_written": self.batches_written,
+            "write_errors": self.write_errors,
+        }
+
+
+class ProductAnalysisReader:
+    """
+    Aggregate reads for dashboards, served from ProductAnalysisRollup and the expiry index.
+
+    Every query is a primary-key lookup or an index range scan bounded by
+    `limit`, so its cost doesn't grow with the number of rows analyzed.
+    Pages are keyset-paginated: pass back the `next_cursor` (or `next_after_id`)
+    of the previous page.
+
+    The reader never migrates the schema. At most `max_connections` queries
+    run at once; the rest wait up to `wait_timeout` seconds for a free
+    connection, then raise TimeoutError, rather than failing as soon as the
+    MySQL pool is exhausted.
+    """
+
+    def __init__(
+        self,
+        connection_factory: Callable[[], Callable[[], Any]],
+        dialect: str = "mysql",
+        max_connections: int = DB_POOL_SIZE,
+        wait_timeout: float = DB_POOL_TIMEOUT_SECONDS
+    ):
+        self.connection_factory = connection_factory
+        self.dialect = dialect
+        self.placeholder = PLACEHOLDERS[dialect]
+        self.wait_timeout = wait_timeout
+        self._connect: Optional[Callable[[], Any]] = None
+        self._lock = threading.Lock()
+        self._connections = threading.BoundedSemaphore(max_connections)
+
+    def _query(self, query: str, params: tuple) -> List[tuple]:
+        with self._lock:
+            if self._connect is None:
+                self._connect = self.connection_factory()
+        if not self._connections.acquire(timeout=self.wait_timeout):
+            raise TimeoutError(f"No database connection free within {self.wait_timeout}s")
+        try:
+            # A pooled connection for MySQL, a fresh one for SQLite; closing returns it to the pool
+            connection = self._connect()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(query, params)
+                    return cursor.fetchall()
+                finally:
+                    cursor.close()
+            finally:
+                connection.close()
+        finally:
+            self._connections.release()
+
+    def count(self, dimension: str, value: str) -> int:
+        """Products counted under one value of a dimension."""
+        p = self.placeholder
+        rows = self._query(
+            f"SELECT products FROM ProductAnalysisRollup WHERE dimension = {p} AND value = {p}",
+            (dimension, value)
+        )
+        return rows[0][0] if rows else 0
+
+    def counts(self, dimension: str, limit: int = 50, cursor: Optional[str] = None) -> Dict:
+        """One page of a dimension's values, by product count (descending)."""
+        p = self.placeholder
+        query = f"SELECT value, products FROM ProductAnalysisRollup WHERE dimension = {p}"
+        params: tuple = (dimension,)
+        if cursor:
+            products, value = decode_cursor(cursor)
+            query += f" AND (products < {p} OR (products = {p} AND value < {p}))"
+            params += (products, products, value)
+        query += f" ORDER BY products DESC, value DESC LIMIT {int(limit) + 1}"
+        rows = self._query(query, params)
+        page = rows[:limit]
+        return {
+            "dimension": dimension,
+            "items": [{"value": value, "products": products} for value, products in page],
+            "next_cursor": encode_cursor(page[-1][1], page[-1][0]) if len(rows) > limit else None,
+        }
+
+    def expiring(self, month: str, limit: int = 50, after_id: int = 0) -> Dict:
+        """The products expiring in `month` ("YYYY-MM"), in insertion order, and how many there are."""
+        p = self.placeholder
+        columns = ["id"] + PRODUCT_ANALYSIS_COLUMNS
+        rows = self._query(
+            f"SELECT {', '.join(columns)} FROM ProductAnalysis WHERE expiry_month = {p} AND id > {p} "
+            f"ORDER BY id LIMIT {int(limit) + 1}",
+            (f"{month}-01", after_id)
+        )
+        page = rows[:limit]
+        return {
+            "month": month,
+            "products": self.count("expiry_month", month),
+            "items": [dict(zip(columns, row)) for row in page],
+            "next_after_id": page[-1][0] if len(rows) > limit else None,
+        }
+
+
+def encode_cursor(products: int, value: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([products, value]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Raises ValueError for a cursor this module didn't produce."""
+    try:
+        products, value = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(products, int) or not isinstance(value, str):
+        raise ValueError("Invalid cursor")
+    return products, value
+
+
+def create_writer() -> ProductAnalysisWriter:
+    """Build the writer for the configured DB_BACKEND."""
+    if DB_BACKEND == "sqlite":
+        return ProductAnalysisWriter(lambda: sqlite_connection_factory(DB_SQLITE_PATH), dialect="sqlite")
+    return ProductAnalysisWriter(mysql_connection_factory, dialect="mysql")
+
+
+def create_reader() -> ProductAnalysisReader:
+    """Build the reader for the configured DB_BACKEND."""
+    if DB_BACKEND == "sqlite":
+        return ProductAnalysisReader(lambda: sqlite_connection_factory(DB_SQLITE_PATH), dialect="sqlite")
+    return ProductAnalysisReader(lambda: mysql_connection_factory("product_analysis_reader"), dialect="mysql")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Create or migrate the ProductAnalysis schema (run once per deployment unless DB_AUTO_MIGRATE=1)"
+    )
+    parser.add_argument(
+        "--rebuild-rollups", action="store_true",
+        help="backfill expiry_month and recompute ProductAnalysisRollup from every row (stop the writers first)"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    dialect = "sqlite" if DB_BACKEND == "sqlite" else "mysql"
+    connect = sqlite_connection_factory(DB_SQLITE_PATH) if dialect == "sqlite" else mysql_connection_factory()
+    connection = connect()
+    try:
+        ensure_schema(connection, dialect)
+        if args.rebuild_rollups:
+            logging.info(f"Rebuilt ProductAnalysisRollup from {rebuild_rollups(connection, dialect)} rows")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import os
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+# How long a finished result keeps answering identical requests (e.g. a scanner's retry)
+SINGLE_FLIGHT_LINGER_SECONDS = float(os.getenv("SINGLE_FLIGHT_LINGER_SECONDS", "5"))
+
+T = TypeVar("T")
+
+
+def content_key(*payloads: bytes) -> str:
+    """Hash of the decoded image bytes; order-insensitive so the same image set in any order matches."""
+    digests = sorted(hashlib.sha256(payload).hexdigest() for payload in payloads)
+    return hashlib.sha256("".join(digests).encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into one computation.
+
+    The first caller for a key starts `factory()` as a task; callers that
+    arrive while it runs, or within `linger` seconds after it succeeded, get
+    the same result (or exception) instead of starting their own. The task
+    is shielded, so a caller that goes away does not cancel it for the others.
+    Failures, and results `reusable` rejects (e.g. partial results of a
+    request that ran out of time), are forgotten immediately so a retry runs again.
+    """
+
+    def __init__(self, linger: float = SINGLE_FLIGHT_LINGER_SECONDS, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.linger = linger
+        self.enabled = enabled
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable[T]],
+        reusable: Optional[Callable[[T], bool]] = None
+    ) -> Tuple[T, bool]:
+        """Return the result for `key` and whether it was shared with an earlier call."""
+        if not self.enabled:
+            return await factory(), False
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.create_task(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done, reusable))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key: Hashable, task: asyncio.Task, reusable: Optional[Callable[[T], bool]]) -> None:
+        succeeded = not task.cancelled() and task.exception() is None
+        if self.linger > 0 and succeeded and (reusable is None or reusable(task.result())):
+            asyncio.get_running_loop().call_later(self.linger, self._forget, key, task)
+        else:
+            self._forget(key, task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def stats(self) -> Dict:
+        return {"in_flight_or_lingering": len(self._calls), "leaders": self.leaders, "coalesced": self.coalesced}
@@ -0,0 +1,196 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+import llm_cache
+import utils
+
+load_dotenv()
+
+# Frames whose dHash is within this many bits of the last processed frame are skipped
+STREAM_DEDUP_MAX_DISTANCE = int(os.getenv("STREAM_DEDUP_MAX_DISTANCE", "6"))
+# Side of the frame dHash grid; 16 gives a 256-bit hash
+STREAM_DEDUP_HASH_SIZE = int(os.getenv("STREAM_DEDUP_HASH_SIZE", "16"))
+# ultralytics tracker config: "bytetrack.yaml" or "botsort.yaml"
+STREAM_TRACKER = os.getenv("STREAM_TRACKER", "bytetrack.yaml")
+# Frame rate the tracker assumes when sizing its lost-track buffer
+STREAM_FRAME_RATE = int(os.getenv("STREAM_FRAME_RATE", "30"))
+# A track is analyzed once it has been missing for this many processed frames...
+STREAM_TRACK_LOST_FRAMES = int(os.getenv("STREAM_TRACK_LOST_FRAMES", "15"))
+# ...or, for products that stay in view, after this many frames with the best crop so far
+STREAM_TRACK_MAX_FRAMES = int(os.getenv("STREAM_TRACK_MAX_FRAMES", "90"))
+# How the best crop of a track is chosen: "sharpness" (variance of the Laplacian) or "area"
+STREAM_CROP_SCORE = os.getenv("STREAM_CROP_SCORE", "sharpness")
+
+
+def hamming_distance(hash_a: str, hash_b: str) -> int:
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def crop_sharpness(crop: np.ndarray) -> float:
+    """Variance of the Laplacian of a crop; blurry (motion-smeared) crops score low."""
+    gray = crop.astype(np.float32).mean(axis=2) if crop.ndim == 3 else crop.astype(np.float32)
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0.0
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def crop_score(crop: np.ndarray, method: str = STREAM_CROP_SCORE) -> float:
+    if not crop.size:
+        return 0.0
+    if method == "area":
+        return float(crop.shape[0] * crop.shape[1])
+    return crop_sharpness(crop)
+
+
+class FrameDeduplicator:
+    """Skips frames that are nearly identical to the last frame that was processed."""
+
+    def __init__(self, max_distance: int = STREAM_DEDUP_MAX_DISTANCE, hash_size: int = STREAM_DEDUP_HASH_SIZE):
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self._last_hash: Optional[str] = None
+
+    def is_duplicate(self, pil_image: Image.Image) -> bool:
+        frame_hash = llm_cache.perceptual_hash(pil_image, self.hash_size)
+        if self._last_hash is not None and hamming_distance(frame_hash, self._last_hash) <= self.max_distance:
+            return True
+        self._last_hash = frame_hash
+        return False
+
+
+class _TrackerInput:
+    # The subset of ultralytics `Boxes` the trackers read, built from our detection dicts
+    def __init__(self, detections: List[Dict]):
+        bboxes = np.array([det["bbox"] for det in detections], dtype=np.float32).reshape(-1, 4)
+        self.conf = np.array([det["confidence"] for det in detections], dtype=np.float32)
+        self.cls = np.array([det["class_id"] for det in detections], dtype=np.float32)
+        # [xmin, ymin, width, height] -> [x_center, y_center, width, height]
+        self.xywh = np.column_stack([bboxes[:, :2] + bboxes[:, 2:] / 2, bboxes[:, 2:]])
+        self.xyxy = np.column_stack([bboxes[:, :2], bboxes[:, :2] + bboxes[:, 2:]])
+
+    def __len__(self):
+        return len(self.conf)
+
+    def __getitem__(self, index):
+        subset = object.__new__(_TrackerInput)
+        subset.conf, subset.cls = self.conf[index], self.cls[index]
+        subset.xywh, subset.xyxy = self.xywh[index], self.xyxy[index]
+        return subset
+
+
+def create_tracker(config: str = STREAM_TRACKER, frame_rate: int = STREAM_FRAME_RATE):
+    """Build a standalone ultralytics BYTETrack/BoT-SORT tracker for one stream."""
+    from ultralytics.trackers import BOTSORT, BYTETracker
+    from ultralytics.utils import IterableSimpleNamespace, yaml_load
+    from ultralytics.utils.checks import check_yaml
+
+    args = IterableSimpleNamespace(**yaml_load(check_yaml(config)))
+    tracker_class = BOTSORT if args.tracker_type == "botsort" else BYTETracker
+    return tracker_class(args=args, frame_rate=frame_rate)
+
+
+@dataclass
+class TrackedProduct:
+    track_id: int
+    detection: Dict
+    best_crop: np.ndarray
+    best_score: float
+    first_frame: int
+    last_frame: int
+    frames_seen: int = 1
+    analyzed: bool = False
+
+
+class ProductTracker:
+    """
+    Gives every physical product in a frame stream a persistent track ID.
+
+    Detections come from the shared detector (so stream frames batch with
+    /analyze_group/ requests); association across frames runs on a tracker
+    owned by this stream. Each track keeps a copy of its best crop, and is
+    handed out exactly once by `finished_tracks` so it gets one LLM analysis
+    no matter how many frames it appears in.
+    """
+
+    def __init__(
+        self,
+        tracker=None,
+        lost_frames: int = STREAM_TRACK_LOST_FRAMES,
+        max_frames: int = STREAM_TRACK_MAX_FRAMES,
+        score_method: str = STREAM_CROP_SCORE
+    ):
+        self.tracker = tracker if tracker is not None else create_tracker()
+        self.lost_frames = lost_frames
+        self.max_frames = max_frames
+        self.score_method = score_method
+        self.frame_index = 0
+        self.tracks: Dict[int, TrackedProduct] = {}
+        # Analyzed tracks whose crops were released; never analyzed again if they reappear
+        self.released_ids = set()
+
+    def update(self, frame: np.ndarray, detections: List[Dict]) -> List[Dict]:
+        """
+        Associate one processed frame's detections with the existing tracks.
+
+        Returns the tracked detections of this frame, each with its `track_id`.
+        """
+        self.frame_index += 1
+        tracked = self.tracker.update(_TrackerInput(detections), frame)
+
+        crops = utils.crop_detections(frame, detections)
+        frame_tracks = []
+        # Each row: x1, y1, x2, y2, track_id, score, class, detection index
+        for row in np.asarray(tracked).reshape(-1, 8):
+            track_id, det_index = int(row[4]), int(row[7])
+            det = detections[det_index]
+            frame_tracks.append({"track_id": track_id, **det})
+            if track_id in self.released_ids:
+                continue
+            crop = crops[det_index]
+            score = crop_score(crop, self.score_method)
+
+            product = self.tracks.get(track_id)
+            if product is None:
+                # Copy: the crop would otherwise keep the whole frame alive
+                product = TrackedProduct(
+                    track_id=track_id, detection=det, best_crop=crop.copy(), best_score=score,
+                    first_frame=self.frame_index, last_frame=self.frame_index
+                )
+                self.tracks[track_id] = product
+            else:
+                product.frames_seen += 1
+                product.last_frame = self.frame_index
+                if score > product.best_score and not product.analyzed:
+                    product.best_crop, product.best_score, product.detection = crop.copy(), score, det
+        return frame_tracks
+
+    def finished_tracks(self, flush: bool = False) -> List[TrackedProduct]:
+        """
+        Tracks ready for analysis: gone for `lost_frames` frames, seen for
+        `max_frames` frames, or every remaining track when `flush` is set.
+        Each track is returned only once.
+        """
+        ready = []
+        for product in self.tracks.values():
+            if product.analyzed:
+                continue
+            gone = self.frame_index - product.last_frame >= self.lost_frames
+            if flush or gone or product.frames_seen >= self.max_frames:
+                product.analyzed = True
+                ready.append(product)
+        # Analyzed tracks that left the scene no longer need their crop
+        for track_id in [t for t, p in self.tracks.items() if p.analyzed and self.frame_index - p.last_frame >= self.lost_frames]:
+            del self.tracks[track_id]
+            self.released_ids.add(track_id)
+        logging.debug(f"{len(ready)} tracks ready for analysis at frame {self.frame_index}")
+        return ready
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import persistence  # noqa: E402
+
+
+def make_writer(path):
+    # brand_name is capped like a VARCHAR column in MySQL, so an over-long value is a data error
+    connection = sqlite3.connect(path)
+    connection.execute(f"""
+        CREATE TABLE ProductAnalysis (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {', '.join(f'{column} TEXT' for column in persistence.PRODUCT_ANALYSIS_COLUMNS + persistence.DERIVED_COLUMNS)},
+            CHECK (length(brand_name) <= 10)
+        )
+    """)
+    connection.commit()
+    connection.close()
+    return persistence.ProductAnalysisWriter(
+        lambda: persistence.sqlite_connection_factory(path), dialect="sqlite", flush_interval=0.01
+    )
+
+
+def stored_brands(path):
+    connection = sqlite3.connect(path)
+    try:
+        return [row[0] for row in connection.execute("SELECT brand_name FROM ProductAnalysis ORDER BY id")]
+    finally:
+        connection.close()
+
+
+def test_poison_row_does_not_block_later_rows(tmp_path):
+    path = str(tmp_path / "product_analysis.db")
+    writer = make_writer(path)
+
+    async def run():
+        await writer.start()
+        writer.submit({"brand_name": "x" * 100, "category": "snacks"})
+        await asyncio.sleep(0.05)
+        for index in range(5):
+            writer.submit({"brand_name": f"brand {index}", "category": "snacks"})
+        await writer.stop()
+
+    asyncio.run(run())
+    assert stored_brands(path) == [f"brand {index}" for index in range(5)]
+    stats = writer.stats()
+    assert stats["pending_retry"] == 0
+    assert stats["rows_rejected"] == 1
+    assert stats["rows_written"] == 5
+
+
+def test_poison_row_is_isolated_within_a_batch(tmp_path):
+    path = str(tmp_path / "product_analysis.db")
+    writer = make_writer(path)
+    rows = [{"brand_name": f"brand {index}", "category": "snacks"} for index in range(7)]
+    rows[3]["brand_name"] = "x" * 100
+
+    writer.write_rows(rows)
+    writer.close()
+
+    assert stored_brands(path) == [f"brand {index}" for index in range(7) if index != 3]
+    # The rollup only counts the rows that were inserted
+    reader = persistence.ProductAnalysisReader(lambda: persistence.sqlite_connection_factory(path), dialect="sqlite")
+    assert reader.count("category", "snacks") == 6
+    assert writer.rows_rejected == 1
+
+
+def test_outdated_schema_writes_the_existing_columns(tmp_path):
+    path = str(tmp_path / "product_analysis.db")
+    # ProductAnalysis as it was before the state and expiry_month columns
+    connection = sqlite3.connect(path)
+    connection.execute(f"""
+        CREATE TABLE ProductAnalysis (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {', '.join(f'{column} TEXT' for column in persistence.PRODUCT_ANALYSIS_COLUMNS if column != 'state')}
+        )
+    """)
+    connection.commit()
+    connection.close()
+    writer = persistence.ProductAnalysisWriter(
+        lambda: persistence.sqlite_connection_factory(path), dialect="sqlite", migrate=False
+    )
+
+    writer.write_rows([{"brand_name": "brand", "state": "fresh", "expiry_date": "03/2026"}])
+    writer.close()
+
+    assert writer.schema_current is False
+    assert writer.rows_written == 1
+    assert stored_brands(path) == ["brand"]
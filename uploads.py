@@ -0,0 +1,376 @@
+import base64
+import binascii
+import io
+import os
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+from PIL import Image
+
+load_dotenv()
+
+# Largest encoded image accepted, in bytes
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+# Largest image accepted, in pixels (width x height), checked from the header before decoding
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", str(50_000_000)))
+# Most images accepted in one /multi_image_ocr/ request
+UPLOAD_MAX_IMAGES = int(os.getenv("UPLOAD_MAX_IMAGES", "10"))
+UPLOAD_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP", "TIFF"}
+
+# Room for the JSON or multipart framing around the images of one request
+BODY_OVERHEAD_BYTES = 64 * 1024
+_DATA_URL_PREFIX_MAX = 256
+
+
+class MemoryTracker:
+    """Bytes a request holds for its upload (buffers, encoded images and decoded frames) and their peak."""
+
+    def __init__(self):
+        self.held = 0
+        self.peak = 0
+
+    def hold(self, nbytes: int) -> None:
+        self.held += nbytes
+        self.peak = max(self.peak, self.held)
+
+    def release(self, nbytes: int) -> None:
+        self.held -= nbytes
+
+
+_memory: ContextVar[Optional[MemoryTracker]] = ContextVar("upload_memory", default=None)
+
+
+def track_memory() -> MemoryTracker:
+    """Start accounting the upload memory of the current request."""
+    tracker = MemoryTracker()
+    _memory.set(tracker)
+    return tracker
+
+
+def hold(nbytes: int) -> None:
+    tracker = _memory.get()
+    if tracker is not None:
+        tracker.hold(nbytes)
+
+
+def release(nbytes: int) -> None:
+    tracker = _memory.get()
+    if tracker is not None:
+        tracker.release(nbytes)
+
+
+def _too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+def _invalid(reason: str) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Invalid image: {reason}")
+
+
+def check_image(data: bytes, max_pixels: int = UPLOAD_MAX_PIXELS) -> None:
+    """Reject an encoded image by its header (format and dimensions) before anything decodes it."""
+    try:
+        image = Image.open(io.BytesIO(data))
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise _invalid(str(e))
+    if image.format not in UPLOAD_FORMATS:
+        raise HTTPException(status_code=415, detail=f"Unsupported image format: {image.format}")
+    width, height = image.size
+    if width * height > max_pixels:
+        raise _too_large(f"{width}x{height} image has more than {max_pixels} pixels")
+
+
+async def body_chunks(request: Request, max_bytes: int) -> AsyncIterator[bytes]:
+    """The request body as it arrives, cut off with a 413 once it exceeds `max_bytes`."""
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise _too_large(f"Request body is larger than {max_bytes} bytes")
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise _too_large(f"Request body is larger than {max_bytes} bytes")
+        yield chunk
+
+
+class Base64Decoder:
+    """
+    Decode one base64 string (optionally a data URL) fed in arbitrary pieces.
+
+    Only a partial 4-character group is carried between pieces, so the
+    encoded text is never held in memory; decoding stops with a 413 as soon
+    as the output passes `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self._prefix: Optional[bytearray] = bytearray()
+        self._pending = b""
+        self._padded = False
+
+    def write(self, text: bytes) -> None:
+        if self._prefix is not None:
+            # A "data:<mime>;base64," header may be split across pieces
+            self._prefix += text
+            if not self._prefix.startswith(b"data:"[:len(self._prefix)]):
+                text = bytes(self._prefix)
+            elif (comma := self._prefix.find(b",")) >= 0:
+                if not self._prefix[:comma].endswith(b";base64"):
+                    raise _invalid("data URL is not base64 encoded")
+                text = bytes(self._prefix[comma + 1:])
+            elif len(self._prefix) > _DATA_URL_PREFIX_MAX:
+                raise _invalid("malformed data URL")
+            else:
+                return
+            self._prefix = None
+        text = self._pending + text
+        usable = len(text) - len(text) % 4
+        self._pending = text[usable:]
+        if usable:
+            self._decode(text[:usable])
+
+    def _decode(self, text: bytes) -> None:
+        if self._padded:
+            raise _invalid("data after base64 padding")
+        try:
+            decoded = base64.b64decode(text, validate=True)
+        except binascii.Error as e:
+            raise _invalid(str(e))
+        if len(self.data) + len(decoded) > self.max_bytes:
+            raise _too_large(f"Image is larger than {self.max_bytes} bytes")
+        self._padded = text.endswith(b"=")
+        self.data += decoded
+        hold(len(decoded))
+
+    def close(self) -> bytes:
+        if self._prefix is not None:
+            prefix, self._prefix = bytes(self._prefix), None
+            if prefix.startswith(b"data:"):
+                raise _invalid("malformed data URL")
+            self.write(prefix)
+        if self._pending:
+            raise _invalid("truncated base64")
+        if not self.data:
+            raise _invalid("empty image")
+        return _to_bytes(self.data)
+
+
+class JsonImageReader:
+    """
+    Pull base64 images out of a JSON body as it streams in.
+
+    Accepts the bodies of the original JSON endpoints: an object whose
+    `field` is a string ({"image": "data:..."}) or an array of strings
+    ({"images": [...]}). Image strings are decoded piece by piece, so only
+    the decoded bytes are kept; other members are skipped, and nested
+    objects are rejected.
+    """
+
+    def __init__(self, field: str, max_images: int = 1, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.field = field
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.images: List[bytes] = []
+        self._depth = 0
+        self._expect_key = False
+        self._key: Optional[bytearray] = None
+        self._member = b""
+        self._decoder: Optional[Base64Decoder] = None
+        self._in_string = False
+        self._escape = False
+        self._done = False
+
+    def feed(self, chunk: bytes) -> None:
+        pos, end = 0, len(chunk)
+        while pos < end:
+            if self._in_string:
+                pos = self._feed_string(chunk, pos)
+                continue
+            char = chunk[pos:pos + 1]
+            pos += 1
+            if char in b" \t\r\n":
+                continue
+            if self._done:
+                raise HTTPException(status_code=400, detail="Malformed JSON body")
+            if char == b'"':
+                self._start_string()
+            elif char == b"{":
+                if self._depth:
+                    raise HTTPException(status_code=400, detail="Unsupported JSON body")
+                self._depth, self._expect_key = 1, True
+            elif char == b"[":
+                if self._depth != 1 or self._expect_key:
+                    raise HTTPException(status_code=400, detail="Unsupported JSON body")
+                self._depth = 2
+            elif char == b"]" and self._depth == 2:
+                self._depth = 1
+            elif char == b"}" and self._depth == 1:
+                self._depth, self._done = 0, True
+            elif char == b":" and self._depth == 1:
+                self._expect_key = False
+            elif char == b"," and self._depth == 1:
+                self._expect_key = True
+            elif not self._depth or self._expect_key:
+                raise HTTPException(status_code=400, detail="Malformed JSON body")
+            # Anything else is a comma between array items or part of a number/true/false/null
+
+    def _start_string(self) -> None:
+        self._in_string = True
+        if self._depth == 1 and self._expect_key:
+            self._key = bytearray()
+        elif self._member == self.field.encode():
+            if len(self.images) >= self.max_images:
+                raise _too_large(f"At most {self.max_images} images are accepted")
+            self._decoder = Base64Decoder(self.max_bytes)
+
+    def _feed_string(self, chunk: bytes, pos: int) -> int:
+        if self._escape:
+            self._escape = False
+            escaped = chunk[pos:pos + 1]
+            if self._decoder is not None:
+                # JSON encoders may write "/" as "\/"; nothing else belongs in base64
+                if escaped != b"/":
+                    raise _invalid("unexpected escape in base64")
+                self._decoder.write(b"/")
+            elif self._key is not None:
+                self._key += escaped
+            return pos + 1
+        # bytes.find is a memchr; much faster than a regex over megabytes of base64
+        quote, backslash = chunk.find(b'"', pos), chunk.find(b"\\", pos)
+        stop = min(i for i in (quote, backslash, len(chunk)) if i >= 0)
+        if self._decoder is not None:
+            self._decoder.write(chunk[pos:stop])
+        elif self._key is not None:
+            self._key += chunk[pos:stop]
+            if len(self._key) > _DATA_URL_PREFIX_MAX:
+                raise HTTPException(status_code=400, detail="Malformed JSON body")
+        if stop == len(chunk):
+            return stop
+        if chunk[stop:stop + 1] == b"\\":
+            self._escape = True
+            return stop + 1
+        self._end_string()
+        return stop + 1
+
+    def _end_string(self) -> None:
+        self._in_string = False
+        if self._key is not None:
+            self._member, self._key = bytes(self._key), None
+        elif self._decoder is not None:
+            self.images.append(self._decoder.close())
+            self._decoder = None
+
+    def close(self) -> List[bytes]:
+        if not self._done or self._in_string:
+            raise HTTPException(status_code=400, detail="Truncated JSON body")
+        if not self.images:
+            raise HTTPException(status_code=422, detail=f"Missing `{self.field}` in the JSON body")
+        return self.images
+
+
+def _to_bytes(buffer: bytearray) -> bytes:
+    # Immutable bytes let BytesIO and PIL share the buffer instead of copying it
+    data = bytes(buffer)
+    hold(len(data))
+    release(len(buffer))
+    buffer.clear()
+    return data
+
+
+async def _read_raw(request: Request, max_bytes: int) -> bytes:
+    buffer = bytearray()
+    async for chunk in body_chunks(request, max_bytes):
+        buffer += chunk
+        hold(len(chunk))
+    if not buffer:
+        raise _invalid("empty body")
+    return _to_bytes(buffer)
+
+
+async def _read_json(request: Request, field: str, max_images: int, max_bytes: int) -> List[bytes]:
+    reader = JsonImageReader(field, max_images, max_bytes)
+    # Base64 is 4/3 the size of what it encodes
+    body_limit = max_images * (max_bytes * 4 // 3 + _DATA_URL_PREFIX_MAX) + BODY_OVERHEAD_BYTES
+    async for chunk in body_chunks(request, body_limit):
+        reader.feed(chunk)
+    return reader.close()
+
+
+async def _read_multipart(request: Request, max_images: int, max_bytes: int) -> List[bytes]:
+    body_limit = max_images * max_bytes + BODY_OVERHEAD_BYTES
+    chunks = body_chunks(request, body_limit)
+
+    async def receive():
+        # Starlette's parser pulls the body through this, so the limit holds while it streams
+        try:
+            return {"type": "http.request", "body": await chunks.__anext__(), "more_body": True}
+        except StopAsyncIteration:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+    # File parts are spooled to temporary files past 1MB rather than kept in memory
+    form = await Request(request.scope, receive).form(max_files=max_images)
+    try:
+        images = []
+        for _, value in form.multi_items():
+            if isinstance(value, str):
+                continue
+            if value.size is not None and value.size > max_bytes:
+                raise _too_large(f"Image is larger than {max_bytes} bytes")
+            data = await value.read()
+            hold(len(data))
+            images.append(data)
+        if not images:
+            raise HTTPException(status_code=422, detail="No image file in the multipart body")
+        return images
+    finally:
+        await form.close()
+
+
+async def read_images(request: Request, field: str, max_images: int = 1, max_bytes: int = UPLOAD_MAX_BYTES) -> List[bytes]:
+    """
+    Read the encoded images of an upload, whatever its content type, and check them before decoding.
+
+    - application/octet-stream or image/*: the body is one image.
+    - multipart/form-data: every file part is an image (up to `max_images`).
+    - application/json: the original base64 bodies, {"image": ...} or
+      {"images": [...]}, decoded as they stream in.
+
+    Raises:
+        HTTPException: 413 past `max_bytes` per image, UPLOAD_MAX_PIXELS or
+        `max_images`; 415 for other content types or image formats; 400/422
+        for malformed bodies.
+    """
+    content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    if content_type == "application/json":
+        images = await _read_json(request, field, max_images, max_bytes)
+    elif content_type == "multipart/form-data":
+        images = await _read_multipart(request, max_images, max_bytes)
+    elif content_type == "application/octet-stream" or content_type.startswith("image/"):
+        images = [await _read_raw(request, max_bytes)]
+    else:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type: {content_type or 'none'}")
+    if len(images) > max_images:
+        raise _too_large(f"At most {max_images} images are accepted")
+    for data in images:
+        check_image(data)
+    return images
+
+
+def openapi_body(json_model: type, multiple: bool = False) -> Dict:
+    """OpenAPI requestBody for an endpoint reading its images with `read_images` rather than a body parameter."""
+    binary = {"type": "string", "format": "binary"}
+    content = {
+        "application/json": {"schema": json_model.model_json_schema()},
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"images": {"type": "array", "items": binary} if multiple else binary},
+            }
+        },
+    }
+    if not multiple:
+        content["application/octet-stream"] = {"schema": binary}
+    return {"requestBody": {"required": True, "content": content}}
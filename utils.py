@@ -1,5 +1,11 @@
 import base64
+import io
+import math
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
 
 
 def image_to_base64_url_bytes(image_bytes: bytes, filename: str) -> str:
@@ -42,4 +48,198 @@ def image_to_base64_url_bytes(image_bytes: bytes, filename: str) -> str:
     # Create the data URL
     base64_url = f"data:{mime_type};base64,{encoded_string}"
     
-    return base64_url
\ No newline at end of file
+    return base64_url
+
+
+def encode_image_for_llm(
+    image: Union[Image.Image, np.ndarray],
+    filename: str,
+    max_side: Optional[int] = None,
+    quality: int = 80
+) -> Tuple[str, int, Tuple[int, int]]:
+    """
+    Downscale and JPEG-encode an image into a base64 data URL for the LLM.
+    
+    Args:
+        image (Image.Image or np.ndarray): The image to encode; arrays are HxWx3 RGB uint8.
+        filename (str): Filename used to pick the MIME type of the data URL.
+        max_side (int, optional): Cap on the longest side in pixels; the aspect ratio is kept.
+        quality (int): JPEG quality.
+        
+    Returns:
+        Tuple[str, int, Tuple[int, int]]: The data URL, the encoded JPEG size in bytes
+        and the (width, height) that was encoded.
+    """
+    if isinstance(image, np.ndarray):
+        # Copies only this crop's pixels out of the frame
+        image = Image.fromarray(np.ascontiguousarray(image))
+    elif max_side and max(image.size) > max_side:
+        image = image.copy()
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    image_bytes = buffered.getvalue()
+    return image_to_base64_url_bytes(image_bytes, filename), len(image_bytes), image.size
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Estimate the input tokens gpt-4o charges for one image.
+    
+    Low detail is a flat 85 tokens. Otherwise the image is fit into 2048x2048,
+    its shortest side is scaled to 768px, and every 512px tile costs 170 tokens
+    on top of the 85 base tokens.
+    
+    Args:
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        detail (str): The `detail` level requested: "low", "high" or "auto".
+        
+    Returns:
+        int: The estimated number of image tokens.
+    """
+    if detail == "low" or width <= 0 or height <= 0:
+        return 85
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def image_size(image) -> Tuple[int, int]:
+    """(width, height) of a PIL image or an HxWxC array."""
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+def crop_detections(frame: np.ndarray, detections: List[Dict]) -> List[np.ndarray]:
+    """
+    Crop every detection out of a decoded frame without copying pixels.
+    
+    Args:
+        frame (np.ndarray): The decoded HxWx3 RGB image.
+        detections (List[Dict]): Detections with a "bbox" of [xmin, ymin, width, height].
+        
+    Returns:
+        List[np.ndarray]: One view into `frame` per detection, clipped to the frame bounds.
+    """
+    if not detections:
+        return []
+    bboxes = np.array([det["bbox"] for det in detections], dtype=int)
+    # Ensure bounding boxes are within image bounds
+    img_height, img_width = frame.shape[:2]
+    x1 = np.clip(bboxes[:, 0], 0, img_width)
+    y1 = np.clip(bboxes[:, 1], 0, img_height)
+    x2 = np.clip(bboxes[:, 0] + bboxes[:, 2], x1, img_width)
+    y2 = np.clip(bboxes[:, 1] + bboxes[:, 3], y1, img_height)
+    return [frame[top:bottom, left:right] for left, top, right, bottom in zip(x1, y1, x2, y2)]
+
+
+# libjpeg can decode at 1/1, 1/2, 1/4 and 1/8 scale directly from the DCT coefficients
+JPEG_SCALES = (8, 4, 2, 1)
+
+
+def jpeg_scale(max_reduction: float) -> int:
+    """The coarsest JPEG decode scale (8, 4, 2 or 1) that reduces by at most `max_reduction`."""
+    return next(scale for scale in JPEG_SCALES if scale <= max(1.0, max_reduction))
+
+
+def decode_reduced(image_data: bytes, reduction: int) -> Image.Image:
+    """
+    Decode image bytes to RGB, letting libjpeg shrink the image by `reduction` while decoding.
+    
+    Only JPEG supports this (draft mode); other formats decode at full size.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    if reduction > 1 and image.format == "JPEG":
+        width, height = image.size
+        # draft() picks the largest scale that keeps the image at least this size
+        image.draft('RGB', (width // reduction, height // reduction))
+    return image.convert('RGB')
+
+
+def decode_for_detection(image_data: bytes, target_side: int) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Decode an upload near the detector's working resolution.
+    
+    Only the header is read to get the full size; JPEGs are then decoded at
+    the coarsest scale whose longest side is still at least `target_side`.
+    
+    Args:
+        image_data (bytes): The encoded image.
+        target_side (int): Longest side the detector needs; 0 decodes at full size.
+        
+    Returns:
+        Tuple[Image.Image, Tuple[int, int]]: The decoded RGB image and the full (width, height).
+    """
+    full_size = Image.open(io.BytesIO(image_data)).size
+    reduction = jpeg_scale(max(full_size) / target_side) if target_side else 1
+    return decode_reduced(image_data, reduction), full_size
+
+
+def scale_detections(detections: List[Dict], from_size: Tuple[int, int], to_size: Tuple[int, int]) -> List[Dict]:
+    """Map detection bboxes ([xmin, ymin, width, height]) from one image size to another."""
+    if not detections or from_size == to_size:
+        return detections
+    scale_x, scale_y = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    bboxes = np.array([det["bbox"] for det in detections], dtype=float) * [scale_x, scale_y, scale_x, scale_y]
+    bboxes = np.rint(bboxes).astype(int)
+    return [{**det, "bbox": bbox.tolist()} for det, bbox in zip(detections, bboxes)]
+
+
+def decode_crops(
+    image_data: bytes,
+    detections: List[Dict],
+    max_sides: List[Optional[int]],
+    decoded: Optional[Image.Image] = None
+) -> List[np.ndarray]:
+    """
+    Crop the detected regions at no more resolution than the LLM will use.
+    
+    A crop whose `max_side` is already met by `decoded` (e.g. the reduced
+    detection frame) is taken from it. The rest come from one more decode, at
+    the coarsest JPEG scale that still gives each of them its `max_side` on
+    the longest side, or its full size when smaller. libjpeg cannot decode
+    an arbitrary region, so that decode saves pixels by scale, not by area;
+    crops are copied out so the frame is released on return.
+    
+    Args:
+        image_data (bytes): The encoded image.
+        detections (List[Dict]): Detections with full-resolution bboxes.
+        max_sides (List[Optional[int]]): Longest side each crop is sent at; None keeps its native size.
+        decoded (Image.Image, optional): An already decoded, possibly reduced, version of the image.
+        
+    Returns:
+        List[np.ndarray]: One RGB crop per detection.
+    """
+    if not detections:
+        return []
+    full_size = Image.open(io.BytesIO(image_data)).size
+    # How far each crop may be scaled down and still be sent at its max_side
+    max_reductions = []
+    for det, max_side in zip(detections, max_sides):
+        longest = max(det["bbox"][2], det["bbox"][3])
+        max_reductions.append(longest / max_side if max_side and longest else 1.0)
+
+    crops: List[Optional[np.ndarray]] = [None] * len(detections)
+    if decoded is not None:
+        decoded_reduction = full_size[0] / decoded.size[0]
+        reuse = [i for i, limit in enumerate(max_reductions) if decoded_reduction <= max(1.0, limit)]
+        if reuse:
+            regions = scale_detections([detections[i] for i in reuse], full_size, decoded.size)
+            for i, crop in zip(reuse, crop_detections(np.asarray(decoded), regions)):
+                crops[i] = crop.copy()
+
+    remaining = [i for i, crop in enumerate(crops) if crop is None]
+    if remaining:
+        image = decode_reduced(image_data, jpeg_scale(min(max_reductions[i] for i in remaining)))
+        regions = scale_detections([detections[i] for i in remaining], full_size, image.size)
+        for i, crop in zip(remaining, crop_detections(np.asarray(image), regions)):
+            crops[i] = crop.copy()
+    return crops